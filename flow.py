@@ -1,12 +1,22 @@
-from pocketflow import Node, Flow, BatchNode
+from pocketflow import Node, Flow, BatchNode, AsyncNode, AsyncFlow, AsyncBatchNode, AsyncParallelBatchNode
 import os
-import yaml  # 添加YAML支持
+import time
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 
 # 导入工具函数
-from utils.call_llm import call_llm
+from utils.call_llm import call_llm, call_llm_stream, acall_llm, acall_llm_stream, repair_llm, arepair_llm
+from utils.yaml_stream import YamlBlockExtractor, extract_yaml_block
+from utils.parse_decision import MAX_PARALLEL_ACTIONS, DecisionParseError, parse_edit_plan, parse_main_decision
+from utils.format_history import format_history_summary
+from utils.checkpoint import AsyncCheckpointFlow, CheckpointFlow, save_progress
+from utils.content_store import content_digest, intern_content
+from utils import llm_metrics
+from utils.file_cache import dir_prefetch_candidates, file_cache, grep_prefetch_candidates, prefetcher
 from utils.read_file import read_file
 from utils.delete_file import delete_file
 from utils.replace_file import replace_file
@@ -25,115 +35,29 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger('coding_agent')
 
-def format_history_summary(history: List[Dict[str, Any]]) -> str:
-    if not history:
-        return "No previous actions."
-    
-    history_str = "\n"
-    
-    for i, action in enumerate(history):
-        # 所有条目的标题 - 移除时间戳
-        history_str += f"Action {i+1}:\n"
-        history_str += f"- Tool: {action['tool']}\n"
-        history_str += f"- Reason: {action['reason']}\n"
-        
-        # 添加参数
-        params = action.get("params", {})
-        if params:
-            history_str += f"- Parameters:\n"
-            for k, v in params.items():
-                history_str += f"  - {k}: {v}\n"
-        
-        # 添加详细结果信息
-        result = action.get("result")
-        if result:
-            if isinstance(result, dict):
-                success = result.get("success", False)
-                history_str += f"- Result: {'Success' if success else 'Failed'}\n"
-                
-                # 添加工具特定的详细信息
-                if action['tool'] == 'read_file' and success:
-                    content = result.get("content", "")
-                    # 显示完整内容而不截断
-                    history_str += f"- Content: {content}\n"
-                elif action['tool'] == 'grep_search' and success:
-                    matches = result.get("matches", [])
-                    history_str += f"- Matches: {len(matches)}\n"
-                    # 显示所有匹配项而不限制为前3个
-                    for j, match in enumerate(matches):
-                        history_str += f"  {j+1}. {match.get('file')}:{match.get('line')}: {match.get('content')}\n"
-                elif action['tool'] == 'edit_file' and success:
-                    operations = result.get("operations", 0)
-                    history_str += f"- Operations: {operations}\n"
-                    
-                    # 如果可用则包含推理
-                    reasoning = result.get("reasoning", "")
-                    if reasoning:
-                        history_str += f"- Reasoning: {reasoning}\n"
-                elif action['tool'] == 'list_dir' and success:
-                    # 获取树形可视化字符串
-                    tree_visualization = result.get("tree_visualization", "")
-                    history_str += "- Directory structure:\n"
-                    
-                    # 正确处理和格式化树形可视化
-                    if tree_visualization and isinstance(tree_visualization, str):
-                        # 首先，确保我们正确处理任何特殊的行结束字符
-                        clean_tree = tree_visualization.replace('\r\n', '\n').strip()
-                        
-                        if clean_tree:
-                            # 为每行添加适当的缩进
-                            for line in clean_tree.split('\n'):
-                                # 确保行正确缩进
-                                if line.strip():  # 只包含非空行
-                                    history_str += f"  {line}\n"
-                        else:
-                            history_str += "  (No tree structure data)\n"
-                    else:
-                        history_str += "  (Empty or inaccessible directory)\n"
-                        logger.debug(f"Tree visualization missing or invalid: {tree_visualization}")
-            else:
-                history_str += f"- Result: {result}\n"
-        
-        # 在操作之间添加分隔符
-        history_str += "\n" if i < len(history) - 1 else ""
-    
-    return history_str
-
-#############################################
-# 主决策代理节点
-#############################################
-class MainDecisionAgent(Node):
-    def prep(self, shared: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
-        # 获取用户查询和历史
-        user_query = shared.get("user_query", "")
-        history = shared.get("history", [])
-        
-        return user_query, history
-    
-    def exec(self, inputs: Tuple[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
-        user_query, history = inputs
-        logger.info(f"MainDecisionAgent: Analyzing user query: {user_query}")
-
-        # 使用工具函数格式化历史，使用'basic'详细级别
-        history_str = format_history_summary(history)
-        
-        # 使用YAML而不是JSON为LLM创建提示
-        prompt = f"""You are a coding assistant that helps modify and navigate code. Given the following request, 
+# 主决策代理的静态提示词：工具目录和YAML说明在每一轮都完全相同，
+# 作为system块发送并标记为提供方提示词缓存，每轮只有用户请求和历史需要重新处理
+MAIN_DECISION_SYSTEM_PROMPT = """You are a coding assistant that helps modify and navigate code. Given the following request, 
 decide which tool to use from the available options.
 
-User request: {user_query}
-
-Here are the actions you performed:
-{history_str}
-
 Available tools:
 1. read_file: Read content from a file
-   - Parameters: target_file (path)
+   - Parameters: target_file (path), start_line_one_indexed (optional), end_line_one_indexed_inclusive (optional)
+   - Without line numbers the whole file is returned. Files that are too large or binary return
+     their size, an outline and the first and last lines instead; read parts of them with a line range
+     (at most 250 lines per read)
    - Example:
      tool: read_file
      reason: I need to read the main.py file to understand its structure
      params:
        target_file: main.py
+   - Example (line range):
+     tool: read_file
+     reason: I need the definitions around line 1200 of the large generated file
+     params:
+       target_file: src/generated.py
+       start_line_one_indexed: 1180
+       end_line_one_indexed_inclusive: 1260
 
 2. edit_file: Make changes to a file
    - Parameters: target_file (path), instructions, code_edit
@@ -152,9 +76,9 @@ Available tools:
        instructions: Add try-except block around the file reading operation
        code_edit: |
             // ... existing file reading code ...
-            function newEdit() {{
+            function newEdit() {
                 // new code here
-            }}
+            }
             // ... existing file reading code ...
 
 3. delete_file: Remove a file
@@ -189,7 +113,7 @@ Available tools:
    - Example:
      tool: finish
      reason: I have completed the requested task of finding all logger instances
-     params: {{}}
+     params: {}
 
 Respond with a YAML object containing:
 ```yaml
@@ -201,47 +125,102 @@ params:
   # parameters specific to the chosen tool
 ```
 
+When you need several independent read-only actions (read_file, grep_search, list_dir)
+whose parameters do not depend on each other's results, you may request them in one turn
+(at most 5). They run concurrently and all results appear in the history before your next decision:
+```yaml
+actions:
+  - tool: read_file
+    reason: I need to read the entry point
+    params:
+      target_file: main.py
+  - tool: grep_search
+    reason: I need to find where the logger is configured
+    params:
+      query: getLogger
+```
+
 If you believe no more actions are needed, use "finish" as the tool and explain why in the reason.
 """
+
+#############################################
+# 主决策代理节点
+#############################################
+class MainDecisionAgent(Node):
+    def prep(self, shared: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+        # 获取用户查询和历史
+        user_query = shared.get("user_query", "")
+        history = shared.get("history", [])
+        
+        # LLM决策期间在后台预读下一步最可能读取的文件
+        prefetcher.prefetch(self.prefetch_candidates(shared))
         
-        # Call LLM to decide action
-        response = call_llm(prompt)
-
-        # Look for YAML structure in the response
-        yaml_content = ""
-        if "```yaml" in response:
-            yaml_blocks = response.split("```yaml")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].split("```")[0].strip()
-        elif "```yml" in response:
-            yaml_blocks = response.split("```yml")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].split("```")[0].strip()
-        elif "```" in response:
-            # Try to extract from generic code block
-            yaml_blocks = response.split("```")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].strip()
-        else:
-            # If no code blocks, try to use the entire response
-            yaml_content = response.strip()
-        
-        if yaml_content:
-            decision = yaml.safe_load(yaml_content)
-            
-            # Validate the required fields
-            assert "tool" in decision, "Tool name is missing"
-            assert "reason" in decision, "Reason is missing"
-            
-            # For tools other than "finish", params must be present
-            if decision["tool"] != "finish":
-                assert "params" in decision, "Parameters are missing"
-            else:
-                decision["params"] = {}
-            
-            return decision
-        else:
-            raise ValueError("No YAML object found in response")
+        return user_query, history
+    
+    def prefetch_candidates(self, shared: Dict[str, Any]) -> List[str]:
+        # 最近的只读操作（并行轮次可能有多个）中grep命中的文件和列出目录中的小文件
+        candidates = []
+        working_dir = shared.get("working_dir", "")
+        for action in reversed(shared.get("history", [])[-MAX_PARALLEL_ACTIONS:]):
+            if action["tool"] not in PARALLEL_TOOLS:
+                break
+            result = action.get("result")
+            if not (isinstance(result, dict) and result.get("success")):
+                continue
+            if action["tool"] == "grep_search":
+                candidates.extend(grep_prefetch_candidates(result.get("matches", [])))
+            elif action["tool"] == "list_dir":
+                path = action["params"].get("relative_workspace_path", ".")
+                candidates.extend(dir_prefetch_candidates(os.path.join(working_dir, path) if working_dir else path))
+        return list(dict.fromkeys(candidates))
+    
+    def build_prompt(self, user_query: str, history: List[Dict[str, Any]]) -> str:
+        # 使用工具函数格式化历史，使用'basic'详细级别
+        history_str = format_history_summary(history)
+        
+        # 工具目录和YAML说明位于MAIN_DECISION_SYSTEM_PROMPT中，这里只包含每轮变化的部分
+        prompt = f"""User request: {user_query}
+
+Here are the actions you performed:
+{history_str}
+"""
+        return prompt
+    
+    def parse_decision(self, yaml_content: str) -> Dict[str, Any]:
+        return parse_main_decision(yaml_content)
+    
+    def parse_response(self, response: str) -> Dict[str, Any]:
+        # 校验完整响应（或流提前关闭时的前缀），用于缓存和修复
+        return self.parse_decision(extract_yaml_block(response, allow_bare=True))
+    
+    def parse_or_repair(self, prompt: str, yaml_content: str) -> Dict[str, Any]:
+        try:
+            return self.parse_decision(yaml_content)
+        except DecisionParseError as e:
+            response = repair_llm(prompt, yaml_content, e, system=MAIN_DECISION_SYSTEM_PROMPT,
+                                  node="MainDecisionAgent", validate=self.parse_response)
+            return self.parse_response(response)
+    
+    def exec(self, inputs: Tuple[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        user_query, history = inputs
+        logger.info(f"MainDecisionAgent: Analyzing user query: {user_query}")
+        prompt = self.build_prompt(user_query, history)
+        
+        # Stream the LLM response and dispatch as soon as the YAML block closes,
+        # without waiting for any trailing prose
+        extractor = YamlBlockExtractor(allow_bare=True)
+        yaml_content = None
+        with closing(call_llm_stream(prompt, system=MAIN_DECISION_SYSTEM_PROMPT, node="MainDecisionAgent",
+                                     validate=self.parse_response)) as stream:
+            for chunk in stream:
+                yaml_content = extractor.feed(chunk)
+                if yaml_content is not None:
+                    break
+        if yaml_content is None:
+            yaml_content = extractor.finish()
+        
+        # 无效的决策不会被缓存；发送简短的修复请求，而不是重新生成完整响应
+        return self.parse_or_repair(prompt, yaml_content)
     
     def post(self, shared: Dict[str, Any], prep_res: Any, exec_res: Dict[str, Any]) -> str:
         logger.info(f"MainDecisionAgent: Selected tool: {exec_res['tool']}")
@@ -250,6 +229,20 @@ If you believe no more actions are needed, use "finish" as the tool and explain
         if "history" not in shared:
             shared["history"] = []
         
+        # 并行操作：每个操作作为独立的历史条目，由ParallelActionsNode统一填充结果
+        if exec_res["tool"] == "parallel":
+            shared["parallel_actions"] = []
+            for action in exec_res["actions"]:
+                shared["parallel_actions"].append(len(shared["history"]))
+                shared["history"].append({
+                    "tool": action["tool"],
+                    "reason": action["reason"],
+                    "params": action.get("params") or {},
+                    "result": None,
+                    "timestamp": datetime.now().isoformat()
+                })
+            return "parallel"
+        
         # 将此操作添加到历史
         shared["history"].append({
             "tool": exec_res["tool"],
@@ -266,7 +259,7 @@ If you believe no more actions are needed, use "finish" as the tool and explain
 # 读取文件操作节点
 #############################################
 class ReadFileAction(Node):
-    def prep(self, shared: Dict[str, Any]) -> str:
+    def prep(self, shared: Dict[str, Any]) -> Dict[str, Any]:
         # 从最后的历史条目获取参数
         history = shared.get("history", [])
         if not history:
@@ -286,22 +279,33 @@ class ReadFileAction(Node):
         reason = last_action.get("reason", "No reason provided")
         logger.info(f"ReadFileAction: {reason}")
         
-        return full_path
+        params = last_action["params"]
+        return {
+            "target_file": full_path,
+            "start_line_one_indexed": params.get("start_line_one_indexed"),
+            "end_line_one_indexed_inclusive": params.get("end_line_one_indexed_inclusive")
+        }
     
-    def exec(self, file_path: str) -> Tuple[str, bool]:
-        # 调用read_file工具，它返回(content, success)的元组
-        return read_file(file_path)
+    def exec(self, params: Dict[str, Any]) -> Tuple[str, bool]:
+        # 调用read_file工具，它返回(content, success)的元组；
+        # 过大的文件和二进制文件只返回有界的视图，不把整个文件放入提示词
+        return read_file(
+            params["target_file"],
+            params["start_line_one_indexed"],
+            params["end_line_one_indexed_inclusive"],
+            bounded=True
+        )
     
-    def post(self, shared: Dict[str, Any], prep_res: str, exec_res: Tuple[str, bool]) -> str:
+    def post(self, shared: Dict[str, Any], prep_res: Dict[str, Any], exec_res: Tuple[str, bool]) -> str:
         # 解包read_file()返回的元组
         content, success = exec_res
         
-        # 在最后的历史条目中更新结果
+        # 在最后的历史条目中更新结果；相同内容的多次读取共享同一个字符串
         history = shared.get("history", [])
         if history:
             history[-1]["result"] = {
                 "success": success,
-                "content": content
+                "content": intern_content(content)
             }
 
 #############################################
@@ -463,17 +467,26 @@ class ReadTargetFileNode(Node):
         return full_path
     
     def exec(self, file_path: str) -> Tuple[str, bool]:
-        # 调用read_file工具，它返回(content, success)
+        # 调用read_file工具，它返回(content, success)；编辑需要完整的内容和准确的行号，
+        # 不使用大文件的有界视图
         return read_file(file_path)
     
     def post(self, shared: Dict[str, Any], prep_res: str, exec_res: Tuple[str, bool]) -> str:
         content, success = exec_res
+        history = shared.get("history", [])
+        
+        if not success:
+            # 无法读取（不存在、二进制文件等）：不根据错误信息计划编辑，直接结束编辑流程
+            logger.warning(f"ReadTargetFileNode: {content}")
+            if history:
+                history[-1]["result"] = {"success": False, "operations": 0, "error": content}
+            return "failed"
+        
         logger.info("ReadTargetFileNode: File read completed for editing")
         
         # 在历史条目中存储文件内容
-        history = shared.get("history", [])
         if history:
-            history[-1]["file_content"] = content
+            history[-1]["file_content"] = intern_content(content)
         
 #############################################
 # 分析和计划更改节点
@@ -503,15 +516,11 @@ class AnalyzeAndPlanNode(Node):
             "code_edit": code_edit
         }
     
-    def exec(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def build_prompt(self, params: Dict[str, Any]) -> str:
         file_content = params["file_content"]
         instructions = params["instructions"]
         code_edit = params["code_edit"]
         
-        # 文件内容作为行
-        file_lines = file_content.split('\n')
-        total_lines = len(file_lines)
-        
         # 使用YAML而不是JSON为LLM生成提示以分析编辑
         prompt = f"""
 As a code editing assistant, I need to convert the following code edit instruction 
@@ -563,49 +572,20 @@ numbers accordingly. Start_line and end_line are 1-indexed.
 If the instruction indicates content should be appended to the file, set both start_line and end_line 
 to the maximum line number + 1, which will add the content at the end of the file.
 """
+        return prompt
+    
+    def parse_plan(self, response: str, total_lines: int) -> Dict[str, Any]:
+        return parse_edit_plan(response, total_lines)
+    
+    def exec(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # 文件内容作为行
+        total_lines = len(params["file_content"].split('\n'))
+        
+        # 调用LLM分析；只缓存通过校验的计划，无效的计划先尝试修复
+        response = call_llm(self.build_prompt(params), node="AnalyzeAndPlanNode",
+                            validate=lambda response: self.parse_plan(response, total_lines))
         
-        # 调用LLM分析
-        response = call_llm(prompt)
-
-        # 在响应中查找YAML结构
-        yaml_content = ""
-        if "```yaml" in response:
-            yaml_blocks = response.split("```yaml")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].split("```")[0].strip()
-        elif "```yml" in response:
-            yaml_blocks = response.split("```yml")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].split("```")[0].strip()
-        elif "```" in response:
-            # 尝试从通用代码块中提取
-            yaml_blocks = response.split("```")
-            if len(yaml_blocks) > 1:
-                yaml_content = yaml_blocks[1].strip()
-        
-        if yaml_content:
-            decision = yaml.safe_load(yaml_content)
-            
-            # 验证必需字段
-            assert "reasoning" in decision, "Reasoning is missing"
-            assert "operations" in decision, "Operations are missing"
-            
-            # 确保操作是列表
-            if not isinstance(decision["operations"], list):
-                raise ValueError("Operations are not a list")
-            
-            # 验证操作
-            for op in decision["operations"]:
-                assert "start_line" in op, "start_line is missing"
-                assert "end_line" in op, "end_line is missing"
-                assert "replacement" in op, "replacement is missing"
-                assert 1 <= op["start_line"] <= total_lines, f"start_line out of range: {op['start_line']}"
-                assert 1 <= op["end_line"] <= total_lines, f"end_line out of range: {op['end_line']}"
-                assert op["start_line"] <= op["end_line"], f"start_line > end_line: {op['start_line']} > {op['end_line']}"
-            
-            return decision
-        else:
-            raise ValueError("No YAML object found in response")
+        return self.parse_plan(response, total_lines)
     
     def post(self, shared: Dict[str, Any], prep_res: Dict[str, Any], exec_res: Dict[str, Any]) -> str:
         # 在共享中存储推理和编辑操作
@@ -617,8 +597,44 @@ to the maximum line number + 1, which will add the content at the end of the fil
 #############################################
 # 应用更改批处理节点
 #############################################
+class EditProgress:
+    """
+    记录编辑操作的应用进度（shared["edit_progress"]，随检查点保存），每个操作开始前和完成后都保存检查点。
+
+    操作按行号修改文件，重复应用会损坏文件，因此从ApplyChangesNode中途恢复时跳过已完成的操作。
+    开始后未记录完成的操作（在写入文件和保存检查点之间中断）按开始前的文件摘要判断：
+    文件已经变化说明操作已经写入。
+    """
+    
+    def __init__(self, shared: Dict[str, Any]):
+        self.shared = shared
+        # 键为操作在edit_operations中的下标（字符串，与JSON一致）
+        self.entries = shared.setdefault("edit_progress", {})
+    
+    def recorded(self, index: int, target_file: str) -> Optional[Tuple[str, bool]]:
+        """返回之前运行中已完成的操作的结果；操作尚未应用时返回None。"""
+        entry = self.entries.get(str(index))
+        if entry is None:
+            return None
+        if "result" in entry:
+            return tuple(entry["result"])
+        if os.path.exists(target_file) and content_digest(file_cache.read_text(target_file)) != entry["before"]:
+            logger.info(f"ApplyChangesNode: Operation {index} was applied before the run was interrupted")
+            return self.finish(index, ("Applied before the run was interrupted", True))
+        return None
+    
+    def start(self, index: int, target_file: str) -> None:
+        before = content_digest(file_cache.read_text(target_file)) if os.path.exists(target_file) else None
+        self.entries[str(index)] = {"before": before}
+        save_progress(self.shared)
+    
+    def finish(self, index: int, result: Tuple[str, bool]) -> Tuple[str, bool]:
+        self.entries[str(index)] = {"result": list(result)}
+        save_progress(self.shared)
+        return tuple(result)
+
 class ApplyChangesNode(BatchNode):
-    def prep(self, shared: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def prep(self, shared: Dict[str, Any]) -> List[Tuple[int, Dict[str, Any], EditProgress]]:
         # 获取编辑操作
         edit_operations = shared.get("edit_operations", [])
         if not edit_operations:
@@ -626,8 +642,8 @@ class ApplyChangesNode(BatchNode):
             return []
         
         # 按start_line降序排序编辑操作
-        # 这确保当我们从底部到顶部编辑时，行号保持有效
-        sorted_ops = sorted(edit_operations, key=lambda op: op["start_line"], reverse=True)
+        # 这确保当我们从底部到顶部编辑时，行号保持有效；下标用于记录每个操作的应用进度
+        sorted_ops = sorted(enumerate(edit_operations), key=lambda item: item[1]["start_line"], reverse=True)
         
         # 从历史中获取目标文件
         history = shared.get("history", [])
@@ -645,19 +661,27 @@ class ApplyChangesNode(BatchNode):
         full_path = os.path.join(working_dir, target_file) if working_dir else target_file
         
         # 将文件路径附加到每个操作
-        for op in sorted_ops:
+        for _, op in sorted_ops:
             op["target_file"] = full_path
         
-        return sorted_ops
+        progress = EditProgress(shared)
+        return [(index, op, progress) for index, op in sorted_ops]
     
-    def exec(self, op: Dict[str, Any]) -> Tuple[bool, str]:
+    def exec(self, item: Tuple[int, Dict[str, Any], EditProgress]) -> Tuple[bool, str]:
+        index, op, progress = item
+        # 从检查点恢复时不重复应用已经写入的操作
+        recorded = progress.recorded(index, op["target_file"])
+        if recorded is not None:
+            return recorded
+        progress.start(index, op["target_file"])
         # 调用replace_file工具，它返回(success, message)
-        return replace_file(
+        result = replace_file(
             target_file=op["target_file"],
             start_line=op["start_line"],
             end_line=op["end_line"],
             content=op["replacement"]
         )
+        return progress.finish(index, result)
     
     def post(self, shared: Dict[str, Any], prep_res: List[Dict[str, Any]], exec_res_list: List[Tuple[bool, str]]) -> str:
         # 检查所有操作是否成功
@@ -679,9 +703,10 @@ class ApplyChangesNode(BatchNode):
                 "reasoning": shared.get("edit_reasoning", "")
             }
         
-        # 处理完成后清除编辑操作和推理
+        # 处理完成后清除编辑操作、推理和应用进度
         shared.pop("edit_operations", None)
         shared.pop("edit_reasoning", None)
+        shared.pop("edit_progress", None)
         
 
 
@@ -695,11 +720,7 @@ class FormatResponseNode(Node):
         
         return history
     
-    def exec(self, history: List[Dict[str, Any]]) -> str:
-        # 如果没有历史，返回通用消息
-        if not history:
-            return "No actions were performed."
-        
+    def build_prompt(self, history: List[Dict[str, Any]]) -> str:
         # 使用工具函数为LLM生成操作摘要
         actions_summary = format_history_summary(history)
         
@@ -721,9 +742,15 @@ IMPORTANT:
 - Write as if you are directly speaking to the user
 - When providing code examples or structured information, use YAML format enclosed in triple backticks
 """
+        return prompt
+    
+    def exec(self, history: List[Dict[str, Any]]) -> str:
+        # 如果没有历史，返回通用消息
+        if not history:
+            return "No actions were performed."
         
         # 调用LLM生成响应
-        response = call_llm(prompt)
+        response = call_llm(self.build_prompt(history), node="FormatResponseNode")
         
         return response
     
@@ -735,6 +762,111 @@ IMPORTANT:
         
         return "done"
 
+#############################################
+# 预算检查节点
+#############################################
+# 会话预算，0表示不限制；可以通过shared["budget_limits"]按会话覆盖
+BUDGET_LIMITS = {
+    "turns": int(os.getenv("AGENT_MAX_TURNS", "30")),
+    "tokens": int(os.getenv("AGENT_MAX_TOKENS", "0")),
+    "seconds": float(os.getenv("AGENT_MAX_SECONDS", "0"))
+}
+
+class BudgetGate(Node):
+    """
+    在每次主决策之前检查会话预算：轮数、token数（llm_metrics.scope_tokens）和运行秒数。
+
+    用量保存在shared["budget_state"]中，随检查点一起保存。以"_"开头的字段是本进程的
+    计数基准，不保存到检查点：恢复后从恢复时刻重新计时，进程停止期间不计入预算。
+    任一预算用尽时记录exhausted_by，添加一个finish操作并转到FormatResponseNode。
+    """
+    def prep(self, shared: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        state = shared.get("budget_state") or {"turns": 0, "tokens": 0, "seconds": 0.0, "exhausted_by": None}
+        limits = {**BUDGET_LIMITS, **shared.get("budget_limits", {})}
+        return dict(state), limits
+    
+    def exec(self, inputs: Tuple[Dict[str, Any], Dict[str, Any]]) -> Dict[str, Any]:
+        state, limits = inputs
+        now, tokens = time.monotonic(), llm_metrics.scope_tokens()
+        if "_tick" in state:
+            state["seconds"] += now - state["_tick"]
+            state["tokens"] += tokens - state["_tokens_seen"]
+        state["_tick"], state["_tokens_seen"] = now, tokens
+        
+        # 按turns、tokens、seconds的顺序报告第一个用尽的预算
+        state["exhausted_by"] = next(
+            (budget for budget, limit in limits.items() if limit and state[budget] >= limit), None
+        )
+        if state["exhausted_by"] is None:
+            state["turns"] += 1
+        return state
+    
+    def post(self, shared: Dict[str, Any], prep_res: Any, exec_res: Dict[str, Any]) -> Optional[str]:
+        shared["budget_state"] = exec_res
+        budget = exec_res["exhausted_by"]
+        if budget is None:
+            return None
+        
+        _, limits = prep_res
+        logger.warning(f"BudgetGate: {budget} budget exhausted ({exec_res[budget]:.0f}/{limits[budget]:.0f}), finishing")
+        llm_metrics.record_budget_exhausted(budget)
+        
+        # 与主决策代理选择finish时相同的历史条目，最终响应会说明会话因预算用尽而结束
+        shared.setdefault("history", []).append({
+            "tool": "finish",
+            "reason": f"Stopped before completing the request: the {budget} budget of {limits[budget]:g} was exhausted",
+            "params": {},
+            "result": None,
+            "timestamp": datetime.now().isoformat()
+        })
+        return "exhausted"
+
+#############################################
+# 并行只读操作批处理节点
+#############################################
+class ParallelActionsNode(BatchNode):
+    """
+    在线程池中并发执行一轮中请求的多个只读操作。
+
+    每个操作复用对应单操作节点的prep/exec/post：prep和post使用只包含该历史条目的
+    共享视图，结果写回同一个条目；只有exec在工作线程中运行。
+    """
+    
+    def prep(self, shared: Dict[str, Any]) -> List[Tuple[str, Any]]:
+        history = shared.get("history", [])
+        items = []
+        for index in shared.get("parallel_actions", []):
+            action = history[index]
+            view = {"history": [action], "working_dir": shared.get("working_dir", "")}
+            items.append((action["tool"], PARALLEL_TOOLS[action["tool"]]().prep(view)))
+        return items
+    
+    def exec(self, item: Tuple[str, Any]) -> Any:
+        tool, prep_res = item
+        return PARALLEL_TOOLS[tool]().exec(prep_res)
+    
+    def _exec(self, items: List[Tuple[str, Any]]) -> List[Any]:
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(items), PARALLEL_ACTION_WORKERS)) as pool:
+            # 每个操作单独按max_retries重试
+            return list(pool.map(lambda item: Node._exec(self, item), items))
+    
+    def post(self, shared: Dict[str, Any], prep_res: List[Tuple[str, Any]], exec_res_list: List[Any]) -> str:
+        history = shared.get("history", [])
+        indices = shared.pop("parallel_actions", [])
+        for index, (tool, item_prep), exec_res in zip(indices, prep_res, exec_res_list):
+            PARALLEL_TOOLS[tool]().post({"history": [history[index]]}, item_prep, exec_res)
+        logger.info(f"ParallelActionsNode: Completed {len(exec_res_list)} actions")
+
+# 可以在一轮中并行执行的只读操作
+PARALLEL_TOOLS = {
+    "read_file": ReadFileAction,
+    "grep_search": GrepSearchAction,
+    "list_dir": ListDirAction
+}
+PARALLEL_ACTION_WORKERS = int(os.getenv("PARALLEL_ACTION_WORKERS", "8"))
+
 #############################################
 # 编辑代理流程
 #############################################
@@ -749,18 +881,32 @@ def create_edit_agent() -> Flow:
     analyze_plan >> apply_changes
     
     # 创建流程
-    return Flow(start=read_target)
+    return CheckpointFlow(start=read_target, name="EditAgent")
 
 #############################################
 # 主流程
 #############################################
+# 会话的token用量在shared中的键（以"_"开头，不保存到检查点；恢复后BudgetGate从恢复时刻重新计数）
+SESSION_USAGE_KEY = "_llm_usage"
+
+class AgentFlow(CheckpointFlow):
+    """
+    主流程：运行期间打开该会话的用量范围（llm_metrics.usage_scope），BudgetGate的token预算
+    只统计本会话的调用，不受同一进程中其他会话的影响。同一个shared多次运行时继续累加。
+    """
+    def _orch(self, shared: Dict[str, Any], params: Optional[Dict[str, Any]] = None) -> Any:
+        with llm_metrics.usage_scope(shared.setdefault(SESSION_USAGE_KEY, {})):
+            return super()._orch(shared, params)
+
 def create_main_flow() -> Flow:
     # 创建节点
+    budget_gate = BudgetGate()
     main_agent = MainDecisionAgent()
     read_action = ReadFileAction()
     grep_action = GrepSearchAction()
     list_dir_action = ListDirAction()
     delete_action = DeleteFileAction()
+    parallel_actions = ParallelActionsNode()
     edit_agent = create_edit_agent()
     format_response = FormatResponseNode()
     
@@ -769,18 +915,168 @@ def create_main_flow() -> Flow:
     main_agent - "grep_search" >> grep_action
     main_agent - "list_dir" >> list_dir_action
     main_agent - "delete_file" >> delete_action
+    main_agent - "parallel" >> parallel_actions
+    main_agent - "edit_file" >> edit_agent
+    main_agent - "finish" >> format_response
+    
+    # 每次决策之前检查预算，用尽时直接生成最终响应
+    budget_gate >> main_agent
+    budget_gate - "exhausted" >> format_response
+    
+    # 使用默认操作将操作节点连接回预算检查
+    read_action >> budget_gate
+    grep_action >> budget_gate
+    list_dir_action >> budget_gate
+    delete_action >> budget_gate
+    parallel_actions >> budget_gate
+    edit_agent >> budget_gate
+    edit_agent - "failed" >> budget_gate
+    
+    # 创建流程
+    return AgentFlow(start=budget_gate)
+
+#############################################
+# 异步执行路径
+#############################################
+# 异步节点复用同步节点的prep/post和提示词构建，只把阻塞部分换成异步：
+# LLM调用使用acall_llm，文件和目录操作在线程池中运行，
+# 因此多个会话可以在同一个事件循环上并发执行。
+class AsyncToolNode(AsyncNode):
+    async def prep_async(self, shared: Dict[str, Any]) -> Any:
+        return self.prep(shared)
+    
+    async def exec_async(self, prep_res: Any) -> Any:
+        # 在线程池中运行同步工具，避免阻塞事件循环
+        return await asyncio.to_thread(self.exec, prep_res)
+    
+    async def post_async(self, shared: Dict[str, Any], prep_res: Any, exec_res: Any) -> Any:
+        return self.post(shared, prep_res, exec_res)
+
+class AsyncMainDecisionAgent(AsyncToolNode, MainDecisionAgent):
+    async def exec_async(self, inputs: Tuple[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        user_query, history = inputs
+        logger.info(f"AsyncMainDecisionAgent: Analyzing user query: {user_query}")
+        prompt = self.build_prompt(user_query, history)
+        
+        # 与同步版本相同：YAML块闭合后立即停止读取流
+        extractor = YamlBlockExtractor(allow_bare=True)
+        yaml_content = None
+        stream = acall_llm_stream(prompt, system=MAIN_DECISION_SYSTEM_PROMPT, node="MainDecisionAgent",
+                                  validate=self.parse_response)
+        try:
+            async for chunk in stream:
+                yaml_content = extractor.feed(chunk)
+                if yaml_content is not None:
+                    break
+        finally:
+            await stream.aclose()
+        if yaml_content is None:
+            yaml_content = extractor.finish()
+        
+        try:
+            return self.parse_decision(yaml_content)
+        except DecisionParseError as e:
+            response = await arepair_llm(prompt, yaml_content, e, system=MAIN_DECISION_SYSTEM_PROMPT,
+                                         node="MainDecisionAgent", validate=self.parse_response)
+            return self.parse_response(response)
+
+class AsyncBudgetGate(AsyncToolNode, BudgetGate):
+    pass
+
+class AsyncReadFileAction(AsyncToolNode, ReadFileAction):
+    pass
+
+class AsyncGrepSearchAction(AsyncToolNode, GrepSearchAction):
+    pass
+
+class AsyncListDirAction(AsyncToolNode, ListDirAction):
+    pass
+
+class AsyncDeleteFileAction(AsyncToolNode, DeleteFileAction):
+    pass
+
+class AsyncParallelActionsNode(AsyncToolNode, AsyncParallelBatchNode, ParallelActionsNode):
+    # AsyncParallelBatchNode通过asyncio.gather并发执行，每个操作在线程池中运行
+    pass
+
+class AsyncReadTargetFileNode(AsyncToolNode, ReadTargetFileNode):
+    pass
+
+class AsyncAnalyzeAndPlanNode(AsyncToolNode, AnalyzeAndPlanNode):
+    async def exec_async(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        total_lines = len(params["file_content"].split('\n'))
+        response = await acall_llm(self.build_prompt(params), node="AnalyzeAndPlanNode",
+                                   validate=lambda response: self.parse_plan(response, total_lines))
+        return self.parse_plan(response, total_lines)
+
+class AsyncApplyChangesNode(AsyncToolNode, AsyncBatchNode, ApplyChangesNode):
+    # AsyncBatchNode按顺序逐个应用操作，保持自底向上的编辑顺序
+    pass
+
+class AsyncFormatResponseNode(AsyncToolNode, FormatResponseNode):
+    async def exec_async(self, history: List[Dict[str, Any]]) -> str:
+        if not history:
+            return "No actions were performed."
+        return await acall_llm(self.build_prompt(history), node="FormatResponseNode")
+
+def create_async_edit_agent() -> AsyncFlow:
+    # 创建节点
+    read_target = AsyncReadTargetFileNode()
+    analyze_plan = AsyncAnalyzeAndPlanNode()
+    apply_changes = AsyncApplyChangesNode()
+    
+    # 使用默认操作连接节点（无命名操作）
+    read_target >> analyze_plan
+    analyze_plan >> apply_changes
+    
+    # 创建流程
+    return AsyncCheckpointFlow(start=read_target, name="EditAgent")
+
+class AsyncAgentFlow(AsyncCheckpointFlow):
+    """AgentFlow的异步版本：用量范围通过contextvar传递，每个会话（任务）只统计自己的调用。"""
+    async def _orch_async(self, shared: Dict[str, Any], params: Optional[Dict[str, Any]] = None) -> Any:
+        with llm_metrics.usage_scope(shared.setdefault(SESSION_USAGE_KEY, {})):
+            return await super()._orch_async(shared, params)
+
+def create_async_main_flow() -> AsyncFlow:
+    # 创建节点
+    budget_gate = AsyncBudgetGate()
+    main_agent = AsyncMainDecisionAgent()
+    read_action = AsyncReadFileAction()
+    grep_action = AsyncGrepSearchAction()
+    list_dir_action = AsyncListDirAction()
+    delete_action = AsyncDeleteFileAction()
+    parallel_actions = AsyncParallelActionsNode()
+    edit_agent = create_async_edit_agent()
+    format_response = AsyncFormatResponseNode()
+    
+    # 将主代理连接到操作节点
+    main_agent - "read_file" >> read_action
+    main_agent - "grep_search" >> grep_action
+    main_agent - "list_dir" >> list_dir_action
+    main_agent - "delete_file" >> delete_action
+    main_agent - "parallel" >> parallel_actions
     main_agent - "edit_file" >> edit_agent
     main_agent - "finish" >> format_response
     
-    # 使用默认操作将操作节点连接回主代理
-    read_action >> main_agent
-    grep_action >> main_agent
-    list_dir_action >> main_agent
-    delete_action >> main_agent
-    edit_agent >> main_agent
+    budget_gate >> main_agent
+    budget_gate - "exhausted" >> format_response
+    
+    # 使用默认操作将操作节点连接回预算检查
+    read_action >> budget_gate
+    grep_action >> budget_gate
+    list_dir_action >> budget_gate
+    delete_action >> budget_gate
+    parallel_actions >> budget_gate
+    edit_agent >> budget_gate
+    edit_agent - "failed" >> budget_gate
     
     # 创建流程
-    return Flow(start=main_agent)
+    return AsyncAgentFlow(start=budget_gate)
 
 # 创建主流程
-coding_agent_flow = create_main_flow()
\ No newline at end of file
+coding_agent_flow = create_main_flow()
+
+# 创建异步主流程：每个会话使用自己的shared字典调用run_async，
+# 多个会话可以通过asyncio.gather在同一事件循环上并发运行
+async_coding_agent_flow = create_async_main_flow()
\ No newline at end of file
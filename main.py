@@ -2,6 +2,8 @@ import os
 import argparse
 import logging
 from flow import coding_agent_flow
+from utils import llm_metrics
+from utils.checkpoint import Checkpointer, attach_checkpointer, resume
 
 # 设置日志记录
 logging.basicConfig(
@@ -24,25 +26,55 @@ def main():
     parser.add_argument('--query', '-q', type=str, help='User query to process', required=False)
     parser.add_argument('--working-dir', '-d', type=str, default=os.path.join(os.getcwd(), "project"), 
                         help='Working directory for file operations (default: current directory)')
+    parser.add_argument('--checkpoint', type=str,
+                        default=os.getenv("CHECKPOINT_FILE", os.path.join(os.getenv("LOG_DIR", "logs"), "checkpoint.json.gz")),
+                        help='Checkpoint file saved after every node (default: logs/checkpoint.json.gz)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the run saved in the checkpoint file instead of starting a new one')
+    parser.add_argument('--max-turns', type=int, help='Stop after this many decisions (default: AGENT_MAX_TURNS or 30, 0 = unlimited)')
+    parser.add_argument('--max-tokens', type=int, help='Stop after this many LLM tokens (default: AGENT_MAX_TOKENS, 0 = unlimited)')
+    parser.add_argument('--max-seconds', type=float, help='Stop after this many seconds (default: AGENT_MAX_SECONDS, 0 = unlimited)')
     args = parser.parse_args()
     
-    # 如果没有通过命令行提供查询，则询问用户
-    user_query = args.query
-    if not user_query:
-        user_query = input("What would you like me to help you with? ")
+    checkpointer = Checkpointer(args.checkpoint)
     
-    # 初始化共享内存
-    shared = {
-        "user_query": user_query,
-        "working_dir": args.working_dir,
-        "history": [],
-        "response": None
-    }
+    if args.resume:
+        # 从检查点恢复共享内存，从最后完成的节点之后继续
+        shared, completed = resume(checkpointer)
+        if completed:
+            logger.info(f"Checkpoint {args.checkpoint} is already complete")
+            print(shared.get("response"))
+            return
+    else:
+        # 如果没有通过命令行提供查询，则询问用户
+        user_query = args.query
+        if not user_query:
+            user_query = input("What would you like me to help you with? ")
+        
+        # 初始化共享内存
+        shared = {
+            "user_query": user_query,
+            "working_dir": args.working_dir,
+            "history": [],
+            "response": None
+        }
+        attach_checkpointer(shared, checkpointer)
     
-    logger.info(f"Working directory: {args.working_dir}")
+    # 命令行指定的预算覆盖环境变量（恢复时也覆盖检查点中的设置）
+    limits = {"turns": args.max_turns, "tokens": args.max_tokens, "seconds": args.max_seconds}
+    shared.setdefault("budget_limits", {}).update({k: v for k, v in limits.items() if v is not None})
     
-    # 运行流程
-    coding_agent_flow.run(shared)
+    logger.info(f"Working directory: {shared['working_dir']}")
+    
+    # 运行流程（流程自己统计本会话的token用量）
+    try:
+        coding_agent_flow.run(shared)
+    finally:
+        # 导出LLM调用指标，用于分析哪个节点占用了会话的大部分时间
+        metrics_dir = os.getenv("LLM_METRICS_DIR", os.getenv("LOG_DIR", "logs"))
+        llm_metrics.export_json(os.path.join(metrics_dir, "llm_metrics.json"))
+        llm_metrics.export_prometheus(os.path.join(metrics_dir, "llm_metrics.prom"))
+        logger.info(f"LLM metrics written to {metrics_dir}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,100 +1,859 @@
-from anthropic import AnthropicVertex
 import os
-import logging
 import json
-from datetime import datetime
+import time
+import asyncio
+import threading
+from typing import Dict, Any, AsyncIterator, Callable, Iterator, Optional, Tuple
+from utils.llm_cache import LLMCache, MemoryCache, migrate_json_cache, prompt_key
+from utils.llm_client import get_backend, response_text, thinking_text, usage_to_dict
+from utils import llm_metrics
+from utils.llm_metrics import estimate_tokens
+from utils.llm_profiles import DEFAULT_PROFILE, get_profile, get_repair_profile
+from utils.llm_retry import acall_with_retry, astream_with_retry, call_with_retry, stream_with_retry
+from utils.rate_limiter import RateLimiter, rate_limiter_from_env
+from utils.singleflight import AsyncSingleFlight, SingleFlight
+from utils.llm_logging import PromptLogger, setup_llm_logger
 
-# 配置日志记录
+# 配置日志记录：后台线程写入按大小/时间轮转并压缩的日志文件
 log_directory = os.getenv("LOG_DIR", "logs")
-os.makedirs(log_directory, exist_ok=True)
-log_file = os.path.join(log_directory, f"llm_calls_{datetime.now().strftime('%Y%m%d')}.log")
+logger = setup_llm_logger(log_directory)
 
-# 设置日志记录器
-logger = logging.getLogger("llm_logger")
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(file_handler)
+# 提示词记录模式：full（完整）、hash（仅哈希）或delta（哈希加相对上一提示词的增量）
+prompt_logger = PromptLogger(logger, mode=os.getenv("LLM_LOG_PROMPTS", "full"))
 
-# 简单缓存配置
-cache_file = "llm_cache.json"
+# 缓存配置：SQLite索引缓存，首次使用时自动迁移旧版JSON缓存
+cache_db = os.getenv("LLM_CACHE_DB", "llm_cache.db")
+legacy_cache_file = "llm_cache.json"
+_cache = None
+_rate_limiter = None
+
+# 进程内LRU缓存层，位于磁盘缓存之前
+_ttl = os.getenv("LLM_MEMORY_CACHE_TTL")
+memory_cache = MemoryCache(
+    max_entries=int(os.getenv("LLM_MEMORY_CACHE_ENTRIES", "256")),
+    max_bytes=int(os.getenv("LLM_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(_ttl) if _ttl else None
+)
+
+def get_cache() -> LLMCache:
+    """返回进程内共享的磁盘缓存，首次调用时打开数据库并迁移旧版JSON缓存。"""
+    global _cache
+    if _cache is None:
+        _cache = LLMCache(cache_db)
+        migrate_json_cache(legacy_cache_file, _cache)
+    return _cache
+
+# 合并并发的相同请求：同一个缓存键同时只向上游发送一次
+inflight = SingleFlight()
+ainflight = AsyncSingleFlight()
+
+# 领导者没有可共享的响应（流式响应未通过校验且未能修复）：等待的调用方各自重新发起请求
+_NO_RESULT = object()
+
+# 流式响应未通过校验后，等待修复请求接手进行中调用的最长时间（秒）
+REPAIR_HANDOFF_TIMEOUT = float(os.getenv("LLM_REPAIR_HANDOFF_TIMEOUT", "120"))
+
+class _RepairHandoff:
+    """
+    流式响应未通过校验时，把进行中的调用交给随后的修复请求（repair_llm）。
+
+    流式响应已经交给调用方，由调用方决定是否修复，因此流结束时不能唤醒等待同一请求的调用方：
+    把它们的校验错误交给它们会使这些会话失败。调用先按缓存键挂起，repair_llm接手后以修复后的
+    响应唤醒等待的调用方，修复失败时以_NO_RESULT唤醒；REPAIR_HANDOFF_TIMEOUT内没有修复请求
+    接手时同样以_NO_RESULT唤醒。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[Callable[[Any], None], threading.Timer]] = {}
+
+    def park(self, key: str, finish: Callable[[Any], None]) -> None:
+        """挂起调用；finish以结果唤醒等待的调用方，可以在任意线程中调用。"""
+        timer = threading.Timer(REPAIR_HANDOFF_TIMEOUT, self._expire, (key, finish))
+        timer.daemon = True
+        with self._lock:
+            self._pending[key] = (finish, timer)
+        timer.start()
+
+    def claim(self, key: str) -> Optional[Callable[[Any], None]]:
+        """接手挂起的调用，返回其finish函数；没有挂起的调用时返回None。"""
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is None:
+            return None
+        entry[1].cancel()
+        return entry[0]
+
+    def _expire(self, key: str, finish: Callable[[Any], None]) -> None:
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None or entry[0] is not finish:
+                return
+            del self._pending[key]
+        logger.warning(f"No repair claimed the invalid streamed response within {REPAIR_HANDOFF_TIMEOUT:g}s, releasing waiters")
+        finish(_NO_RESULT)
+
+_repair_handoff = _RepairHandoff()
+
+def _finish_threadsafe(loop: asyncio.AbstractEventLoop, key: str, future: asyncio.Future) -> Callable[[Any], None]:
+    """返回在事件循环中完成异步进行中调用的finish函数，可以在任意线程中调用。"""
+    def finish(result: Any) -> None:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(ainflight.finish, key, future, result)
+    return finish
+
+def get_rate_limiter() -> RateLimiter:
+    """返回进程内共享的限流器（由LLM_RPM、LLM_TPM和LLM_RATE_LIMIT_DB配置）。"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = rate_limiter_from_env()
+    return _rate_limiter
+
+def get_cache_stats() -> Dict[str, Any]:
+    """返回内存缓存层的命中/未命中/淘汰计数器。"""
+    return memory_cache.stats()
+
+def get_token_usage() -> Dict[str, int]:
+    """返回本进程所有LLM请求累计的已缓存/未缓存输入token和输出token。"""
+    return llm_metrics.totals()
+
+def _record_call(node: Optional[str], start: float, usage: Dict[str, int], ttft: Optional[float] = None) -> None:
+    """记录一次上游调用的耗时和token用量。"""
+    record = llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=False, ttft=ttft, usage=usage)
+    # cache_read为命中提供方提示词缓存的输入token，cache_creation为写入缓存的输入token
+    logger.info(
+        f"LLM call ({record['node']}): {record['wall_time']:.2f}s, "
+        f"ttft={'n/a' if ttft is None else f'{ttft:.2f}s'}, "
+        f"cached input={record['cache_read_input_tokens']}, "
+        f"cache write={record['cache_creation_input_tokens']}, "
+        f"uncached input={record['input_tokens']}, output={record['output_tokens']}, "
+        f"thinking~={record['thinking_tokens']}"
+    )
+
+def _rate_limited_tokens(usage: Dict[str, int]) -> int:
+    # 与提供方的配额计算一致：命中提示词缓存的输入token不计入
+    return usage.get("input_tokens", 0) + usage.get("cache_creation_input_tokens", 0) + usage.get("output_tokens", 0)
+
+def _settle_rate_limit(estimate: int, usage: Dict[str, int]) -> None:
+    """用实际用量修正调用前按估算值预约的TPM配额。"""
+    get_rate_limiter().adjust(_rate_limited_tokens(usage) - estimate)
+
+def _limited_create(request: Dict[str, Any], estimate: int, timeout: float) -> Any:
+    get_rate_limiter().acquire(estimate)
+    try:
+        return get_backend().create(**request, timeout=timeout)
+    except BaseException:
+        # 失败（包括中断）的请求按未消耗配额处理，退还预约
+        get_rate_limiter().adjust(-estimate)
+        raise
+
+async def _alimited_create(request: Dict[str, Any], estimate: int, timeout: float) -> Any:
+    await get_rate_limiter().aacquire(estimate)
+    try:
+        return await get_backend().acreate(**request, timeout=timeout)
+    except BaseException:
+        # 包括对冲中落后而被取消的请求
+        get_rate_limiter().adjust(-estimate)
+        raise
+
+def _discard_response(node: Optional[str], estimate: int) -> Callable[[Any], None]:
+    """返回处理对冲中落后的响应的函数：用实际用量结算其限流预约并计入用量（不计为一次调用）。"""
+    def discard(response: Any) -> None:
+        usage = _response_usage(response)
+        _settle_rate_limit(estimate, usage)
+        llm_metrics.record_usage(node, usage)
+    return discard
+
+def _record_error(node: Optional[str], start: float, error: Exception) -> None:
+    llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=False, error=repr(error))
+
+def _response_usage(response: Any) -> Dict[str, int]:
+    usage = usage_to_dict(response.usage)
+    usage["thinking_tokens"] = estimate_tokens(thinking_text(response))
+    return usage
+
+class _StreamUsage:
+    """收集流式调用中分多次到达的usage，并记录首个token的到达时间。"""
+
+    def __init__(self, start: float):
+        self.start = start
+        self.usage: Dict[str, int] = {}
+        self.thinking_chars = 0
+        self.ttft: Optional[float] = None
+
+    def mark_first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+
+    def callback(self, usage: Dict[str, int]) -> None:
+        thinking_chars = usage.get("thinking_chars", 0)
+        if thinking_chars:
+            # 思考内容是最先到达的token
+            self.mark_first_token()
+            self.thinking_chars += thinking_chars
+        for field, value in usage.items():
+            if value and field != "thinking_chars":
+                self.usage[field] = value
+
+    def finalize(self, text: str) -> Dict[str, int]:
+        usage = dict(self.usage)
+        usage["thinking_tokens"] = (self.thinking_chars + 3) // 4
+        # 提前关闭流时提供方不会返回输出token数，使用估算值
+        if not usage.get("output_tokens"):
+            usage["output_tokens"] = estimate_tokens(text) + usage["thinking_tokens"]
+        return usage
+
+class _StreamAttempt:
+    """
+    一次上游流式请求（每次重试和每个对冲请求各一个），第一次读取时才经过限流器发起请求。
+
+    每个请求收集自己的用量，关闭时用实际用量结算自己的限流预约。失败的和对冲中落败的请求
+    同时把用量计入指标；成功的请求由调用方记为一次调用。
+    """
+
+    def __init__(self, request: Dict[str, Any], estimate: int, start: float, node: Optional[str], timeout: float):
+        self.request = {**request, "timeout": timeout}
+        self.estimate = estimate
+        self.node = node
+        self.usage = _StreamUsage(start)
+        self.chunks = []
+        self.failed = False
+        self.discarded = False
+        self.final_usage: Optional[Dict[str, int]] = None
+        self._stream = None
+
+    def discard(self) -> None:
+        self.discarded = True
+
+    def _received(self, chunk: str) -> str:
+        self.usage.mark_first_token()
+        self.chunks.append(chunk)
+        return chunk
+
+    def _settle(self) -> None:
+        """结算限流预约（只执行一次）；未发起的请求没有预约。"""
+        if self.final_usage is not None or self._stream is None:
+            return
+        self.final_usage = self.usage.finalize("".join(self.chunks))
+        _settle_rate_limit(self.estimate, self.final_usage)
+        if self.failed or self.discarded:
+            llm_metrics.record_usage(self.node, self.final_usage)
+
+    def __iter__(self) -> "_StreamAttempt":
+        return self
+
+    def __next__(self) -> str:
+        if self._stream is None:
+            get_rate_limiter().acquire(self.estimate)
+            self._stream = get_backend().stream(self.usage.callback, **self.request)
+        try:
+            return self._received(next(self._stream))
+        except StopIteration:
+            raise
+        except BaseException:
+            self.failed = True
+            raise
+
+    def close(self) -> None:
+        if self._stream is not None:
+            # 立即关闭上游流，提前停止读取时中止生成
+            self._stream.close()
+        self._settle()
+
+class _AsyncStreamAttempt(_StreamAttempt):
+    """_StreamAttempt的异步版本。"""
+
+    def __aiter__(self) -> "_AsyncStreamAttempt":
+        return self
+
+    async def __anext__(self) -> str:
+        if self._stream is None:
+            await get_rate_limiter().aacquire(self.estimate)
+            self._stream = get_backend().astream(self.usage.callback, **self.request)
+        try:
+            return self._received(await self._stream.__anext__())
+        except StopAsyncIteration:
+            raise
+        except BaseException:
+            self.failed = True
+            raise
+
+    async def aclose(self) -> None:
+        if self._stream is not None:
+            await self._stream.aclose()
+        self._settle()
+
+def _stream_winner(attempts) -> Optional[_StreamAttempt]:
+    """返回产出了响应的请求：既没有失败也没有在对冲中落败的那一个。"""
+    return next((attempt for attempt in attempts if not attempt.failed and not attempt.discarded), None)
+
+def _validation_error(text: str, validate: Optional[Callable[[str], Any]]) -> Optional[Exception]:
+    """返回validate对响应抛出的异常；未提供validate或校验通过时返回None。"""
+    if validate is None:
+        return None
+    try:
+        validate(text)
+    except Exception as e:
+        return e
+    return None
+
+def _lookup_cache(key: str, prompt: str, validate: Optional[Callable[[str], Any]] = None) -> Optional[str]:
+    """
+    依次查找内存缓存和磁盘缓存，磁盘命中时提升到内存缓存。
+
+    提供validate时，未通过校验的缓存条目（本功能之前写入的无效响应）被删除并视为未命中。
+    """
+    cached = memory_cache.get(key)
+    if cached is not None:
+        logger.info(f"Memory cache hit for prompt: {prompt[:50]}...")
+    else:
+        cached = get_cache().get(key)
+        if cached is None:
+            return None
+        logger.info(f"Cache hit for prompt: {prompt[:50]}...")
+        memory_cache.set(key, cached)
+
+    error = _validation_error(cached, validate)
+    if error is not None:
+        logger.warning(f"Discarding cached response that fails validation: {error}")
+        _discard_cache(key)
+        return None
+    return cached
+
+def _discard_cache(key: str) -> None:
+    memory_cache.delete(key)
+    try:
+        get_cache().delete(key)
+    except Exception as e:
+        logger.error(f"Failed to delete cache entry: {e}")
+
+def _store_cache(key: str, prompt: str, response_text: str) -> None:
+    memory_cache.set(key, response_text)
+    try:
+        get_cache().set(key, prompt, response_text)
+        logger.info(f"Added to cache")
+    except Exception as e:
+        logger.error(f"Failed to save cache: {e}")
+
+def _record_shared(node: Optional[str], start: float, prompt: str) -> None:
+    llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+    llm_metrics.record_event(node, "coalesced")
+    logger.info(f"Shared in-flight response for prompt: {prompt[:50]}...")
+
+def _join_inflight(key: str, prompt: str, node: Optional[str], start: float) -> Tuple[Any, Optional[str]]:
+    """
+    加入相同缓存键的进行中调用。
+
+    Returns:
+        (call, None)：本调用为领导者，完成后必须调用inflight.finish()
+        (None, text)：已从其他调用方得到响应
+    """
+    while True:
+        call, leader = inflight.join(key)
+        if leader:
+            break
+        text = call.wait()
+        if text is not _NO_RESULT:
+            _record_shared(node, start, prompt)
+            return None, text
+        # 领导者没有可共享的响应：重新加入，自己发起请求（或等待新的领导者）
+
+    # 上一个领导者先写缓存再移除键，在两者之间错过缓存的调用在这里命中
+    cached = memory_cache.get(key)
+    if cached is not None:
+        inflight.finish(key, call, result=cached)
+        llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+        return None, cached
+    return call, None
+
+async def _ajoin_inflight(key: str, prompt: str, node: Optional[str], start: float) -> Tuple[Any, Optional[str]]:
+    """_join_inflight的异步版本，合并同一个事件循环中的调用。"""
+    while True:
+        future, leader = ainflight.join(key)
+        if leader:
+            break
+        text = await asyncio.shield(future)
+        if text is not _NO_RESULT:
+            _record_shared(node, start, prompt)
+            return None, text
+
+    cached = memory_cache.get(key)
+    if cached is not None:
+        ainflight.finish(key, future, result=cached)
+        llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+        return None, cached
+    return future, None
+
+def _cache_key(prompt: str, system: Optional[str], profile: Dict[str, Any]) -> str:
+    # 没有system块且使用原有请求参数时保持原有的键，已有的缓存条目仍然有效
+    material = prompt if system is None else system + "\0" + prompt
+    if profile != DEFAULT_PROFILE:
+        # 不同模型或思考预算的响应不能互相复用
+        material = json.dumps(profile, sort_keys=True) + "\0" + material
+    return prompt_key(material)
+
+def _build_request(prompt: str, system: Optional[str], profile: Dict[str, Any]) -> Dict[str, Any]:
+    request = {
+        "max_tokens": profile["max_tokens"],
+        "messages": [{"role": "user", "content": prompt}],
+        "model": profile["model"]
+    }
+    if profile["thinking_budget"]:
+        request["thinking"] = {
+            "type": "enabled",
+            "budget_tokens": profile["thinking_budget"]
+        }
+    if system:
+        # 静态前缀标记为提供方提示词缓存，后续请求只需处理变化的用户消息
+        request["system"] = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+    return request
 
 # 了解更多关于调用LLM的信息: https://the-pocket.github.io/PocketFlow/utility_function/llm.html
-def call_llm(prompt: str, use_cache: bool = True) -> str:
+def call_llm(
+    prompt: str,
+    use_cache: bool = True,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None,
+    profile: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    调用LLM并返回响应文本。
+
+    提供validate时（通常是节点的解析函数，无效时抛出异常），只有通过校验的响应
+    才会写入缓存；未通过校验的响应先通过repair_llm发送一个简短的修复请求，
+    修复仍然失败时抛出校验错误。
+
+    Args:
+        prompt: 提示词（每次调用变化的部分）
+        use_cache: 是否使用缓存
+        system: 可选的静态system前缀，标记为提供方提示词缓存
+        node: 发起调用的节点名称，用于选择模型档案和指标统计
+        validate: 可选的响应校验函数
+        profile: 可选的档案，覆盖节点的档案
+    """
+    start = time.perf_counter()
+
     # 记录提示词
-    logger.info(f"PROMPT: {prompt}")
-    
+    prompt_logger.log(prompt)
+
     # 如果启用缓存则检查缓存
+    profile = profile or get_profile(node)
+    key = _cache_key(prompt, system, profile)
     if use_cache:
-        # 从磁盘加载缓存
-        cache = {}
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'r') as f:
-                    cache = json.load(f)
-            except:
-                logger.warning(f"Failed to load cache, starting with empty cache")
-        
-        # 如果缓存中存在则返回
-        if prompt in cache:
-            logger.info(f"Cache hit for prompt: {prompt[:50]}...")
-            return cache[prompt]
-    
-    # 如果不在缓存中或禁用缓存则调用LLM
-    client = AnthropicVertex(
-        region=os.getenv("ANTHROPIC_REGION", "us-east5"),
-        project_id=os.getenv("ANTHROPIC_PROJECT_ID", "your-project-id")
-    )
-    response = client.messages.create(
-        max_tokens=20000,
-        thinking={
-            "type": "enabled",
-            "budget_tokens": 16000
-        },
-        messages=[{"role": "user", "content": prompt}],
-        model="claude-3-7-sonnet@20250219"
-    )
-    response_text = response.content[1].text
-    
-    # 记录响应
-    logger.info(f"RESPONSE: {response_text}")
-    
-    # 如果启用缓存则更新缓存
+        cached = _lookup_cache(key, prompt, validate)
+        if cached is not None:
+            llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+            return cached
+
+        # 相同的请求正在进行时等待并共享其结果
+        call, shared = _join_inflight(key, prompt, node, start)
+        if shared is not None:
+            return shared
+
+    # 如果不在缓存中或禁用缓存则通过共享的长连接后端调用LLM，暂时性错误时退避重试
+    try:
+        request = _build_request(prompt, system, profile)
+        estimate = estimate_tokens(prompt)
+        # 每次重试都重新经过限流器
+        response = call_with_retry(lambda timeout: _limited_create(request, estimate, timeout), node=node,
+                                   on_discard=_discard_response(node, estimate))
+    except BaseException as e:
+        if isinstance(e, Exception):
+            _record_error(node, start, e)
+        if use_cache:
+            # 失败（包括中断）时唤醒等待同一请求的调用方，它们会收到同样的错误
+            inflight.finish(key, call, error=e)
+        raise
+    try:
+        text = response_text(response)
+        usage = _response_usage(response)
+        _settle_rate_limit(estimate, usage)
+        _record_call(node, start, usage)
+
+        # 记录响应
+        logger.info(f"RESPONSE: {text}")
+
+        # 无效的响应不缓存，先尝试修复
+        error = _validation_error(text, validate)
+        if error is not None:
+            text = repair_llm(prompt, text, error, system=system, node=node, validate=validate, use_cache=False, profile=profile)
+
+        # 如果启用缓存则更新缓存
+        if use_cache:
+            _store_cache(key, prompt, text)
+    except BaseException as e:
+        if use_cache:
+            # 上游调用之后的任何失败（修复、写缓存、记录指标或中断）同样要唤醒等待的调用方
+            inflight.finish(key, call, error=e)
+        raise
+
+    # 唤醒等待同一请求的调用方
     if use_cache:
-        # 重新加载缓存以避免覆盖
-        cache = {}
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'r') as f:
-                    cache = json.load(f)
-            except:
-                pass
-        
-        # 添加到缓存并保存
-        cache[prompt] = response_text
+        inflight.finish(key, call, result=text)
+
+    return text
+
+def call_llm_stream(
+    prompt: str,
+    use_cache: bool = True,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None
+) -> Iterator[str]:
+    """
+    流式调用LLM，逐块产出响应文本。
+
+    缓存命中时一次性产出缓存的响应。调用方拿到所需内容后可以提前关闭
+    生成器以中止生成；此时已接收的前缀会被缓存，因为它已包含调用方
+    需要的全部内容，再次请求时会得到相同的结果。
+
+    提供validate时，只有通过校验的响应（或前缀）才会被缓存和共享给等待的调用方。
+    流式响应已经交给调用方，因此不在这里修复：调用方解析失败时应调用repair_llm，
+    等待同一请求的调用方随后得到修复后的响应（修复失败时各自重新发起请求）。
+
+    Args:
+        prompt: 提示词（每次调用变化的部分）
+        use_cache: 是否使用缓存
+        system: 可选的静态system前缀，标记为提供方提示词缓存
+        node: 发起调用的节点名称，用于选择模型档案和指标统计
+        validate: 可选的响应校验函数
+
+    Yields:
+        响应文本块
+    """
+    start = time.perf_counter()
+    prompt_logger.log(prompt)
+
+    profile = get_profile(node)
+    key = _cache_key(prompt, system, profile)
+    if use_cache:
+        cached = _lookup_cache(key, prompt, validate)
+        if cached is not None:
+            llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+            yield cached
+            return
+
+        # 相同的请求正在进行时等待其完整响应，一次性产出
+        call, shared = _join_inflight(key, prompt, node, start)
+        if shared is not None:
+            yield shared
+            return
+
+    # 每次重试和每个对冲请求各自的上游请求
+    attempts = []
+    chunks = []
+    chunk_stream = None
+    finished = False
+    error = None
+    try:
+        request = _build_request(prompt, system, profile)
+        estimate = estimate_tokens(prompt)
+
+        def open_stream(timeout: float) -> _StreamAttempt:
+            attempts.append(_StreamAttempt(request, estimate, start, node, timeout))
+            return attempts[-1]
+
+        chunk_stream = stream_with_retry(open_stream, node=node, on_discard=_StreamAttempt.discard)
+        for chunk in chunk_stream:
+            chunks.append(chunk)
+            yield chunk
+        finished = True
+    except GeneratorExit:
+        # 调用方提前停止读取
+        finished = True
+        raise
+    except Exception as e:
+        error = e
+        _record_error(node, start, e)
+        raise
+    finally:
+        invalid = None
+        failure = None
         try:
-            with open(cache_file, 'w') as f:
-                json.dump(cache, f)
-            logger.info(f"Added to cache")
-        except Exception as e:
-            logger.error(f"Failed to save cache: {e}")
-    
-    return response_text
+            if chunk_stream is not None:
+                # 立即关闭上游流（提前停止读取时中止生成），各请求结算自己的限流预约
+                chunk_stream.close()
+            text = "".join(chunks)
+            logger.info(f"RESPONSE: {text}")
+            winner = _stream_winner(attempts)
+            if finished and winner is not None:
+                winner.close()
+                _record_call(node, start, winner.final_usage, winner.usage.ttft)
+                invalid = _validation_error(text, validate)
+            # 请求中途失败或响应未通过校验时不缓存
+            if finished and use_cache and text and invalid is None:
+                _store_cache(key, prompt, text)
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            # 收尾步骤失败时同样要唤醒等待同一请求的调用方
+            if use_cache:
+                if finished and invalid is None and failure is None:
+                    inflight.finish(key, call, result=text)
+                elif finished and failure is None:
+                    # 未通过校验：等待的调用方交给调用方随后的修复请求，不把校验错误交给它们
+                    _repair_handoff.park(key, lambda result: inflight.finish(key, call, result=result))
+                else:
+                    inflight.finish(key, call, error=failure or invalid or error or RuntimeError("In-flight LLM call was interrupted"))
+
+async def acall_llm(
+    prompt: str,
+    use_cache: bool = True,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None,
+    profile: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    call_llm的异步版本，供AsyncNode使用。
+
+    磁盘缓存读写在线程池中执行，LLM请求使用后端的异步客户端，
+    因此不会阻塞同一事件循环上的其他会话。校验和修复的行为与call_llm相同。
+    """
+    start = time.perf_counter()
+    prompt_logger.log(prompt)
+
+    profile = profile or get_profile(node)
+    key = _cache_key(prompt, system, profile)
+    if use_cache:
+        cached = await asyncio.to_thread(_lookup_cache, key, prompt, validate)
+        if cached is not None:
+            llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+            return cached
+
+        future, shared = await _ajoin_inflight(key, prompt, node, start)
+        if shared is not None:
+            return shared
+
+    try:
+        request = _build_request(prompt, system, profile)
+        estimate = estimate_tokens(prompt)
+        response = await acall_with_retry(lambda timeout: _alimited_create(request, estimate, timeout), node=node,
+                                          on_discard=_discard_response(node, estimate))
+    except BaseException as e:
+        if isinstance(e, Exception):
+            _record_error(node, start, e)
+        if use_cache:
+            # 包括取消：等待的调用方不能一直挂起
+            ainflight.finish(key, future, error=e)
+        raise
+    try:
+        text = response_text(response)
+        usage = _response_usage(response)
+        _settle_rate_limit(estimate, usage)
+        _record_call(node, start, usage)
+        logger.info(f"RESPONSE: {text}")
+
+        error = _validation_error(text, validate)
+        if error is not None:
+            text = await arepair_llm(prompt, text, error, system=system, node=node, validate=validate, use_cache=False, profile=profile)
+
+        if use_cache:
+            await asyncio.to_thread(_store_cache, key, prompt, text)
+    except BaseException as e:
+        if use_cache:
+            ainflight.finish(key, future, error=e)
+        raise
+
+    if use_cache:
+        ainflight.finish(key, future, result=text)
+
+    return text
+
+async def acall_llm_stream(
+    prompt: str,
+    use_cache: bool = True,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None
+) -> AsyncIterator[str]:
+    """call_llm_stream的异步版本，提前关闭（aclose）时的缓存和校验行为相同。"""
+    start = time.perf_counter()
+    prompt_logger.log(prompt)
+
+    profile = get_profile(node)
+    key = _cache_key(prompt, system, profile)
+    if use_cache:
+        cached = await asyncio.to_thread(_lookup_cache, key, prompt, validate)
+        if cached is not None:
+            llm_metrics.record_call(node, time.perf_counter() - start, cache_hit=True)
+            yield cached
+            return
+
+        future, shared = await _ajoin_inflight(key, prompt, node, start)
+        if shared is not None:
+            yield shared
+            return
+
+    attempts = []
+    chunks = []
+    chunk_stream = None
+    finished = False
+    error = None
+    try:
+        request = _build_request(prompt, system, profile)
+        estimate = estimate_tokens(prompt)
+
+        def open_stream(timeout: float) -> _AsyncStreamAttempt:
+            attempts.append(_AsyncStreamAttempt(request, estimate, start, node, timeout))
+            return attempts[-1]
+
+        chunk_stream = astream_with_retry(open_stream, node=node, on_discard=_AsyncStreamAttempt.discard)
+        async for chunk in chunk_stream:
+            chunks.append(chunk)
+            yield chunk
+        finished = True
+    except GeneratorExit:
+        finished = True
+        raise
+    except Exception as e:
+        error = e
+        _record_error(node, start, e)
+        raise
+    finally:
+        invalid = None
+        failure = None
+        try:
+            if chunk_stream is not None:
+                await chunk_stream.aclose()
+            text = "".join(chunks)
+            logger.info(f"RESPONSE: {text}")
+            winner = _stream_winner(attempts)
+            if finished and winner is not None:
+                await winner.aclose()
+                _record_call(node, start, winner.final_usage, winner.usage.ttft)
+                invalid = _validation_error(text, validate)
+            if finished and use_cache and text and invalid is None:
+                # SQLite写入在线程池中执行，不阻塞事件循环上的其他会话
+                await asyncio.to_thread(_store_cache, key, prompt, text)
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            if use_cache:
+                if finished and invalid is None and failure is None:
+                    ainflight.finish(key, future, result=text)
+                elif finished and failure is None:
+                    _repair_handoff.park(key, _finish_threadsafe(asyncio.get_running_loop(), key, future))
+                else:
+                    ainflight.finish(key, future, error=failure or invalid or error or RuntimeError("In-flight LLM call was interrupted"))
+
+# 修复请求只包含无效的响应和解析错误，不重新发送原始提示词，也不需要完整的思考预算
+REPAIR_PROMPT = """Your previous response could not be used:
+{error}
+
+Previous response:
+{response}
+
+Fix the problem above and reply with the corrected YAML block only, in the same format as the previous response."""
+
+def _repair_request(node: Optional[str], response: str, error: Exception, profile: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    llm_metrics.record_event(node, "repairs")
+    logger.warning(f"Repairing invalid response from {node or 'unknown'}: {error}")
+    return REPAIR_PROMPT.format(error=error, response=response), get_repair_profile(node, profile)
+
+def _finish_repair(
+    prompt: str,
+    repaired: str,
+    system: Optional[str],
+    node: Optional[str],
+    validate: Optional[Callable[[str], Any]],
+    use_cache: bool,
+    profile: Dict[str, Any]
+) -> str:
+    error = _validation_error(repaired, validate)
+    if error is not None:
+        llm_metrics.record_event(node, "repair_failures")
+        raise error
+    if use_cache:
+        # 修复后的响应写入原始请求的缓存键（与原始请求相同的档案），重新运行时直接得到有效的响应
+        _store_cache(_cache_key(prompt, system, profile), prompt, repaired)
+    return repaired
+
+def repair_llm(
+    prompt: str,
+    response: str,
+    error: Exception,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None,
+    use_cache: bool = True,
+    profile: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    把解析错误发回LLM，修复未通过校验的响应，而不是重新生成完整响应。
+
+    修复请求使用节点的修复档案（默认不启用思考）。修复后的响应仍未通过校验时抛出新的校验错误。
+
+    Args:
+        prompt: 原始提示词
+        response: 未通过校验的响应
+        error: 校验错误
+        system: 原始调用的system前缀（修复请求复用它，命中提供方提示词缓存）
+        node: 原始调用的节点名称
+        validate: 响应校验函数
+        use_cache: 是否把修复后的响应写入原提示词的缓存键
+        profile: 原始调用覆盖节点档案时传入同一个档案，修复请求使用其模型，缓存键与原始调用一致
+
+    Returns:
+        通过校验的响应文本
+    """
+    profile = profile or get_profile(node)
+    # 接手未通过校验的流式调用：修复后唤醒等待同一请求的调用方
+    handoff = _repair_handoff.claim(_cache_key(prompt, system, profile)) if use_cache else None
+    try:
+        repair_prompt, repair_profile = _repair_request(node, response, error, profile)
+        repaired = call_llm(repair_prompt, use_cache=False, system=system, node=node, profile=repair_profile)
+        repaired = _finish_repair(prompt, repaired, system, node, validate, use_cache, profile)
+    except BaseException:
+        if handoff is not None:
+            handoff(_NO_RESULT)
+        raise
+    if handoff is not None:
+        handoff(repaired)
+    return repaired
+
+async def arepair_llm(
+    prompt: str,
+    response: str,
+    error: Exception,
+    system: Optional[str] = None,
+    node: Optional[str] = None,
+    validate: Optional[Callable[[str], Any]] = None,
+    use_cache: bool = True,
+    profile: Optional[Dict[str, Any]] = None
+) -> str:
+    """repair_llm的异步版本。"""
+    profile = profile or get_profile(node)
+    handoff = _repair_handoff.claim(_cache_key(prompt, system, profile)) if use_cache else None
+    try:
+        repair_prompt, repair_profile = _repair_request(node, response, error, profile)
+        repaired = await acall_llm(repair_prompt, use_cache=False, system=system, node=node, profile=repair_profile)
+        repaired = await asyncio.to_thread(_finish_repair, prompt, repaired, system, node, validate, use_cache, profile)
+    except BaseException:
+        if handoff is not None:
+            handoff(_NO_RESULT)
+        raise
+    if handoff is not None:
+        handoff(repaired)
+    return repaired
 
 def clear_cache() -> None:
-    """如果缓存文件存在则清除它。"""
-    if os.path.exists(cache_file):
-        os.remove(cache_file)
-        logger.info("Cache cleared")
+    """清除内存缓存和磁盘缓存中的所有条目。"""
+    memory_cache.clear()
+    get_cache().clear()
+    logger.info("Cache cleared")
 
 if __name__ == "__main__":
     test_prompt = "Hello, how are you?"
-    
+
     # 第一次调用 - 应该调用API
     print("Making first call...")
     response1 = call_llm(test_prompt, use_cache=False)
     print(f"Response: {response1}")
-    
+
     # 第二次调用 - 应该命中缓存
     print("\nMaking second call with same prompt...")
     response2 = call_llm(test_prompt, use_cache=True)
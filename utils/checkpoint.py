@@ -0,0 +1,286 @@
+import os
+import copy
+import asyncio
+import gzip
+import json
+import time
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+from pocketflow import AsyncFlow, AsyncNode, BaseNode, Flow
+
+logger = logging.getLogger('coding_agent')
+
+CHECKPOINT_VERSION = 1
+
+def _strip_private(value: Any) -> Any:
+    """去掉以"_"开头的键（渲染缓存、摘要等可以重新计算的派生字段）。"""
+    if isinstance(value, dict):
+        return {k: _strip_private(v) for k, v in value.items() if not (isinstance(k, str) and k.startswith("_"))}
+    if isinstance(value, list):
+        return [_strip_private(v) for v in value]
+    return value
+
+class Checkpointer:
+    """
+    把共享存储和流程中下一个要运行的节点保存为gzip压缩的JSON检查点。
+
+    写入临时文件后原子重命名，进程在写入过程中被杀死时旧的检查点仍然完整。
+    position是从外层流程到内层子流程的节点名称路径，如["EditAgent", "ApplyChangesNode"]；
+    None表示流程已经完成。
+    """
+
+    def __init__(self, path: str, compresslevel: int = 6):
+        self.path = path
+        self.compresslevel = compresslevel
+        self.saves = 0
+
+    def save(self, shared: Dict[str, Any], position: Optional[List[str]]) -> None:
+        payload = {
+            "version": CHECKPOINT_VERSION,
+            "saved_at": time.time(),
+            "position": position,
+            "shared": _strip_private(shared)
+        }
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".checkpoint-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=self.compresslevel, mtime=0) as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.saves += 1
+        logger.debug(f"Checkpoint saved to {self.path} at {position}")
+
+    def load(self) -> Tuple[Dict[str, Any], Optional[List[str]]]:
+        """
+        读取检查点。
+
+        Returns:
+            (共享存储, 下一个要运行的节点路径)；路径为None表示流程已经完成
+
+        Raises:
+            FileNotFoundError: 检查点不存在
+            ValueError: 检查点版本不受支持
+        """
+        with gzip.open(self.path, "rb") as f:
+            payload = json.loads(f.read().decode("utf-8"))
+        if payload.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {payload.get('version')}")
+        return payload["shared"], payload["position"]
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+def _node_names(start: BaseNode) -> Tuple[Dict[int, str], Dict[str, BaseNode]]:
+    """
+    从起始节点遍历流程图，为每个节点命名：优先使用checkpoint_name属性，否则使用类名
+    （同名节点依次加上#2、#3后缀）。
+
+    后继节点按连接顺序遍历，因此同一个流程定义总是得到相同的名称。
+
+    Returns:
+        (节点id到名称, 名称到节点)
+    """
+    names: Dict[int, str] = {}
+    by_name: Dict[str, BaseNode] = {}
+    counts: Dict[str, int] = {}
+    pending = [start]
+    while pending:
+        node = pending.pop(0)
+        if id(node) in names:
+            continue
+        base = getattr(node, "checkpoint_name", None) or type(node).__name__
+        counts[base] = counts.get(base, 0) + 1
+        name = base if counts[base] == 1 else f"{base}#{counts[base]}"
+        names[id(node)] = name
+        by_name[name] = node
+        pending.extend(node.successors.values())
+    return names, by_name
+
+# 本次运行的检查点设置（检查点写入器和恢复位置）在shared中的键。以"_"开头，不保存到检查点；
+# 放在每个会话自己的shared中而不是流程对象上，同一个流程对象可以同时运行多个会话
+CHECKPOINT_KEY = "_checkpoint"
+
+def attach_checkpointer(shared: Dict[str, Any], checkpointer: Checkpointer, resume_from: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    为使用shared的这次运行启用检查点：之后每个节点的post完成后保存到checkpointer。
+
+    Args:
+        shared: 本次运行的共享存储
+        checkpointer: 检查点写入器
+        resume_from: 恢复时第一个要运行的节点路径，None表示从起始节点开始
+
+    Returns:
+        shared
+    """
+    shared[CHECKPOINT_KEY] = {"checkpointer": checkpointer, "resume_from": resume_from}
+    return shared
+
+def resume(checkpointer: Checkpointer) -> Tuple[Dict[str, Any], bool]:
+    """
+    从检查点恢复：用返回的共享存储运行流程时，从检查点记录的节点继续并继续保存检查点。
+
+    Returns:
+        (共享存储, 流程是否已经完成)
+    """
+    shared, position = checkpointer.load()
+    if position is not None:
+        logger.info(f"Resuming from checkpoint {checkpointer.path} at {'/'.join(position)}")
+    return attach_checkpointer(shared, checkpointer, position), position is None
+
+def _checkpointer(shared: Dict[str, Any]) -> Optional[Checkpointer]:
+    state = shared.get(CHECKPOINT_KEY)
+    return state["checkpointer"] if state else None
+
+def save_progress(shared: Dict[str, Any]) -> None:
+    """
+    在节点运行过程中保存检查点，位置仍为正在运行的节点；未启用检查点时什么也不做。
+
+    检查点默认只在节点的post完成后保存，中断的节点恢复时整体重新运行。副作用不能重复执行的
+    节点（如按行号修改文件）把已完成的部分记录在shared中并调用此函数，恢复时跳过这些部分。
+    """
+    state = shared.get(CHECKPOINT_KEY)
+    if state and state.get("position"):
+        state["checkpointer"].save(shared, state["position"])
+
+class _CheckpointMixin:
+    """CheckpointFlow和AsyncCheckpointFlow的共同部分：节点命名、恢复位置和保存检查点。"""
+
+    # 只在作为子流程运行的副本上设置（见_prepare），流程对象本身不保存任何运行状态
+    resume_from: Optional[List[str]] = None
+    prefix: List[str] = []
+
+    def __init__(self, start: Optional[BaseNode] = None, name: Optional[str] = None):
+        super().__init__(start=start)
+        # 作为子流程时在检查点路径中使用的名称
+        self.checkpoint_name = name
+        self._names = None
+
+    def _named_nodes(self) -> Tuple[Dict[int, str], Dict[str, BaseNode]]:
+        # 流程在连接完所有节点后才运行，第一次运行时命名即可
+        if self._names is None:
+            self._names = _node_names(self.start_node)
+        return self._names
+
+    def _resume_position(self, shared: Dict[str, Any]) -> Optional[List[str]]:
+        """返回本次运行的恢复位置（只使用一次）：子流程的副本由外层流程设置，最外层流程取自shared。"""
+        if self.prefix:
+            return self.resume_from
+        state = shared.get(CHECKPOINT_KEY)
+        return state.pop("resume_from", None) if state else None
+
+    def _first_node(self, position: Optional[List[str]]) -> BaseNode:
+        """返回第一个要运行的节点：恢复时为检查点记录的节点，否则为起始节点。"""
+        if not position:
+            return self.start_node
+        _, by_name = self._named_nodes()
+        if position[0] not in by_name:
+            raise ValueError(f"Checkpoint node {position[0]} does not exist in this flow")
+        return by_name[position[0]]
+
+    def _prepare(self, shared: Dict[str, Any], node: BaseNode, position: Optional[List[str]]) -> BaseNode:
+        """
+        复制要运行的节点（与Flow相同，每步运行一个副本），并记录正在运行的节点位置（供save_progress使用）。
+
+        子流程的副本在本流程的位置之下保存检查点；检查点位于子流程内部时，子流程从剩余路径继续。
+        """
+        state = shared.get(CHECKPOINT_KEY)
+        if state is not None:
+            names, _ = self._named_nodes()
+            state["position"] = self.prefix + [names[id(node)]]
+        curr = copy.copy(node)
+        if isinstance(curr, _CheckpointMixin):
+            names, _ = self._named_nodes()
+            curr.prefix = self.prefix + [names[id(node)]]
+            curr.resume_from = position[1:] if position and len(position) > 1 else None
+        elif position and len(position) > 1:
+            raise ValueError(f"Checkpoint node {position[0]} is not a checkpointing subflow")
+        return curr
+
+    def _after_run(self, shared: Dict[str, Any], next_node: Optional[BaseNode]) -> None:
+        checkpointer = _checkpointer(shared)
+        if checkpointer is None:
+            return
+        if next_node is not None:
+            names, _ = self._named_nodes()
+            checkpointer.save(shared, self.prefix + [names[id(next_node)]])
+        elif not self.prefix:
+            # 最外层流程结束：记录为已完成
+            checkpointer.save(shared, None)
+        # 子流程结束时由外层流程在运行完子流程后保存
+
+class CheckpointFlow(_CheckpointMixin, Flow):
+    """
+    每个节点的post完成后保存检查点的Flow；shared中未设置检查点（attach_checkpointer或resume）时行为与Flow相同。
+
+    子流程也使用CheckpointFlow时，检查点记录子流程内部的位置，恢复时不会重新运行子流程中已完成的节点。
+    """
+
+    def _orch(self, shared: Dict[str, Any], params: Optional[Dict[str, Any]] = None) -> Any:
+        position = self._resume_position(shared)
+        node, p, last_action = self._first_node(position), (params or {**self.params}), None
+        while node:
+            curr = self._prepare(shared, node, position)
+            position = None
+            curr.set_params(p)
+            last_action = curr._run(shared)
+            node = self.get_next_node(curr, last_action)
+            self._after_run(shared, node)
+        return last_action
+
+class AsyncCheckpointFlow(_CheckpointMixin, AsyncFlow):
+    """CheckpointFlow的异步版本。"""
+
+    async def _orch_async(self, shared: Dict[str, Any], params: Optional[Dict[str, Any]] = None) -> Any:
+        position = self._resume_position(shared)
+        node, p, last_action = self._first_node(position), (params or {**self.params}), None
+        while node:
+            curr = self._prepare(shared, node, position)
+            position = None
+            curr.set_params(p)
+            last_action = await curr._run_async(shared) if isinstance(curr, AsyncNode) else curr._run(shared)
+            node = self.get_next_node(curr, last_action)
+            # 压缩和写文件在线程池中执行，不阻塞事件循环
+            if _checkpointer(shared) is not None:
+                await asyncio.to_thread(self._after_run, shared, node)
+        return last_action
+
+if __name__ == "__main__":
+    from pocketflow import Node
+
+    class Step(Node):
+        def __init__(self, label: str, crash: bool = False):
+            super().__init__()
+            self.label = label
+            self.crash = crash
+
+        def post(self, shared, prep_res, exec_res):
+            if self.crash and not shared.get("_recovered"):
+                raise KeyboardInterrupt(f"killed during {self.label}")
+            shared["steps"].append(self.label)
+            shared["_scratch"] = "derived data, not saved"
+
+    inner = Step("inner-1")
+    inner >> Step("inner-2", crash=True) >> Step("inner-3")
+    first = Step("outer-1")
+    first >> CheckpointFlow(start=inner, name="Sub") >> Step("outer-2")
+    flow = CheckpointFlow(start=first)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpointer = Checkpointer(os.path.join(tmp, "checkpoint.json.gz"))
+        try:
+            flow.run(attach_checkpointer({"steps": []}, checkpointer))
+        except KeyboardInterrupt as e:
+            print(f"Run interrupted: {e}")
+
+        saved, position = checkpointer.load()
+        print(f"Checkpoint: steps={saved['steps']}, position={position}, keys={sorted(saved)}")
+        shared, completed = resume(checkpointer)
+        shared["_recovered"] = True
+        flow.run(shared)
+        print(f"Resumed run: steps={shared['steps']}, completed={checkpointer.load()[1] is None}")
@@ -0,0 +1,51 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+def content_digest(text: str) -> str:
+    """返回文本内容的SHA-256十六进制摘要。"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ContentStore:
+    """
+    按内容寻址的字符串驻留表。
+
+    相同内容的字符串只保留一个对象：同一个文件被多次读取时，
+    历史中的各个条目共享同一份内容，而不是各自持有一个副本。
+    只保留最近使用的max_entries份内容的索引；被淘汰的内容仍由引用它的条目持有。
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def intern(self, text: str) -> str:
+        """返回与text内容相同的规范字符串对象。"""
+        digest = content_digest(text)
+        with self._lock:
+            existing = self._entries.get(digest)
+            if existing is not None:
+                self._entries.move_to_end(digest)
+                return existing
+            self._entries[digest] = text
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return text
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+_store = ContentStore(max_entries=int(os.getenv("CONTENT_STORE_ENTRIES", "512")))
+
+def intern_content(text: str) -> str:
+    """在进程共享的驻留表中驻留文本内容。"""
+    return _store.intern(text)
+
+if __name__ == "__main__":
+    first = "".join(f"{i}: line {i}\n" for i in range(1, 1001))
+    second = "".join(f"{i}: line {i}\n" for i in range(1, 1001))
+    print(f"Same object before interning: {first is second}")
+    print(f"Same object after interning: {intern_content(first) is intern_content(second)}")
+    print(f"Digest: {content_digest(first)[:16]}..., store size: {len(_store)}")
@@ -1,5 +1,6 @@
 import os
 from typing import Tuple
+from utils.file_cache import file_cache
 
 def delete_file(target_file: str) -> Tuple[str, bool]:
     """
@@ -16,6 +17,7 @@ def delete_file(target_file: str) -> Tuple[str, bool]:
             return f"File {target_file} does not exist", False
         
         os.remove(target_file)
+        file_cache.invalidate(target_file)
         return f"Successfully deleted {target_file}", True
             
     except Exception as e:
@@ -0,0 +1,231 @@
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('coding_agent')
+
+class FileCache:
+    """
+    文件文本内容的进程级内存缓存，按(mtime_ns, size, inode)校验。
+
+    每次读取都先stat文件：修改时间、大小或inode变化时视为失效并重新读取，
+    因此被编辑或被替换（如重命名覆盖）的文件不会返回旧内容。
+    通过write_text写入时直接更新缓存（写穿），随后的读取不需要再访问磁盘。
+    总字节数超过max_bytes时淘汰最久未使用的文件。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # 路径 -> (版本, 文本, 派生结果)；派生结果（如带行号的内容）与文本一起失效
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int, int], str, Dict[str, str]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.abspath(path)
+
+    @staticmethod
+    def _version(st: os.stat_result) -> Tuple[int, int, int]:
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def _entry_bytes(entry) -> int:
+        return len(entry[1]) + sum(len(value) for value in entry[2].values())
+
+    def _valid_entry(self, key: str):
+        """返回仍然有效的缓存条目并更新LRU顺序；调用方持有锁。"""
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == self._version(st):
+            self._entries.move_to_end(key)
+            return entry
+        return None
+
+    def get(self, path: str) -> Optional[str]:
+        """返回仍然有效的缓存内容；未缓存或文件已变化时返回None。"""
+        key = self._key(path)
+        with self._lock:
+            entry = self._valid_entry(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _store(self, key: str, entry) -> None:
+        """存入条目并按容量淘汰；调用方持有锁。"""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._entry_bytes(old)
+        size = self._entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._entry_bytes(evicted)
+
+    def put(self, path: str, text: str, stat: os.stat_result) -> None:
+        with self._lock:
+            self._store(self._key(path), (self._version(stat), text, {}))
+
+    def read_text(self, path: str) -> str:
+        """
+        返回文件的文本内容（UTF-8，通用换行符），优先使用缓存。
+
+        读取失败时抛出与open()/read()相同的异常。
+        """
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+        key = self._key(path)
+        with open(key, 'r', encoding='utf-8') as f:
+            st = os.fstat(f.fileno())
+            text = f.read()
+        self.put(key, text, st)
+        return text
+
+    def read_lines(self, path: str) -> List[str]:
+        """与open(path).readlines()相同的行列表，优先使用缓存。"""
+        return io.StringIO(self.read_text(path)).readlines()
+
+    def write_text(self, path: str, text: str) -> None:
+        """写入文件（UTF-8）并更新缓存，之后的读取直接命中。"""
+        key = self._key(path)
+        with open(key, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            st = os.fstat(f.fileno())
+        # 缓存读取时会看到的内容：文本模式读取把\r\n和\r转换为\n
+        self.put(key, text.replace('\r\n', '\n').replace('\r', '\n'), st)
+
+    def derived(self, path: str, name: str, build: Callable[[str], str]) -> str:
+        """
+        返回由文件内容派生的结果（如带行号的内容），与内容一起缓存和失效。
+
+        Args:
+            path: 文件路径
+            name: 派生结果的名称
+            build: 从文件内容计算派生结果的函数
+        """
+        text = self.read_text(path)
+        key = self._key(path)
+        with self._lock:
+            entry = self._valid_entry(key)
+            if entry is not None and entry[1] is text and name in entry[2]:
+                return entry[2][name]
+        value = build(text)
+        with self._lock:
+            entry = self._valid_entry(key)
+            # 只在期间文件未变化时保存
+            if entry is not None and entry[1] is text:
+                self._store(key, (entry[0], entry[1], {**entry[2], name: value}))
+        return value
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            old = self._entries.pop(self._key(path), None)
+            if old is not None:
+                self._bytes -= self._entry_bytes(old)
+
+    def __contains__(self, path: str) -> bool:
+        with self._lock:
+            return self._key(path) in self._entries
+
+class Prefetcher:
+    """
+    在后台线程中预读文件到FileCache。
+
+    在LLM思考下一步操作时调用prefetch()，下一步很可能读取的文件就已经在内存中了。
+    只预读不超过max_file_bytes的文件，已缓存的文件会被跳过；预读失败被静默忽略。
+    """
+
+    def __init__(self, cache: FileCache, max_workers: int = 2, max_file_bytes: int = 256 * 1024):
+        self.cache = cache
+        self.max_file_bytes = max_file_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file-prefetch")
+
+    def _load(self, path: str) -> None:
+        try:
+            if os.path.getsize(path) <= self.max_file_bytes:
+                self.cache.read_text(path)
+        except (OSError, UnicodeDecodeError):
+            pass
+
+    def prefetch(self, paths: Iterable[str]) -> List[str]:
+        """提交后台预读，返回实际提交的路径。"""
+        submitted = []
+        for path in paths:
+            if path in self.cache:
+                continue
+            self._executor.submit(self._load, path)
+            submitted.append(path)
+        if submitted:
+            logger.debug(f"Prefetching {len(submitted)} files: {submitted}")
+        return submitted
+
+def grep_prefetch_candidates(matches: List[dict], limit: int = 5) -> List[str]:
+    """grep结果中命中次数最多的文件，次数相同时保持首次出现的顺序。"""
+    counts = {}
+    for match in matches:
+        path = match.get("file")
+        if path:
+            counts[path] = counts.get(path, 0) + 1
+    return sorted(counts, key=lambda path: -counts[path])[:limit]
+
+def dir_prefetch_candidates(directory: str, limit: int = 5, max_file_bytes: int = 32 * 1024) -> List[str]:
+    """目录中直接包含的小文件（跳过隐藏文件），按文件名排序。"""
+    try:
+        with os.scandir(directory) as it:
+            files = [
+                entry.path for entry in it
+                if not entry.name.startswith('.') and entry.is_file() and entry.stat().st_size <= max_file_bytes
+            ]
+    except OSError:
+        return []
+    return sorted(files)[:limit]
+
+# 进程共享的文件缓存和预读器
+file_cache = FileCache(max_bytes=int(os.getenv("FILE_CACHE_BYTES", str(64 * 1024 * 1024))))
+prefetcher = Prefetcher(file_cache, max_workers=int(os.getenv("FILE_PREFETCH_WORKERS", "2")))
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(5):
+            with open(os.path.join(tmp, f"module_{i}.py"), 'w') as f:
+                f.write(f"def handler_{i}():\n    return {i}\n" * 200)
+
+        cache = FileCache()
+        candidates = dir_prefetch_candidates(tmp)
+        Prefetcher(cache).prefetch(candidates)
+        time.sleep(0.1)
+        print(f"Prefetched: {sum(path in cache for path in candidates)}/{len(candidates)} files")
+
+        path = candidates[0]
+        cache.read_text(path)
+        print(f"Cache hits after reading a prefetched file: {cache.hits}")
+
+        # 修改文件后缓存自动失效
+        with open(path, 'a') as f:
+            f.write("# edited\n")
+        sees_edit = cache.read_text(path).endswith("# edited\n")
+        print(f"Sees edit: {sees_edit}, misses: {cache.misses}")
+
+        # 通过缓存写入：随后的读取直接命中，不访问磁盘
+        cache.write_text(path, "def rewritten():\n    pass\n")
+        hits = cache.hits
+        print(f"Reads written content: {cache.read_text(path).startswith('def rewritten')}, hit: {cache.hits == hits + 1}")
@@ -0,0 +1,258 @@
+import os
+import re
+import json
+from typing import BinaryIO, List, Tuple
+
+# 判断文件是否为二进制时读取的字节数
+SNIFF_BYTES = 8192
+# 头部和尾部视图各自最多读取的字节数和显示的行数
+VIEW_BYTES = 4096
+VIEW_LINES = 20
+# 视图和大纲中每行最多显示的字符数（压缩过的文件可能只有一行）
+MAX_LINE_CHARS = 200
+# 构建大纲时最多扫描的字节数和最多列出的条目数
+OUTLINE_SCAN_BYTES = int(os.getenv("OUTLINE_SCAN_BYTES", str(4 * 1024 * 1024)))
+OUTLINE_MAX_ENTRIES = 50
+
+# 行首的顶层定义：Python、JS/TS、Go、Rust、Java等常见语言的def/class/function等
+_DEFINITION = re.compile(
+    rb"^[ \t]*(?:export[ \t]+(?:default[ \t]+)?)?(?:(?:public|private|protected|static|abstract|pub|async)[ \t]+)*"
+    rb"(?:def|class|function\*?|interface|struct|enum|trait|impl|fn|func|module|type)[ \t]+[\w$.]"
+)
+_JSON_SPACE = re.compile(r"[ \t\n\r]*")
+
+def sniff_binary(path: str) -> bool:
+    """
+    读取文件开头的SNIFF_BYTES字节判断是否为二进制文件：包含NUL字节或不是合法的UTF-8。
+
+    开头被截断的多字节字符不算解码失败。
+    """
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    if b"\0" in head:
+        return True
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # 只有末尾不完整的字符（被SNIFF_BYTES截断）才可以接受
+        return not (e.reason == 'unexpected end of data' and len(head) == SNIFF_BYTES)
+    return False
+
+def _clip(line: bytes) -> str:
+    text = line.rstrip(b"\r\n").decode('utf-8', errors='replace')
+    if len(text) > MAX_LINE_CHARS:
+        return text[:MAX_LINE_CHARS] + " ... [line truncated]"
+    return text
+
+def _count_lines(f: BinaryIO, size: int) -> int:
+    """按块统计行数（与readlines()一致：不以换行符结尾的最后一行也算一行）。"""
+    f.seek(0)
+    count, last = 0, b""
+    while True:
+        chunk = f.read(1024 * 1024)
+        if not chunk:
+            break
+        count += chunk.count(b"\n")
+        last = chunk[-1:]
+    return count + (1 if size and last != b"\n" else 0)
+
+def _head(f: BinaryIO, size: int) -> Tuple[List[bytes], int]:
+    """返回文件开头的行和这些行结束的字节偏移；最后一个不完整的行被丢弃（除非只有这一行）。"""
+    f.seek(0)
+    data = f.read(VIEW_BYTES)
+    lines = data.splitlines(keepends=True)
+    if len(data) < size and len(lines) > 1 and not lines[-1].endswith(b"\n"):
+        lines.pop()
+    lines = lines[:VIEW_LINES]
+    return lines, sum(len(line) for line in lines)
+
+def _tail(f: BinaryIO, size: int, head_end: int) -> List[bytes]:
+    """返回文件末尾的行（不与头部重叠）；第一个不完整的行被丢弃（除非只有这一行）。"""
+    start = max(head_end, size - VIEW_BYTES)
+    f.seek(start)
+    data = f.read(size - start)
+    lines = data.splitlines(keepends=True)
+    if start > head_end and len(lines) > 1:
+        f.seek(start - 1)
+        if f.read(1) != b"\n":
+            lines.pop(0)
+    return lines[-VIEW_LINES:]
+
+def code_outline(f: BinaryIO) -> Tuple[List[str], bool]:
+    """
+    逐行扫描文件开头，列出行首的类、函数等定义（带行号）。
+
+    每次最多读取一行的前4096字节，超长的行不会整行读入内存。
+
+    Returns:
+        (大纲条目, 是否因达到扫描或条目上限而截断)
+    """
+    f.seek(0)
+    entries: List[str] = []
+    line_number, at_line_start, scanned = 1, True, 0
+    while scanned < OUTLINE_SCAN_BYTES:
+        chunk = f.readline(4096)
+        if not chunk:
+            return entries, False
+        scanned += len(chunk)
+        if at_line_start and _DEFINITION.match(chunk):
+            entries.append(f"{line_number}: {_clip(chunk)}")
+            if len(entries) >= OUTLINE_MAX_ENTRIES:
+                return entries, True
+        at_line_start = chunk.endswith(b"\n")
+        if at_line_start:
+            line_number += 1
+    return entries, bool(f.read(1))
+
+def _json_preview(value) -> str:
+    if isinstance(value, dict):
+        return f"{{{len(value)} keys}}"
+    if isinstance(value, list):
+        return f"[{len(value)} items]"
+    return _clip(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+def json_outline(f: BinaryIO) -> Tuple[List[str], bool]:
+    """
+    列出JSON文件的顶层键（带行号和值的概要：对象的键数、数组的元素数或简短的值）；
+    顶层为数组时给出元素个数。
+
+    只读取文件开头的OUTLINE_SCAN_BYTES字节，每个顶层值由json模块（C实现）解析；
+    值超出读取范围时停止，只显示其类型。
+
+    Returns:
+        (大纲条目, 是否因达到扫描或条目上限而截断)
+    """
+    f.seek(0)
+    data = f.read(OUTLINE_SCAN_BYTES)
+    truncated = bool(f.read(1))
+    text = data.decode('utf-8', errors='replace')
+    decoder = json.JSONDecoder()
+    entries: List[str] = []
+    line_number, counted = 1, 0
+
+    def skip(pos: int) -> int:
+        return _JSON_SPACE.match(text, pos).end()
+
+    pos = skip(0)
+    top = text[pos:pos + 1]
+    if top not in ("{", "["):
+        return entries, False
+    items, pos = 0, skip(pos + 1)
+    try:
+        while pos < len(text) and text[pos] not in "}]":
+            if top == "{":
+                key, pos = decoder.raw_decode(text, pos)
+                pos = skip(pos)
+                if text[pos:pos + 1] != ":":
+                    break
+                pos = skip(pos + 1)
+                line_number += text.count("\n", counted, pos)
+                counted = pos
+                label = f"{line_number}: {_clip(json.dumps(key, ensure_ascii=False).encode('utf-8'))}"
+                try:
+                    value, pos = decoder.raw_decode(text, pos)
+                except ValueError:
+                    # 值超出读取范围：只显示类型
+                    kind = {"{": "{...}", "[": "[...]"}.get(text[pos:pos + 1], "...")
+                    entries.append(f"{label}: {kind}")
+                    return entries, True
+                entries.append(f"{label}: {_json_preview(value)}")
+                if len(entries) >= OUTLINE_MAX_ENTRIES:
+                    return entries, True
+            else:
+                _, pos = decoder.raw_decode(text, pos)
+                items += 1
+            pos = skip(pos)
+            if text[pos:pos + 1] != ",":
+                break
+            pos = skip(pos + 1)
+    except ValueError:
+        # 超出读取范围或不是合法的JSON：保留已经得到的条目
+        truncated = True
+    if top == "[":
+        entries.append(f"top-level array with {items}{'+' if truncated else ''} items")
+    return entries, truncated
+
+def describe_file(path: str, binary: bool, limit: int) -> str:
+    """
+    不读取整个文件，返回大文件或二进制文件的有界视图：大小、行数、结构大纲以及头部和尾部的行。
+
+    Args:
+        path: 文件路径
+        binary: 是否为二进制文件（二进制文件只显示大小和开头字节的十六进制）
+        limit: 整个文件读取的大小上限，用于提示信息
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if binary:
+            preview = f.read(64).hex(' ')
+            return (
+                f"File {path} appears to be binary ({size:,} bytes); content not shown.\n"
+                f"First bytes (hex): {preview}\n"
+            )
+
+        total_lines = _count_lines(f, size)
+        parts = [
+            f"File {path} is too large to read entirely ({size:,} bytes, {total_lines:,} lines; limit {limit:,} bytes).",
+            "Showing an outline with the first and last lines. Read specific ranges with "
+            "start_line_one_indexed/end_line_one_indexed_inclusive, or use grep_search to locate content."
+        ]
+
+        f.seek(0)
+        first = f.read(64).lstrip()[:1]
+        if path.endswith(".json") or first in (b"{", b"["):
+            kind, (entries, truncated) = "top-level keys", json_outline(f)
+        else:
+            kind, (entries, truncated) = "definitions", code_outline(f)
+        if entries:
+            parts.append(f"\nOutline ({kind}):")
+            parts.extend(entries)
+            if truncated:
+                parts.append("... (outline truncated)")
+
+        head, head_end = _head(f, size)
+        parts.append("\nHead:")
+        parts.extend(f"{i}: {_clip(line)}" for i, line in enumerate(head, 1))
+
+        tail = _tail(f, size, head_end)
+        if tail:
+            parts.append("\nTail:")
+            parts.extend(f"{i}: {_clip(line)}" for i, line in enumerate(tail, total_lines - len(tail) + 1))
+    return "\n".join(parts) + "\n"
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 类似package-lock.json的大JSON文件
+        lock = os.path.join(tmp, "package-lock.json")
+        packages = {f"node_modules/pkg-{i}": {"version": f"1.0.{i}", "resolved": f"https://registry.example/pkg-{i}.tgz"} for i in range(50000)}
+        with open(lock, 'w') as f:
+            json.dump({"name": "project", "version": "1.0.0", "lockfileVersion": 3, "requires": True, "packages": packages}, f, indent=2)
+        # 只有一行的压缩脚本
+        bundle = os.path.join(tmp, "bundle.min.js")
+        with open(bundle, 'w') as f:
+            f.write("function a(){return 1};" * 200000)
+        # 大的源文件
+        source = os.path.join(tmp, "generated.py")
+        with open(source, 'w') as f:
+            for i in range(20000):
+                f.write(f"class Model{i}:\n    def run(self):\n        return {i}\n\n")
+        # 二进制文件
+        image = os.path.join(tmp, "image.png")
+        with open(image, 'wb') as f:
+            f.write(b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR" + os.urandom(4096))
+
+        for path in (lock, bundle, source, image):
+            tracemalloc.start()
+            start = time.perf_counter()
+            binary = sniff_binary(path)
+            view = describe_file(path, binary, 256 * 1024)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"=== {os.path.basename(path)}: {os.path.getsize(path):,} bytes -> {len(view):,} chars, "
+                  f"{elapsed * 1000:.0f} ms, peak {peak / 1024:.0f} KB")
+            print(view[:1200])
@@ -0,0 +1,404 @@
+import os
+import difflib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from utils.llm_metrics import estimate_tokens
+from utils.content_store import content_digest
+
+logger = logging.getLogger('coding_agent')
+
+# 历史摘要的token预算（0表示不限制）和始终保持原样的最近条目数
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "100000"))
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "5"))
+# 压缩后保留的grep匹配数
+COMPACT_GREP_MATCHES = 5
+
+def _render_head(action: Dict[str, Any]) -> List[str]:
+    """渲染条目的工具、原因、参数，以及字典结果的成功状态行。"""
+    parts = [
+        f"- Tool: {action['tool']}\n",
+        f"- Reason: {action['reason']}\n"
+    ]
+
+    # 添加参数
+    params = action.get("params", {})
+    if params:
+        parts.append("- Parameters:\n")
+        for k, v in params.items():
+            parts.append(f"  - {k}: {v}\n")
+
+    result = action.get("result")
+    if result and isinstance(result, dict):
+        parts.append(f"- Result: {'Success' if result.get('success', False) else 'Failed'}\n")
+    return parts
+
+def render_action(action: Dict[str, Any]) -> str:
+    """
+    渲染单个历史条目的正文（不含"Action N:"标题）。
+
+    结果填入后条目不再变化，渲染结果缓存在action["_rendered"]中，
+    之后每一轮都直接复用；尚无结果的条目每次重新渲染。
+    """
+    rendered = action.get("_rendered")
+    if rendered is not None:
+        return rendered
+
+    parts = _render_head(action)
+
+    # 添加详细结果信息
+    result = action.get("result")
+    if result:
+        if isinstance(result, dict):
+            success = result.get("success", False)
+
+            # 添加工具特定的详细信息
+            if action['tool'] == 'read_file' and success:
+                content = result.get("content", "")
+                if "_same_as" in action:
+                    # 与之前某次读取的内容完全相同，只引用该条目
+                    parts.append(f"- Content: [unchanged, identical to the content shown in Action {action['_same_as'] + 1}]\n")
+                elif action.get("_diff") is not None:
+                    # 同一文件编辑后再次读取，只显示相对上次读取的差异
+                    parts.append(f"- Content: [changed since Action {action['_diff_base'] + 1}, unified diff against it]\n")
+                    parts.append(f"{action['_diff']}\n")
+                else:
+                    # 显示完整内容而不截断
+                    parts.append(f"- Content: {content}\n")
+            elif action['tool'] == 'grep_search' and success:
+                matches = result.get("matches", [])
+                parts.append(f"- Matches: {len(matches)}\n")
+                # 显示所有匹配项而不限制为前3个
+                for j, match in enumerate(matches):
+                    parts.append(f"  {j+1}. {match.get('file')}:{match.get('line')}: {match.get('content')}\n")
+            elif action['tool'] == 'edit_file' and success:
+                operations = result.get("operations", 0)
+                parts.append(f"- Operations: {operations}\n")
+
+                # 如果可用则包含推理
+                reasoning = result.get("reasoning", "")
+                if reasoning:
+                    parts.append(f"- Reasoning: {reasoning}\n")
+            elif action['tool'] == 'list_dir' and success:
+                # 获取树形可视化字符串
+                tree_visualization = result.get("tree_visualization", "")
+                parts.append("- Directory structure:\n")
+
+                # 正确处理和格式化树形可视化
+                if tree_visualization and isinstance(tree_visualization, str):
+                    # 首先，确保我们正确处理任何特殊的行结束字符
+                    clean_tree = tree_visualization.replace('\r\n', '\n').strip()
+
+                    if clean_tree:
+                        # 为每行添加适当的缩进，只包含非空行
+                        parts.extend(f"  {line}\n" for line in clean_tree.split('\n') if line.strip())
+                    else:
+                        parts.append("  (No tree structure data)\n")
+                else:
+                    parts.append("  (Empty or inaccessible directory)\n")
+                    logger.debug(f"Tree visualization missing or invalid: {tree_visualization}")
+            if not success and result.get("error"):
+                parts.append(f"- Error: {result['error']}\n")
+        else:
+            parts.append(f"- Result: {result}\n")
+
+    rendered = "".join(parts)
+    if result is not None:
+        action["_rendered"] = rendered
+    return rendered
+
+def _strip_line_numbers(content: str) -> Optional[List[str]]:
+    """去掉read_file整文件输出中的"N: "行号前缀；内容不是从1开始连续编号时返回None。"""
+    lines = content.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    stripped = []
+    for i, line in enumerate(lines):
+        prefix = f"{i+1}: "
+        if not line.startswith(prefix):
+            return None
+        stripped.append(line[len(prefix):])
+    return stripped
+
+def _content_diff(old: str, new: str) -> Optional[str]:
+    """
+    返回两次整文件读取之间的统一差异。
+
+    差异基于去掉行号的原始行计算，插入或删除行不会让后续所有行都显示为变化；
+    hunk头中的行号与文件行号一致。无法计算或差异不比完整内容短时返回None。
+    """
+    old_lines, new_lines = _strip_line_numbers(old), _strip_line_numbers(new)
+    if old_lines is None or new_lines is None:
+        return None
+    diff = "\n".join(difflib.unified_diff(old_lines, new_lines, "before", "after", n=2, lineterm=""))
+    if not diff or len(diff) >= len(new):
+        return None
+    return diff
+
+def _shows_full_content(action: Dict[str, Any]) -> bool:
+    """条目是否显示完整内容（既不是对其他条目的引用，也不是差异）。"""
+    return "_same_as" not in action and action.get("_diff") is None
+
+def link_duplicate_reads(history: List[Dict[str, Any]]) -> None:
+    """
+    为重复的文件读取建立引用，每个条目只在结果填入后处理一次。
+
+    - 内容与更早某次读取完全相同：设置_same_as为该条目的下标
+    - 同一文件再次读取但内容已变化（如编辑之后）：设置_diff_base和_diff
+
+    引用和差异基准总是指向显示了完整内容的条目；相同的内容只以差异或引用的形式出现过、
+    且没有可作为差异基准的完整读取时，再次显示完整内容。
+    """
+    first_by_digest: Dict[str, int] = {}
+    last_by_path: Dict[str, int] = {}
+    for i, action in enumerate(history):
+        result = action.get("result")
+        if action["tool"] != "read_file" or not (isinstance(result, dict) and result.get("success")):
+            continue
+        params = action.get("params", {})
+        path = os.path.normpath(str(params.get("target_file", "")))
+        # 按行范围读取的内容只是文件的一部分，不与整文件读取比较差异
+        whole = params.get("start_line_one_indexed") is None or params.get("end_line_one_indexed_inclusive") is None
+        digest = action.get("_digest")
+        if digest is None:
+            content = result.get("content", "")
+            digest = action["_digest"] = content_digest(content)
+            if digest in first_by_digest:
+                action["_same_as"] = first_by_digest[digest]
+            elif whole and path in last_by_path:
+                base = last_by_path[path]
+                action["_diff_base"] = base
+                action["_diff"] = _content_diff(history[base]["result"].get("content", ""), content)
+        # 只记录显示了完整内容的条目，之后的引用和差异不会指向另一个差异
+        if _shows_full_content(action):
+            first_by_digest.setdefault(digest, i)
+            if whole:
+                last_by_path[path] = i
+
+def render_compact(action: Dict[str, Any]) -> str:
+    """
+    渲染条目的压缩正文：省略文件内容和目录树，只保留前几条grep匹配。
+
+    压缩结果同样缓存在action["_compact"]中。
+    """
+    compact = action.get("_compact")
+    if compact is not None:
+        return compact
+
+    result = action.get("result")
+    if not (isinstance(result, dict) and result.get("success")) or "_same_as" in action:
+        return render_action(action)
+
+    full = render_action(action)
+    head = "".join(_render_head(action))
+    tool = action["tool"]
+    if tool == "read_file":
+        content = result.get("content", "")
+        compact = (
+            f"{head}- Content: [elided {content.count(chr(10)) + 1} lines, "
+            f"~{estimate_tokens(content)} tokens; read the file again if needed]\n"
+        )
+    elif tool == "grep_search":
+        matches = result.get("matches", [])
+        if len(matches) <= COMPACT_GREP_MATCHES:
+            compact = full
+        else:
+            lines = [f"- Matches: {len(matches)}\n"]
+            for j, match in enumerate(matches[:COMPACT_GREP_MATCHES]):
+                lines.append(f"  {j+1}. {match.get('file')}:{match.get('line')}: {match.get('content')}\n")
+            files = sorted({str(match.get('file')) for match in matches[COMPACT_GREP_MATCHES:]})
+            lines.append(f"  ... {len(matches) - COMPACT_GREP_MATCHES} more matches elided in: {', '.join(files)}\n")
+            compact = head + "".join(lines)
+    elif tool == "list_dir":
+        entries = full.count("\n") - head.count("\n") - 1
+        compact = f"{head}- Directory structure: [elided {entries} lines; list the directory again if needed]\n"
+    else:
+        compact = full
+
+    action["_compact"] = compact
+    return compact
+
+def _protected_entries(history: List[Dict[str, Any]], keep_recent: int) -> set:
+    """
+    返回不压缩的条目下标：最近keep_recent个条目、每个被编辑过的文件最近一次读取，
+    以及被之后的条目引用（相同内容或差异基准）的读取。
+    """
+    protected = set(range(max(0, len(history) - keep_recent), len(history)))
+    for action in history:
+        if "_same_as" in action:
+            protected.add(action["_same_as"])
+        if action.get("_diff") is not None:
+            protected.add(action["_diff_base"])
+    edited = {
+        action.get("params", {}).get("target_file")
+        for action in history if action["tool"] == "edit_file"
+    }
+    latest_read = {}
+    for i, action in enumerate(history):
+        target = action.get("params", {}).get("target_file")
+        if action["tool"] == "read_file" and target in edited:
+            latest_read[target] = i
+    protected.update(latest_read.values())
+    return protected
+
+def compact_history_summary(history: List[Dict[str, Any]], token_budget: Optional[int] = None, keep_recent: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    格式化历史摘要，超出token预算时从最旧的条目开始压缩。
+
+    最近的条目和被编辑文件的最新内容始终保持原样；其余条目依次省略文件内容、
+    目录树和多余的grep匹配，直到摘要回到预算之内（或已无可压缩的条目）。
+
+    Args:
+        history: 操作历史
+        token_budget: 摘要的token预算，默认取HISTORY_TOKEN_BUDGET，0表示不限制
+        keep_recent: 不压缩的最近条目数，默认取HISTORY_KEEP_RECENT
+
+    Returns:
+        (摘要字符串, 报告)；报告包含各工具段落的token数、压缩的条目数和总token数
+    """
+    if not history:
+        return "No previous actions.", {"sections": {}, "compacted": 0, "total": 0, "budget": token_budget}
+
+    if token_budget is None:
+        token_budget = HISTORY_TOKEN_BUDGET
+    if keep_recent is None:
+        keep_recent = HISTORY_KEEP_RECENT
+
+    link_duplicate_reads(history)
+    fragments = [f"Action {i+1}:\n{render_action(action)}" for i, action in enumerate(history)]
+    tokens = [estimate_tokens(fragment) for fragment in fragments]
+    total = sum(tokens)
+
+    compacted = 0
+    if token_budget and total > token_budget:
+        protected = _protected_entries(history, keep_recent)
+        for i, action in enumerate(history):
+            if total <= token_budget:
+                break
+            if i in protected:
+                continue
+            fragment = f"Action {i+1}:\n{render_compact(action)}"
+            if len(fragment) < len(fragments[i]):
+                new_tokens = estimate_tokens(fragment)
+                total -= tokens[i] - new_tokens
+                fragments[i], tokens[i] = fragment, new_tokens
+                compacted += 1
+
+    sections: Dict[str, int] = {}
+    for action, count in zip(history, tokens):
+        sections[action["tool"]] = sections.get(action["tool"], 0) + count
+    report = {"sections": sections, "compacted": compacted, "total": total, "budget": token_budget}
+
+    # 操作之间用空行分隔
+    return "\n" + "\n".join(fragments), report
+
+def format_history_summary(history: List[Dict[str, Any]], token_budget: Optional[int] = None) -> str:
+    """
+    将操作历史格式化为提示词中的摘要。
+
+    每个条目的正文只渲染一次，之后按缓存的片段拼接，
+    每轮的开销与历史总长度成线性关系，而不是每个条目都重新拼接字符串。
+    超出token预算时按compact_history_summary的规则压缩旧条目。
+    """
+    summary, report = compact_history_summary(history, token_budget)
+    if report["compacted"]:
+        logger.info(
+            f"History compacted: {report['compacted']} entries elided, "
+            f"~{report['total']} tokens (budget {report['budget']}), by tool: {report['sections']}"
+        )
+    else:
+        logger.debug(f"History tokens: ~{report['total']}, by tool: {report['sections']}")
+    return summary
+
+if __name__ == "__main__":
+    import copy
+    import time
+
+    def legacy_format_history_summary(history: List[Dict[str, Any]]) -> str:
+        # 原实现的精简副本：逐条目拼接字符串，用于对比输出和耗时
+        history_str = "\n"
+        for i, action in enumerate(history):
+            history_str += f"Action {i+1}:\n"
+            history_str += f"- Tool: {action['tool']}\n"
+            history_str += f"- Reason: {action['reason']}\n"
+            params = action.get("params", {})
+            if params:
+                history_str += f"- Parameters:\n"
+                for k, v in params.items():
+                    history_str += f"  - {k}: {v}\n"
+            result = action.get("result")
+            if result:
+                success = result.get("success", False)
+                history_str += f"- Result: {'Success' if success else 'Failed'}\n"
+                if action['tool'] == 'read_file' and success:
+                    history_str += f"- Content: {result.get('content', '')}\n"
+                elif action['tool'] == 'grep_search' and success:
+                    matches = result.get("matches", [])
+                    history_str += f"- Matches: {len(matches)}\n"
+                    for j, match in enumerate(matches):
+                        history_str += f"  {j+1}. {match.get('file')}:{match.get('line')}: {match.get('content')}\n"
+                elif action['tool'] == 'list_dir' and success:
+                    history_str += "- Directory structure:\n"
+                    for line in result.get("tree_visualization", "").strip().split('\n'):
+                        if line.strip():
+                            history_str += f"  {line}\n"
+            history_str += "\n" if i < len(history) - 1 else ""
+        return history_str
+
+    def synthetic_history(steps: int) -> List[Dict[str, Any]]:
+        history = []
+        for step in range(steps):
+            kind = step % 3
+            if kind == 0:
+                content = "".join(f"{n}: line {n} of module_{step}.py\n" for n in range(1, 201))
+                history.append({"tool": "read_file", "reason": f"inspect module {step}",
+                                "params": {"target_file": f"src/module_{step}.py"},
+                                "result": {"success": True, "content": content}})
+            elif kind == 1:
+                matches = [{"file": f"src/module_{n}.py", "line": n, "content": f"def handler_{n}():"} for n in range(30)]
+                history.append({"tool": "grep_search", "reason": "find handlers",
+                                "params": {"query": "def handler_"},
+                                "result": {"success": True, "matches": matches}})
+            else:
+                tree = "\n".join(f"├── module_{n}.py" for n in range(40))
+                history.append({"tool": "list_dir", "reason": "explore",
+                                "params": {"relative_workspace_path": "src"},
+                                "result": {"success": True, "tree_visualization": tree}})
+        return history
+
+    # 模拟200步会话：每一轮都重新生成整个历史摘要
+    steps = 200
+    full_history = synthetic_history(steps)
+
+    start = time.perf_counter()
+    legacy_outputs = [legacy_format_history_summary(full_history[:n]) for n in range(1, steps + 1)]
+    legacy_time = time.perf_counter() - start
+
+    session = copy.deepcopy(full_history)
+    start = time.perf_counter()
+    outputs = [format_history_summary(session[:n], token_budget=0) for n in range(1, steps + 1)]
+    memo_time = time.perf_counter() - start
+
+    print(f"{steps}-step session, summary rendered every turn:")
+    print(f"  legacy concatenation: {legacy_time * 1000:.1f} ms")
+    print(f"  memoized fragments:   {memo_time * 1000:.1f} ms ({legacy_time / memo_time:.1f}x faster)")
+    print(f"  identical output: {outputs == legacy_outputs}")
+    print(f"  final summary size: {len(outputs[-1]) / 1024:.0f} KB")
+
+    # 同一会话在30000 token预算下的压缩结果
+    summary, report = compact_history_summary(session, token_budget=30000)
+    print(f"\nWith a 30000-token budget: {report['compacted']} entries compacted, ~{report['total']} tokens")
+    print(f"  tokens by tool: {report['sections']}")
+
+    # 重复读取：第二次读取未变化的文件只引用第一次，编辑后的读取显示差异
+    original = "".join(f"{n}: line {n}\n" for n in range(1, 301))
+    edited = original.replace("150: line 150\n", "150: line 150\n151: inserted line\n")
+    edited = "".join(f"{n}: {line.split(': ', 1)[1]}" for n, line in enumerate(edited.splitlines(keepends=True), 1))
+    reads = [
+        {"tool": "read_file", "reason": "read", "params": {"target_file": "a.py"}, "result": {"success": True, "content": original}},
+        {"tool": "read_file", "reason": "read again", "params": {"target_file": "./a.py"}, "result": {"success": True, "content": original}},
+        {"tool": "edit_file", "reason": "insert", "params": {"target_file": "a.py"}, "result": {"success": True, "operations": 1}},
+        {"tool": "read_file", "reason": "verify", "params": {"target_file": "a.py"}, "result": {"success": True, "content": edited}},
+    ]
+    deduped = format_history_summary(reads, token_budget=0)
+    print(f"\nRepeated reads: {len(legacy_format_history_summary(reads))} chars -> {len(deduped)} chars")
+    print(deduped[deduped.index("Action 2:"):])
@@ -1,5 +1,6 @@
 import os
 from typing import Tuple
+from utils.file_cache import file_cache
 
 def insert_file(target_file: str, content: str, line_number: int = None) -> Tuple[str, bool]:
     """
@@ -27,9 +28,8 @@ def insert_file(target_file: str, content: str, line_number: int = None) -> Tupl
             else:
                 operation = "created"
                 
-            # 创建包含新内容的文件
-            with open(target_file, 'w', encoding='utf-8') as f:
-                f.write(content)
+            # 创建包含新内容的文件，同时更新缓存
+            file_cache.write_text(target_file, content)
                 
             return f"Successfully {operation} {target_file}", True
         
@@ -40,9 +40,8 @@ def insert_file(target_file: str, content: str, line_number: int = None) -> Tupl
                 lines = [''] * max(0, line_number - 1)
                 operation = "created and inserted into"
             else:
-                # 读取现有内容
-                with open(target_file, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
+                # 通过共享文件缓存读取现有内容
+                lines = file_cache.read_lines(target_file)
                 operation = "inserted into"
                 
             # 确保line_number有效
@@ -66,9 +65,8 @@ def insert_file(target_file: str, content: str, line_number: int = None) -> Tupl
                 # 如果存在，在插入点分割行
                 lines.insert(position, content)
                 
-            # 写入更新后的内容
-            with open(target_file, 'w', encoding='utf-8') as f:
-                f.writelines(lines)
+            # 写入更新后的内容，同时更新缓存
+            file_cache.write_text(target_file, ''.join(lines))
                 
             return f"Successfully {operation} {target_file} at line {line_number}", True
             
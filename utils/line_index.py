@@ -0,0 +1,196 @@
+import os
+import mmap
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Optional, Tuple
+
+# 构建索引时每次扫描的字节数
+_CHUNK_BYTES = 16 * 1024 * 1024
+
+class LineIndex:
+    """
+    文件的稀疏行偏移索引。
+
+    offsets[k]是第k*stride行（从0开始）的起始字节偏移。读取某一行时从最近的
+    索引点向后查找不超过stride-1个换行符，因此范围读取的代价是O(范围+stride)，
+    而索引只占用每stride行8字节。行按b"\\n"划分，与readlines()的行号一致
+    （只使用\\r作为换行符的文件除外）。
+    """
+
+    def __init__(self, offsets: array, total_lines: int, size: int, stride: int):
+        self.offsets = offsets
+        self.total_lines = total_lines
+        self.size = size
+        self.stride = stride
+
+    @classmethod
+    def build(cls, mm, stride: int = 64) -> "LineIndex":
+        """扫描整个文件构建索引；按块split，换行符的查找在C中完成。"""
+        size = len(mm)
+        offsets = array('q', [0])
+        pos = 0
+        line = 0  # 从pos开始的行号
+        while pos < size:
+            end = mm.rfind(b"\n", pos, min(pos + _CHUNK_BYTES, size))
+            if end == -1:
+                # 块内没有换行符（超长的行）：向后找到这一行的结尾
+                end = mm.find(b"\n", pos + _CHUNK_BYTES)
+                if end == -1:
+                    break
+            # 块内各行之后下一行的起始偏移（相对于pos），依次对应第line+1、line+2...行
+            starts = list(accumulate(len(part) + 1 for part in mm[pos:end + 1].split(b"\n")[:-1]))
+            first = (-(line + 1)) % stride
+            offsets.extend(pos + start for start in starts[first::stride])
+            line += len(starts)
+            pos = end + 1
+        # 最后一行没有以换行符结尾时也算一行
+        total_lines = line + (1 if pos < size else 0)
+        if offsets[-1] >= size and len(offsets) > 1:
+            # 以换行符结尾的文件：最后一个索引点指向文件末尾，不是一行的开始
+            offsets.pop()
+        return cls(offsets, total_lines, size, stride)
+
+    def span(self, mm, start: int, end: int) -> Tuple[int, int]:
+        """
+        返回第start行到第end行（从0开始，不含end）的字节范围。
+
+        Args:
+            mm: 与索引对应的文件内容（mmap）
+            start: 起始行，必须小于total_lines
+            end: 结束行（不含），超出文件时截断
+        """
+        end = min(end, self.total_lines)
+        begin = self.offsets[start // self.stride]
+        for _ in range(start % self.stride):
+            begin = mm.find(b"\n", begin) + 1
+        stop = begin
+        for _ in range(end - start):
+            newline = mm.find(b"\n", stop)
+            if newline == -1:
+                return begin, self.size
+            stop = newline + 1
+        return begin, stop
+
+class LineIndexCache:
+    """
+    按(路径, size, mtime_ns, inode)缓存的行偏移索引。
+
+    文件变化后索引在下一次读取时重建；超过max_entries时淘汰最久未使用的索引。
+    """
+
+    def __init__(self, max_entries: int = 32, stride: int = 64):
+        self.max_entries = max_entries
+        self.stride = stride
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int, int], LineIndex]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def _index(self, key: str, mm, st: os.stat_result) -> LineIndex:
+        version = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        index = LineIndex.build(mm, self.stride)
+        with self._lock:
+            self.builds += 1
+            self._entries[key] = (version, index)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def read_lines(self, path: str, start: int, end: int) -> Tuple[Optional[str], int]:
+        """
+        读取第start行到第end行（从0开始，不含end），不把整个文件读入内存。
+
+        Returns:
+            (文本内容, 文件总行数)；start超出文件时内容为None。
+            文本按UTF-8解码，\\r\\n转换为\\n，与文本模式读取的结果一致。
+        """
+        key = os.path.abspath(path)
+        with open(key, 'rb') as f:
+            # 在已打开的文件上取版本，索引和读取的内容一定对应同一个文件
+            st = os.fstat(f.fileno())
+            if st.st_size == 0:
+                return (None, 0)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                index = self._index(key, mm, st)
+                if start >= index.total_lines:
+                    return None, index.total_lines
+                begin, stop = index.span(mm, start, end)
+                data = mm[begin:stop]
+        return data.decode('utf-8').replace('\r\n', '\n'), index.total_lines
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            self._entries.pop(os.path.abspath(path), None)
+
+# 进程共享的行索引缓存
+line_index_cache = LineIndexCache(max_entries=int(os.getenv("LINE_INDEX_ENTRIES", "32")))
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import tempfile
+
+    # 正确性：与readlines()的结果比较，包括不以换行符结尾的文件和超长的行
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LineIndexCache(stride=4)
+        cases = {
+            "plain": "".join(f"line {i}\n" for i in range(100)),
+            "no_trailing_newline": "".join(f"line {i}\n" for i in range(10)) + "last",
+            "crlf": "".join(f"line {i}\r\n" for i in range(10)),
+            "long_line": "short\n" + "x" * 100 + "\nend\n"
+        }
+        for name, text in cases.items():
+            path = os.path.join(tmp, name)
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+            with open(path, 'r', encoding='utf-8') as f:
+                expected = f.readlines()
+            ok = all(
+                cache.read_lines(path, start, start + length)[0] == "".join(expected[start:start + length])
+                for start in range(len(expected)) for length in (1, 3, 7)
+            )
+            print(f"{name}: {len(expected)} lines, matches readlines: {ok}")
+
+    if "--bench" not in sys.argv:
+        print("\nRun with --bench [MB] to benchmark range reads on a large file")
+        sys.exit(0)
+
+    # 基准：在数百MB的文件上读取第2000-2100行和文件末尾附近的100行
+    size_mb = int(sys.argv[sys.argv.index("--bench") + 1]) if len(sys.argv) > sys.argv.index("--bench") + 1 else 300
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "large.txt")
+        line = "    result = compute_value(alpha, beta, gamma)  # generated line padding text\n"
+        block = line * 100000
+        with open(path, 'w') as f:
+            for _ in range(max(1, size_mb * 1024 * 1024 // len(block))):
+                f.write(block)
+        total = os.path.getsize(path)
+        print(f"\nFile: {total / 1024 / 1024:.0f} MB")
+
+        def timed(fn):
+            start = time.perf_counter()
+            result = fn()
+            return result, time.perf_counter() - start
+
+        def readlines_slice(start, end):
+            with open(path, 'r', encoding='utf-8') as f:
+                return "".join(f.readlines()[start:end])
+
+        cache = LineIndexCache()
+        legacy, legacy_time = timed(lambda: readlines_slice(1999, 2100))
+        (indexed, lines), build_time = timed(lambda: cache.read_lines(path, 1999, 2100))
+        _, warm_time = timed(lambda: cache.read_lines(path, 1999, 2100))
+        (tail, _), tail_time = timed(lambda: cache.read_lines(path, lines - 100, lines))
+        print(f"Lines: {lines}, index entries: {len(cache._entries[os.path.abspath(path)][1].offsets)}")
+        print(f"readlines() + slice, lines 2000-2100: {legacy_time * 1000:.0f} ms")
+        print(f"Indexed, first read (builds index):   {build_time * 1000:.0f} ms")
+        print(f"Indexed, lines 2000-2100:             {warm_time * 1000:.3f} ms")
+        print(f"Indexed, last 100 lines:              {tail_time * 1000:.3f} ms")
+        print(f"Same content: {legacy == indexed}, tail ok: {tail == line * 100}")
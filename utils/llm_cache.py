@@ -0,0 +1,321 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger("llm_logger")
+
+def prompt_key(prompt: str) -> str:
+    """返回提示词的SHA-256十六进制摘要，作为缓存索引键。"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+@contextmanager
+def interprocess_lock(lock_path: str):
+    """
+    基于文件的进程间互斥锁（POSIX上使用fcntl.flock）。
+
+    不支持flock的平台上退化为无操作，此时由SQLite自身的锁保证数据一致。
+    """
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class LLMCache:
+    """
+    基于SQLite的LLM响应缓存。
+
+    每条记录以提示词哈希为主键，查找和写入都只触及单行，
+    不再需要像旧版llm_cache.json那样每次调用都解析并重写整个文件。
+
+    多个进程可以安全地共享同一个数据库：使用WAL日志模式，读操作不会
+    被写操作阻塞；每次写入都是一个独立的短事务，遇到锁冲突时等待并重试，
+    不会丢失其他进程写入的条目。每个线程（以及fork出的子进程）使用自己的连接。
+    """
+
+    def __init__(self, db_path: str, busy_timeout: float = 30.0, write_retries: int = 5):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.write_retries = write_retries
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        # WAL模式是数据库级别的持久设置，只需设置一次
+        conn.execute("PRAGMA journal_mode=WAL")
+        self._write(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, prompt TEXT NOT NULL, response TEXT NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """返回当前线程的连接；fork之后在子进程中重新打开。"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _write(self, sql: str, param_sets: Optional[Sequence[Tuple]] = None) -> None:
+        """
+        在一个BEGIN IMMEDIATE事务中执行写操作，数据库繁忙时退避重试。
+
+        带占位符的语句总是通过executemany执行，param_sets为每次执行的参数；
+        只有不带参数的语句（param_sets为None）使用execute。
+        """
+        conn = self._connection()
+        for attempt in range(self.write_retries):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if param_sets is None:
+                        conn.execute(sql)
+                    else:
+                        conn.executemany(sql, param_sets)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                return
+            except sqlite3.OperationalError as e:
+                busy = "locked" in str(e) or "busy" in str(e)
+                if not busy or attempt == self.write_retries - 1:
+                    raise
+                time.sleep(0.05 * (2 ** attempt))
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, prompt: str, response: str) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO responses (key, prompt, response) VALUES (?, ?, ?)",
+            [(key, prompt, response)]
+        )
+
+    def delete(self, key: str) -> None:
+        self._write("DELETE FROM responses WHERE key = ?", [(key,)])
+
+    def set_many(self, entries: Iterable[Tuple[str, str, str]], replace: bool = False) -> None:
+        """在一个事务中写入多个(key, prompt, response)条目；replace为False时保留已有条目。"""
+        # 先收集为列表：繁忙重试时需要再次遍历
+        entries = list(entries)
+        if not entries:
+            return
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self._write(f"{verb} INTO responses (key, prompt, response) VALUES (?, ?, ?)", entries)
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self) -> None:
+        self._write("DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    # 连接属于其他线程时无法在此关闭，随线程结束释放
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+class MemoryCache:
+    """
+    进程内的LRU缓存层，位于磁盘缓存之前。
+
+    同时按条目数和字节数限制容量，可选TTL。超出任一上限时
+    淘汰最久未使用的条目。hits/misses/evictions计数器用于评估容量配置。
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (response, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            response, size, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def set(self, key: str, response: str) -> None:
+        size = len(response.encode("utf-8"))
+        # 单个条目超过总容量时不缓存，否则会清空整个缓存
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (response, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """返回计数器和当前占用情况的快照。"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes
+            }
+
+def migrate_json_cache(json_path: str, cache: LLMCache) -> int:
+    """
+    将旧版llm_cache.json（提示词 -> 响应的字典）导入SQLite缓存。
+
+    导入成功后将JSON文件重命名为`<json_path>.migrated`，避免重复迁移。
+    迁移在进程间文件锁内进行，多个进程同时启动时只有一个会执行迁移。
+
+    Args:
+        json_path: 旧版JSON缓存文件路径
+        cache: 目标缓存
+
+    Returns:
+        导入的条目数
+    """
+    if not os.path.exists(json_path):
+        return 0
+
+    with interprocess_lock(cache.db_path + ".lock"):
+        # 获得锁后再次检查，其他进程可能已经完成迁移
+        if not os.path.exists(json_path):
+            return 0
+
+        try:
+            with open(json_path, 'r') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load legacy cache {json_path}, skipping migration: {e}")
+            return 0
+        if not isinstance(legacy, dict):
+            logger.warning(f"Legacy cache {json_path} is not a prompt -> response mapping, skipping migration")
+            return 0
+
+        # 只导入字符串条目（response列不允许NULL）
+        legacy = {prompt: response for prompt, response in legacy.items() if isinstance(response, str)}
+        cache.set_many((prompt_key(prompt), prompt, response) for prompt, response in legacy.items())
+        os.replace(json_path, json_path + ".migrated")
+
+    logger.info(f"Migrated {len(legacy)} entries from {json_path} to {cache.db_path}")
+    return len(legacy)
+
+def _demo_worker(db_path: str, worker: int, count: int) -> None:
+    cache = LLMCache(db_path)
+    for i in range(count):
+        prompt = f"worker {worker} prompt {i}"
+        cache.set(prompt_key(prompt), prompt, f"response {i}")
+    cache.close()
+
+if __name__ == "__main__":
+    import tempfile
+    import multiprocessing
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 创建旧版JSON缓存并迁移
+        json_path = os.path.join(tmp, "llm_cache.json")
+        with open(json_path, 'w') as f:
+            json.dump({"Hello": "Hi there!", "Bye": "Goodbye!"}, f)
+
+        cache = LLMCache(os.path.join(tmp, "llm_cache.db"))
+        migrated = migrate_json_cache(json_path, cache)
+        print(f"Migrated entries: {migrated}, cache size: {len(cache)}")
+        print(f"Lookup 'Hello': {cache.get(prompt_key('Hello'))}")
+
+        # 空的和格式不对的旧版缓存：不导入任何条目，也不报错
+        for name, content in (("empty.json", {}), ("list.json", ["not", "a", "mapping"])):
+            path = os.path.join(tmp, name)
+            with open(path, 'w') as f:
+                json.dump(content, f)
+            print(f"Migrated from {name}: {migrate_json_cache(path, cache)}")
+
+        # 测试写入和读取
+        cache.set(prompt_key("New prompt"), "New prompt", "New response")
+        print(f"Lookup 'New prompt': {cache.get(prompt_key('New prompt'))}")
+        print(f"Lookup missing: {cache.get(prompt_key('Missing'))}")
+
+        # 多个进程并发写入同一个数据库，不应丢失任何条目
+        workers = [
+            multiprocessing.Process(target=_demo_worker, args=(cache.db_path, w, 200))
+            for w in range(4)
+        ]
+        for p in workers:
+            p.start()
+        for p in workers:
+            p.join()
+        print(f"Cache size after 4 workers x 200 writes: {len(cache)} (expected {3 + 800})")
+        cache.close()
+
+    # 测试内存LRU层的淘汰
+    memory = MemoryCache(max_entries=2, max_bytes=1024)
+    memory.set("a", "response a")
+    memory.set("b", "response b")
+    memory.get("a")
+    memory.set("c", "response c")  # 淘汰最久未使用的"b"
+    print(f"\nMemory lookup 'b': {memory.get('b')}, 'a': {memory.get('a')}")
+    print(f"Memory stats: {memory.stats()}")
@@ -0,0 +1,235 @@
+import os
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+logger = logging.getLogger("llm_logger")
+
+# 响应usage中与输入/输出token计费相关的字段
+USAGE_FIELDS = ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens")
+
+def response_text(response: Any) -> str:
+    """拼接响应中所有text类型内容块的文本（跳过thinking块）。"""
+    return "".join(block.text for block in response.content if block.type == "text")
+
+def thinking_text(response: Any) -> str:
+    """拼接响应中所有thinking内容块的文本。"""
+    return "".join(block.thinking for block in response.content if block.type == "thinking")
+
+def usage_to_dict(usage: Any) -> Dict[str, int]:
+    """把SDK的usage对象转换为字典，缺失或为None的字段记为0。"""
+    return {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+
+class LLMBackend:
+    """
+    LLM后端接口。
+
+    call_llm只通过此接口发送请求，因此可以替换为任何实现了
+    create()的对象，例如指向本地替身服务器的后端以进行负载测试。
+    """
+
+    def create(self, **request) -> Any:
+        """
+        发送一条Messages API请求并返回响应对象。
+
+        请求参数中的timeout为本次请求的超时秒数（不超过重试的剩余截止时间），由Anthropic SDK直接支持。
+        """
+        raise NotImplementedError
+
+    def stream(self, usage_callback: Optional[Callable[[Dict[str, int]], None]] = None, **request) -> Iterator[str]:
+        """
+        以流式方式发送请求，逐块产出响应文本。
+
+        默认实现退化为一次create()调用；支持流式的后端应覆盖此方法。
+        调用方提前关闭生成器时，后端应中止底层请求。
+        收到usage信息时（可能分多次）以字典调用usage_callback，键为USAGE_FIELDS
+        中的字段，另有thinking_chars表示新收到的思考内容字符数。
+        """
+        response = self.create(**request)
+        if usage_callback:
+            usage_callback(_response_usage_dict(response))
+        yield response_text(response)
+
+    async def acreate(self, **request) -> Any:
+        """create()的异步版本；默认实现在线程池中运行create()。"""
+        return await asyncio.to_thread(self.create, **request)
+
+    async def astream(self, usage_callback: Optional[Callable[[Dict[str, int]], None]] = None, **request) -> AsyncIterator[str]:
+        """stream()的异步版本；默认实现退化为一次acreate()调用。"""
+        response = await self.acreate(**request)
+        if usage_callback:
+            usage_callback(_response_usage_dict(response))
+        yield response_text(response)
+
+    def close(self) -> None:
+        """释放连接池等资源。"""
+        pass
+
+def _response_usage_dict(response: Any) -> Dict[str, int]:
+    usage = usage_to_dict(response.usage)
+    usage["thinking_chars"] = len(thinking_text(response))
+    return usage
+
+def _handle_stream_event(event: Any, usage_callback: Optional[Callable[[Dict[str, int]], None]]) -> Optional[str]:
+    """处理一个流式事件：上报usage，并返回文本增量（如果有）。"""
+    if event.type == "message_start":
+        # 输入token（包括提示词缓存读写）在流开始时就已确定
+        if usage_callback:
+            usage_callback(usage_to_dict(event.message.usage))
+    elif event.type == "message_delta":
+        if usage_callback:
+            usage_callback({"output_tokens": getattr(event.usage, "output_tokens", None) or 0})
+    elif event.type == "content_block_delta":
+        if event.delta.type == "text_delta":
+            return event.delta.text
+        if event.delta.type == "thinking_delta" and usage_callback:
+            usage_callback({"thinking_chars": len(event.delta.thinking)})
+    return None
+
+class AnthropicBackend(LLMBackend):
+    """
+    包装一个Anthropic SDK客户端（AnthropicVertex或Anthropic）。
+
+    异步客户端在第一次异步调用时才通过async_client_factory创建，
+    只使用同步路径的进程不会额外建立连接池。
+    """
+
+    def __init__(self, client: Any, async_client_factory: Optional[Callable[[], Any]] = None):
+        self.client = client
+        self._async_client_factory = async_client_factory
+        self._async_client = None
+
+    @property
+    def async_client(self) -> Any:
+        if self._async_client is None:
+            if self._async_client_factory is None:
+                raise RuntimeError("Backend has no async client")
+            self._async_client = self._async_client_factory()
+        return self._async_client
+
+    def create(self, **request) -> Any:
+        return self.client.messages.create(**request)
+
+    def stream(self, usage_callback: Optional[Callable[[Dict[str, int]], None]] = None, **request) -> Iterator[str]:
+        # 退出上下文管理器时关闭HTTP响应，因此提前停止消费会中止生成
+        with self.client.messages.stream(**request) as stream:
+            for event in stream:
+                text = _handle_stream_event(event, usage_callback)
+                if text:
+                    yield text
+
+    async def acreate(self, **request) -> Any:
+        if self._async_client_factory is None:
+            return await super().acreate(**request)
+        return await self.async_client.messages.create(**request)
+
+    async def astream(self, usage_callback: Optional[Callable[[Dict[str, int]], None]] = None, **request) -> AsyncIterator[str]:
+        if self._async_client_factory is None:
+            async for text in super().astream(usage_callback, **request):
+                yield text
+            return
+        async with self.async_client.messages.stream(**request) as stream:
+            async for event in stream:
+                text = _handle_stream_event(event, usage_callback)
+                if text:
+                    yield text
+
+    def close(self) -> None:
+        self.client.close()
+        # 异步客户端的连接在进程退出时随事件循环一起释放
+
+def _pooled_http_client() -> Any:
+    """创建启用连接池和keep-alive的HTTP客户端，供SDK客户端复用连接和TLS会话。"""
+    import httpx
+    from anthropic import DefaultHttpxClient
+
+    return DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10")),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+        ),
+        timeout=float(os.getenv("LLM_TIMEOUT", "600"))
+    )
+
+def _pooled_async_http_client() -> Any:
+    """_pooled_http_client()的异步版本，供acall_llm使用。"""
+    import httpx
+    from anthropic import DefaultAsyncHttpxClient
+
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10")),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+        ),
+        timeout=float(os.getenv("LLM_TIMEOUT", "600"))
+    )
+
+def vertex_backend() -> LLMBackend:
+    """通过Google Vertex AI访问Claude的后端（默认）。"""
+    from anthropic import AnthropicVertex, AsyncAnthropicVertex
+
+    # 重试由utils/llm_retry.py统一处理（带截止时间和对冲请求），关闭SDK自带的重试
+
+    region = os.getenv("ANTHROPIC_REGION", "us-east5")
+    project_id = os.getenv("ANTHROPIC_PROJECT_ID", "your-project-id")
+    return AnthropicBackend(
+        AnthropicVertex(region=region, project_id=project_id, http_client=_pooled_http_client(), max_retries=0),
+        lambda: AsyncAnthropicVertex(region=region, project_id=project_id, http_client=_pooled_async_http_client(), max_retries=0)
+    )
+
+def anthropic_backend() -> LLMBackend:
+    """
+    直连Anthropic API的后端。
+
+    设置ANTHROPIC_BASE_URL可指向兼容Messages API的本地替身服务器。
+    """
+    from anthropic import Anthropic, AsyncAnthropic
+
+    base_url = os.getenv("ANTHROPIC_BASE_URL")
+    return AnthropicBackend(
+        Anthropic(base_url=base_url, http_client=_pooled_http_client(), max_retries=0),
+        lambda: AsyncAnthropic(base_url=base_url, http_client=_pooled_async_http_client(), max_retries=0)
+    )
+
+# 后端名称 -> 工厂函数，通过LLM_BACKEND环境变量选择
+_backend_factories: Dict[str, Callable[[], LLMBackend]] = {
+    "vertex": vertex_backend,
+    "anthropic": anthropic_backend
+}
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+def register_backend(name: str, factory: Callable[[], LLMBackend]) -> None:
+    """注册一个可通过LLM_BACKEND选择的后端工厂。"""
+    _backend_factories[name] = factory
+
+def get_backend() -> LLMBackend:
+    """返回进程内共享的长生命周期后端，首次调用时创建。"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv("LLM_BACKEND", "vertex")
+                if name not in _backend_factories:
+                    raise ValueError(f"Unknown LLM backend: {name}")
+                _backend = _backend_factories[name]()
+                logger.info(f"Created LLM backend: {name}")
+    return _backend
+
+def set_backend(backend: Optional[LLMBackend]) -> None:
+    """替换共享后端（传入None则在下次调用时按配置重新创建），并关闭旧后端。"""
+    global _backend
+    with _backend_lock:
+        old, _backend = _backend, backend
+    if old is not None and old is not backend:
+        old.close()
+
+def close_backend() -> None:
+    """关闭共享后端并释放其连接池。"""
+    set_backend(None)
+
+atexit.register(close_backend)
@@ -0,0 +1,153 @@
+import os
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import hashlib
+import logging
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """
+    按大小或时间间隔轮转的日志处理器，轮转出的文件用gzip压缩。
+
+    达到max_bytes或距上次轮转超过interval秒时（以先到者为准）轮转，
+    旧文件保存为`<filename>.<n>.gz`，最多保留backup_count个。
+    """
+
+    def __init__(self, filename: str, max_bytes: int, interval: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=max(1, backup_count), encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.interval > 0 and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+_listener = None
+
+def setup_llm_logger(log_directory: str) -> logging.Logger:
+    """
+    配置llm_logger：日志记录放入队列，由后台线程写入可轮转、压缩的文件，
+    调用方线程不会因磁盘写入而阻塞。
+
+    轮转参数由环境变量LLM_LOG_MAX_BYTES、LLM_LOG_ROTATE_SECONDS和
+    LLM_LOG_BACKUP_COUNT控制。
+    """
+    global _listener
+    logger = logging.getLogger("llm_logger")
+    if _listener is not None:
+        return logger
+
+    os.makedirs(log_directory, exist_ok=True)
+    file_handler = CompressingRotatingFileHandler(
+        os.path.join(log_directory, "llm_calls.log"),
+        max_bytes=int(os.getenv("LLM_LOG_MAX_BYTES", str(50 * 1024 * 1024))),
+        interval=float(os.getenv("LLM_LOG_ROTATE_SECONDS", "86400")),
+        backup_count=int(os.getenv("LLM_LOG_BACKUP_COUNT", "14"))
+    )
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.Queue()
+    _listener = QueueListener(log_queue, file_handler)
+    _listener.start()
+    # 进程退出时先写完队列中剩余的记录
+    atexit.register(_listener.stop)
+
+    logger.setLevel(logging.INFO)
+    logger.addHandler(QueueHandler(log_queue))
+    # 完整的提示词和响应只写入专用日志，不再同步写入根日志处理器
+    logger.propagate = False
+    return logger
+
+def _common_prefix_len(a: str, b: str) -> int:
+    # 用切片比较做二分查找，比逐字符比较快得多
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class PromptLogger:
+    """
+    按配置的模式记录提示词。
+
+    - full：记录完整提示词（默认）
+    - hash：只记录提示词的哈希和长度
+    - delta：记录哈希，以及相对于最近某个提示词的增量（公共前缀之后的部分）。
+      提示词每轮都会重新嵌入整个历史，增量模式使日志量随会话长度线性而非平方增长。
+    """
+
+    def __init__(self, logger: logging.Logger, mode: str = "full", history_size: int = 8, min_prefix: int = 256):
+        if mode not in ("full", "hash", "delta"):
+            raise ValueError(f"Unknown prompt log mode: {mode}")
+        self.logger = logger
+        self.mode = mode
+        self.min_prefix = min_prefix
+        self._recent = deque(maxlen=history_size)  # (hash, prompt)
+        self._lock = threading.Lock()
+
+    def log(self, prompt: str) -> None:
+        if self.mode == "full":
+            self.logger.info(f"PROMPT: {prompt}")
+            return
+
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        if self.mode == "hash":
+            self.logger.info(f"PROMPT sha256={digest} chars={len(prompt)}")
+            return
+
+        with self._lock:
+            base_digest, prefix = None, 0
+            for recent_digest, recent_prompt in self._recent:
+                length = _common_prefix_len(prompt, recent_prompt)
+                if length > prefix:
+                    base_digest, prefix = recent_digest, length
+            self._recent.append((digest, prompt))
+
+        if base_digest is None or prefix < self.min_prefix:
+            self.logger.info(f"PROMPT sha256={digest} chars={len(prompt)} full: {prompt}")
+        else:
+            self.logger.info(
+                f"PROMPT sha256={digest} chars={len(prompt)} base={base_digest} prefix={prefix} delta: {prompt[prefix:]}"
+            )
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 使用很小的max_bytes触发轮转和压缩
+        handler = CompressingRotatingFileHandler(os.path.join(tmp, "test.log"), max_bytes=200, interval=3600, backup_count=3)
+        test_logger = logging.getLogger("llm_logging_test")
+        test_logger.addHandler(handler)
+        test_logger.setLevel(logging.INFO)
+
+        prompt_logger = PromptLogger(test_logger, mode="delta", min_prefix=10)
+        history = "User request: fix the bug\n"
+        for step in range(5):
+            history += f"Action {step + 1}: read_file utils/module_{step}.py\n"
+            prompt_logger.log(history)
+
+        handler.close()
+        print(f"Log files: {sorted(os.listdir(tmp))}")
+        with open(os.path.join(tmp, "test.log")) as f:
+            print(f"Current log:\n{f.read()}")
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# 按节点聚合的token计数字段
+TOKEN_FIELDS = ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens", "thinking_tokens")
+
+_lock = threading.Lock()
+_nodes: Dict[str, Dict[str, Any]] = {}
+_recent_calls = deque(maxlen=int(os.getenv("LLM_METRICS_RECENT_CALLS", "200")))
+# 按预算（turns、tokens、seconds）统计因预算用尽而结束的会话数
+_budgets_exhausted: Dict[str, int] = {}
+
+# 当前打开的用量范围（外层在前），调用计入所有范围；通过contextvar传递，同一进程中并发的异步会话互不影响
+_usage_scope: ContextVar[Tuple[Dict[str, int], ...]] = ContextVar("llm_usage_scope", default=())
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数（约4个字符一个token），用于提供方未返回计数的场景。"""
+    return (len(text) + 3) // 4
+
+def _new_node_stats() -> Dict[str, Any]:
+    return {
+        "calls": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "errors": 0,
+        "wall_time_total": 0.0,
+        "wall_time_max": 0.0,
+        "ttft_total": 0.0,
+        "ttft_count": 0,
+        "retries": 0,
+        "hedges_fired": 0,
+        "hedges_won": 0,
+        "coalesced": 0,
+        "repairs": 0,
+        "repair_failures": 0,
+        **{field: 0 for field in TOKEN_FIELDS}
+    }
+
+def record_call(
+    node: Optional[str],
+    wall_time: float,
+    cache_hit: bool,
+    ttft: Optional[float] = None,
+    usage: Optional[Dict[str, int]] = None,
+    error: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    记录一次LLM调用。
+
+    Args:
+        node: 发起调用的节点名称（未知时记为"unknown"）
+        wall_time: 调用总耗时（秒），缓存命中时为查找耗时
+        cache_hit: 是否命中响应缓存
+        ttft: 首个token的到达时间（秒），仅流式调用可用
+        usage: token计数，键见TOKEN_FIELDS
+        error: 调用失败时的错误描述
+
+    Returns:
+        记录的调用条目
+    """
+    node = node or "unknown"
+    usage = usage or {}
+    record = {
+        "timestamp": time.time(),
+        "node": node,
+        "wall_time": wall_time,
+        "ttft": ttft,
+        "cache_hit": cache_hit,
+        "error": error,
+        **{field: usage.get(field, 0) for field in TOKEN_FIELDS}
+    }
+
+    with _lock:
+        stats = _nodes.setdefault(node, _new_node_stats())
+        stats["calls"] += 1
+        stats["cache_hits" if cache_hit else "cache_misses"] += 1
+        if error:
+            stats["errors"] += 1
+        stats["wall_time_total"] += wall_time
+        stats["wall_time_max"] = max(stats["wall_time_max"], wall_time)
+        if ttft is not None:
+            stats["ttft_total"] += ttft
+            stats["ttft_count"] += 1
+        for field in TOKEN_FIELDS:
+            stats[field] += record[field]
+        _recent_calls.append(record)
+        for scope in _usage_scope.get():
+            for field in TOKEN_FIELDS:
+                scope[field] += record[field]
+
+    return record
+
+def record_usage(node: Optional[str], usage: Dict[str, int]) -> None:
+    """
+    只累加token用量，不计为一次调用（如对冲中落后的请求：消耗了配额，但结果未被使用）。
+
+    与record_call相同，也计入当前的用量范围。
+    """
+    with _lock:
+        stats = _nodes.setdefault(node or "unknown", _new_node_stats())
+        for field in TOKEN_FIELDS:
+            stats[field] += usage.get(field, 0)
+            for scope in _usage_scope.get():
+                scope[field] += usage.get(field, 0)
+
+def record_event(node: Optional[str], field: str, amount: int = 1) -> None:
+    """
+    累加节点的事件计数器。
+
+    Args:
+        node: 节点名称（未知时记为"unknown"）
+        field: 计数器名称：retries、hedges_fired、hedges_won、coalesced、repairs或repair_failures
+        amount: 增量
+    """
+    with _lock:
+        stats = _nodes.setdefault(node or "unknown", _new_node_stats())
+        stats[field] += amount
+
+@contextmanager
+def usage_scope(usage: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, int]]:
+    """
+    统计一个会话的token用量：范围内（包括其中创建的线程和任务）记录的调用都累加到产出的字典中。
+
+    范围可以嵌套，调用同时计入外层的范围。传入usage时继续累加到该字典（同一会话多次运行），
+    否则从零开始。
+
+    用法：
+        with usage_scope() as usage:
+            flow.run(shared)
+    """
+    if usage is None:
+        usage = {field: 0 for field in TOKEN_FIELDS}
+    else:
+        for field in TOKEN_FIELDS:
+            usage.setdefault(field, 0)
+    token = _usage_scope.set(_usage_scope.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _usage_scope.reset(token)
+
+def scope_tokens() -> int:
+    """
+    返回当前（最内层的）用量范围（没有时为整个进程）消耗的token数。
+
+    与提供方的配额计算一致：未命中缓存的输入、缓存写入和输出token，不含命中提示词缓存的输入token。
+    """
+    with _lock:
+        scopes = _usage_scope.get()
+        if scopes:
+            usage = scopes[-1]
+        else:
+            usage = {field: sum(stats[field] for stats in _nodes.values()) for field in TOKEN_FIELDS}
+        return usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["output_tokens"]
+
+def record_budget_exhausted(budget: str) -> None:
+    """记录一次因预算用尽而结束的会话（budget为turns、tokens或seconds）。"""
+    with _lock:
+        _budgets_exhausted[budget] = _budgets_exhausted.get(budget, 0) + 1
+
+def latency_percentile(node: Optional[str], percentile: float, min_samples: int = 1, field: str = "wall_time") -> Optional[float]:
+    """
+    返回节点最近成功的上游调用（不含缓存命中）耗时的百分位数。
+
+    field为wall_time（调用总耗时）或ttft（首个token的到达时间，只有流式调用有此样本）。
+    样本数少于min_samples时返回None。
+    """
+    node = node or "unknown"
+    with _lock:
+        samples = sorted(
+            record[field] for record in _recent_calls
+            if record["node"] == node and not record["cache_hit"] and not record["error"] and record[field] is not None
+        )
+    if not samples or len(samples) < min_samples:
+        return None
+    index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+    return samples[index]
+
+def totals() -> Dict[str, Any]:
+    """返回所有节点合计的调用数和token数。"""
+    with _lock:
+        result = {"calls": 0, "cache_hits": 0, **{field: 0 for field in TOKEN_FIELDS}}
+        for stats in _nodes.values():
+            for key in result:
+                result[key] += stats[key]
+        return result
+
+def snapshot() -> Dict[str, Any]:
+    """返回按节点聚合的指标和最近调用记录的快照。"""
+    with _lock:
+        nodes = {}
+        for node, stats in _nodes.items():
+            nodes[node] = dict(stats)
+            nodes[node]["wall_time_avg"] = stats["wall_time_total"] / stats["calls"] if stats["calls"] else 0.0
+            nodes[node]["ttft_avg"] = stats["ttft_total"] / stats["ttft_count"] if stats["ttft_count"] else None
+            nodes[node]["cache_hit_rate"] = stats["cache_hits"] / stats["calls"] if stats["calls"] else 0.0
+        return {
+            "generated_at": time.time(),
+            "nodes": nodes,
+            "budgets_exhausted": dict(_budgets_exhausted),
+            "recent_calls": list(_recent_calls)
+        }
+
+def reset() -> None:
+    """清空所有指标。"""
+    with _lock:
+        _nodes.clear()
+        _recent_calls.clear()
+        _budgets_exhausted.clear()
+
+def _atomic_write(path: str, content: str) -> None:
+    # 先写临时文件再替换，避免采集方读到写了一半的文件
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def export_json(path: str) -> None:
+    """将指标快照写入JSON文件。"""
+    _atomic_write(path, json.dumps(snapshot(), indent=2))
+
+def render_prometheus() -> str:
+    """以Prometheus文本格式渲染按节点聚合的指标。"""
+    current = snapshot()
+    nodes = current["nodes"]
+    lines = []
+
+    def metric(name: str, metric_type: str, help_text: str, samples) -> None:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}")
+
+    metric("llm_calls_total", "counter", "LLM calls by node and response cache result.", [
+        ({"node": node, "cache": cache}, stats[field])
+        for node, stats in nodes.items() for cache, field in (("hit", "cache_hits"), ("miss", "cache_misses"))
+    ])
+    metric("llm_call_errors_total", "counter", "Failed LLM calls by node.", [
+        ({"node": node}, stats["errors"]) for node, stats in nodes.items()
+    ])
+    metric("llm_call_duration_seconds_sum", "counter", "Total LLM call wall time by node.", [
+        ({"node": node}, stats["wall_time_total"]) for node, stats in nodes.items()
+    ])
+    metric("llm_call_duration_seconds_count", "counter", "Number of timed LLM calls by node.", [
+        ({"node": node}, stats["calls"]) for node, stats in nodes.items()
+    ])
+    metric("llm_call_duration_seconds_max", "gauge", "Slowest LLM call by node.", [
+        ({"node": node}, stats["wall_time_max"]) for node, stats in nodes.items()
+    ])
+    metric("llm_time_to_first_token_seconds_sum", "counter", "Total time to first token of streamed calls by node.", [
+        ({"node": node}, stats["ttft_total"]) for node, stats in nodes.items()
+    ])
+    metric("llm_time_to_first_token_seconds_count", "counter", "Number of streamed calls with a first token by node.", [
+        ({"node": node}, stats["ttft_count"]) for node, stats in nodes.items()
+    ])
+    metric("llm_retries_total", "counter", "Retried upstream LLM requests by node.", [
+        ({"node": node}, stats["retries"]) for node, stats in nodes.items()
+    ])
+    metric("llm_hedged_requests_total", "counter", "Hedged LLM requests by node and outcome (won = hedge returned first).", [
+        ({"node": node, "outcome": outcome}, stats[field])
+        for node, stats in nodes.items() for outcome, field in (("fired", "hedges_fired"), ("won", "hedges_won"))
+    ])
+    metric("llm_coalesced_calls_total", "counter", "LLM calls served by an identical in-flight request by node.", [
+        ({"node": node}, stats["coalesced"]) for node, stats in nodes.items()
+    ])
+    metric("llm_repairs_total", "counter", "Repair requests for responses that failed validation by node and outcome.", [
+        ({"node": node, "outcome": outcome}, stats[field])
+        for node, stats in nodes.items() for outcome, field in (("attempted", "repairs"), ("failed", "repair_failures"))
+    ])
+    metric("llm_tokens_total", "counter", "Tokens by node and type (thinking tokens are estimated).", [
+        ({"node": node, "type": field[:-len("_tokens")]}, stats[field])
+        for node, stats in nodes.items() for field in TOKEN_FIELDS
+    ])
+    metric("agent_budget_exhausted_total", "counter", "Agent sessions stopped because a budget ran out, by budget.", [
+        ({"budget": budget}, count) for budget, count in current["budgets_exhausted"].items()
+    ])
+    return "\n".join(lines) + "\n"
+
+def export_prometheus(path: str) -> None:
+    """将指标写入Prometheus文本文件（可供node_exporter的textfile采集器读取）。"""
+    _atomic_write(path, render_prometheus())
+
+if __name__ == "__main__":
+    # 模拟几次调用并打印两种导出格式
+    record_call("MainDecisionAgent", 2.5, cache_hit=False, ttft=0.8,
+                usage={"input_tokens": 300, "cache_read_input_tokens": 1200, "output_tokens": 150, "thinking_tokens": 100})
+    record_call("MainDecisionAgent", 0.01, cache_hit=True)
+    record_call("FormatResponseNode", 4.0, cache_hit=False, usage={"input_tokens": 2000, "output_tokens": 400})
+
+    print(json.dumps(snapshot()["nodes"], indent=2))
+    print(render_prometheus())
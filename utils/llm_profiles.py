@@ -0,0 +1,116 @@
+import os
+import json
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("llm_logger")
+
+# 原有的固定请求参数；未配置专用档案的节点使用它
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "model": "claude-3-7-sonnet@20250219",
+    "max_tokens": 20000,
+    "thinking_budget": 16000
+}
+
+# 各节点的默认档案。thinking_budget为0表示不启用扩展思考。
+# - MainDecisionAgent每轮只需选择一个工具，较小的思考预算即可；但edit_file决策的code_edit
+#   包含完整的修改内容，max_tokens保留与默认档案相近的输出空间（思考之后约16000个token），
+#   避免长编辑被截断。max_tokens只是上限，不影响普通决策的耗时和费用，只有确实很长的响应才会
+#   用到；缩短思考预算才是降低每轮延迟的手段
+# - AnalyzeAndPlanNode需要推理出精确的行号，保留完整预算
+# - FormatResponseNode只是总结已执行的操作，不需要思考
+NODE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "MainDecisionAgent": {"max_tokens": 20000, "thinking_budget": 4000},
+    "AnalyzeAndPlanNode": {"max_tokens": 20000, "thinking_budget": 16000},
+    "FormatResponseNode": {"max_tokens": 4000, "thinking_budget": 0}
+}
+
+# 扩展思考的最小预算（提供方限制）
+MIN_THINKING_BUDGET = 1024
+
+# 修复无效响应时的思考预算：只需按错误信息改正格式，默认不启用思考
+REPAIR_THINKING_BUDGET = int(os.getenv("LLM_REPAIR_THINKING_BUDGET", "0"))
+
+_profiles: Optional[Dict[str, Dict[str, Any]]] = None
+
+def load_profiles(path: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    加载节点档案：内置默认值，再用JSON文件中的设置覆盖。
+
+    JSON文件格式为 {"节点名称": {"model": ..., "max_tokens": ..., "thinking_budget": ...}}，
+    可以只覆盖部分字段；"default"条目覆盖所有节点的默认值。
+    文件路径默认取自环境变量LLM_PROFILES_FILE。
+
+    Args:
+        path: 可选的JSON档案文件路径
+
+    Returns:
+        节点名称到档案覆盖项的字典
+    """
+    profiles = {node: dict(profile) for node, profile in NODE_PROFILES.items()}
+    path = path or os.getenv("LLM_PROFILES_FILE")
+    if path:
+        with open(path, 'r') as f:
+            overrides = json.load(f)
+        for node, profile in overrides.items():
+            profiles.setdefault(node, {}).update(profile)
+        logger.info(f"Loaded LLM profiles from {path}")
+    return profiles
+
+def get_profile(node: Optional[str]) -> Dict[str, Any]:
+    """
+    返回节点使用的完整档案（model、max_tokens和thinking_budget）。
+
+    未知节点使用默认档案。
+    """
+    global _profiles
+    if _profiles is None:
+        _profiles = load_profiles()
+
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(_profiles.get("default", {}))
+    if node:
+        profile.update(_profiles.get(node, {}))
+
+    budget = profile.get("thinking_budget") or 0
+    if budget:
+        # 思考预算不能低于提供方下限，且max_tokens必须大于思考预算
+        budget = max(budget, MIN_THINKING_BUDGET)
+        profile["max_tokens"] = max(profile["max_tokens"], budget + 1)
+    profile["thinking_budget"] = budget
+    return profile
+
+def get_repair_profile(node: Optional[str], base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    返回修复节点无效响应时使用的档案：模型和max_tokens与原始请求相同，思考预算为REPAIR_THINKING_BUDGET。
+
+    base为原始请求使用的档案（调用方覆盖了节点档案时），默认为节点的档案。
+    """
+    profile = dict(base) if base else get_profile(node)
+    budget = REPAIR_THINKING_BUDGET
+    if budget:
+        budget = max(budget, MIN_THINKING_BUDGET)
+        profile["max_tokens"] = max(profile["max_tokens"], budget + 1)
+    profile["thinking_budget"] = budget
+    return profile
+
+def set_profiles(profiles: Optional[Dict[str, Dict[str, Any]]]) -> None:
+    """替换当前的节点档案；传入None则在下次使用时重新加载。"""
+    global _profiles
+    _profiles = profiles
+
+if __name__ == "__main__":
+    import tempfile
+
+    for node in ("MainDecisionAgent", "AnalyzeAndPlanNode", "FormatResponseNode", "SomeOtherNode"):
+        print(f"{node}: {get_profile(node)}")
+    print(f"Repair profile for AnalyzeAndPlanNode: {get_repair_profile('AnalyzeAndPlanNode')}")
+
+    # 通过JSON文件覆盖部分字段
+    with tempfile.NamedTemporaryFile('w', suffix=".json", delete=False) as f:
+        json.dump({"FormatResponseNode": {"model": "claude-3-5-haiku@20241022"},
+                   "MainDecisionAgent": {"thinking_budget": 500}}, f)
+    set_profiles(load_profiles(f.name))
+    os.remove(f.name)
+    print(f"\nOverridden FormatResponseNode: {get_profile('FormatResponseNode')}")
+    print(f"Overridden MainDecisionAgent: {get_profile('MainDecisionAgent')}")
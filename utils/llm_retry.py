@@ -0,0 +1,488 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FuturesTimeout, wait
+from contextlib import closing
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+from utils import llm_metrics
+
+logger = logging.getLogger("llm_logger")
+
+# 可重试的HTTP状态码：请求超时、冲突、限流，以及服务端错误（含529 overloaded）
+RETRYABLE_STATUS = (408, 409, 429)
+
+class RetryPolicy:
+    """
+    带抖动的指数退避重试策略。
+
+    第n次重试前等待 uniform(0, min(max_delay, base_delay * 2**n)) 秒（full jitter），
+    服务端返回Retry-After时至少等待该时长。每次尝试的超时为attempt_timeout。
+    设置deadline时所有尝试必须在deadline秒内完成：每次尝试的超时不超过到截止时间的剩余时间，
+    下一次等待会超过截止时间时直接抛出最后一个错误。deadline为None或0表示没有总截止时间
+    （默认：非流式的长时间生成在完成前不返回任何数据，单次尝试就可能接近attempt_timeout）。
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        deadline: Optional[float] = None,
+        attempt_timeout: float = 600.0
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline or None
+        self.attempt_timeout = attempt_timeout
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """
+        从环境变量LLM_RETRY_ATTEMPTS、LLM_RETRY_BASE_DELAY、LLM_RETRY_MAX_DELAY、LLM_RETRY_DEADLINE
+        （默认0，不限制）和LLM_TIMEOUT（单次请求的超时，与HTTP客户端的默认超时相同）创建策略。
+        """
+        return cls(
+            max_attempts=int(os.getenv("LLM_RETRY_ATTEMPTS", "4")),
+            base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0")),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "30")),
+            deadline=float(os.getenv("LLM_RETRY_DEADLINE", "0")),
+            attempt_timeout=float(os.getenv("LLM_TIMEOUT", "600"))
+        )
+
+    def timeout(self, start: float) -> float:
+        """返回下一次尝试的超时（秒）：attempt_timeout，设置了截止时间时不超过剩余时间（至少1秒）。"""
+        if self.deadline is None:
+            return self.attempt_timeout
+        remaining = self.deadline - (time.monotonic() - start)
+        return max(1.0, min(self.attempt_timeout, remaining))
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        return max(delay, _retry_after(error) or 0.0)
+
+    def next_delay(self, attempt: int, error: Exception, start: float) -> Optional[float]:
+        """
+        返回第attempt次尝试失败后的等待时间；不应重试时返回None。
+        """
+        if attempt + 1 >= self.max_attempts or not is_retryable(error):
+            return None
+        delay = self.backoff(attempt, error)
+        if self.deadline is not None and time.monotonic() + delay - start > self.deadline:
+            return None
+        return delay
+
+default_policy = RetryPolicy.from_env()
+
+# 对冲请求：在节点最近调用耗时的该百分位数之后仍未返回时，发起第二个相同请求
+_hedge_percentile = os.getenv("LLM_HEDGE_PERCENTILE")
+HEDGE_PERCENTILE = float(_hedge_percentile) if _hedge_percentile else None
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+def is_retryable(error: BaseException) -> bool:
+    """判断错误是否为连接错误、超时、限流或服务端错误等暂时性错误。"""
+    try:
+        import anthropic
+    except ImportError:
+        anthropic = None
+
+    if anthropic is not None:
+        if isinstance(error, anthropic.APIConnectionError):
+            # 包括APITimeoutError
+            return True
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def hedge_delay(node: Optional[str], field: str = "wall_time") -> Optional[float]:
+    """
+    返回节点发起对冲请求前的等待时间；未启用对冲或样本不足时返回None。
+
+    field为wall_time时按完整调用的耗时计算（非流式调用），为ttft时按首个token的到达时间计算（流式调用）。
+    """
+    if HEDGE_PERCENTILE is None:
+        return None
+    threshold = llm_metrics.latency_percentile(node, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, field)
+    if threshold is None:
+        return None
+    return max(threshold, HEDGE_MIN_DELAY)
+
+def _log_retry(node: Optional[str], error: Exception, delay: float, attempt: int, policy: RetryPolicy) -> None:
+    llm_metrics.record_event(node, "retries")
+    logger.warning(
+        f"LLM call ({node or 'unknown'}) failed with {error!r}, "
+        f"retrying in {delay:.1f}s (attempt {attempt + 2}/{policy.max_attempts})"
+    )
+
+def _hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        _hedge_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("LLM_HEDGE_WORKERS", "8")), thread_name_prefix="llm-hedge"
+        )
+    return _hedge_executor
+
+def _when_done(future, callback: Callable[[Any], None]) -> None:
+    """落后的请求成功完成后（在调用方的上下文中）以其结果调用callback；失败的请求被忽略。"""
+    context = contextvars.copy_context()
+
+    def done(f) -> None:
+        if f.cancelled() or f.exception() is not None:
+            return
+        try:
+            context.run(callback, f.result())
+        except Exception as e:
+            logger.error(f"Failed to discard hedged LLM call: {e!r}")
+
+    future.add_done_callback(done)
+
+def _hedge_winner(primary, hedge, node: Optional[str]):
+    """等待两个请求中先成功的一个；都失败时抛出第一个请求的错误。"""
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in (primary, hedge):
+            if future in done and future.exception() is None:
+                if future is hedge:
+                    llm_metrics.record_event(node, "hedges_won")
+                return future
+    raise primary.exception()
+
+def hedged_call(fn: Callable[[], Any], delay: float, node: Optional[str] = None, on_discard: Optional[Callable[[Any], None]] = None) -> Any:
+    """
+    调用fn；delay秒后仍未返回则再发起一次，返回先成功的结果。
+
+    落后的请求无法取消，会在后台线程中完成；它成功时以其结果调用on_discard
+    （用于结算限流预约和记录用量），否则结果被丢弃。两个请求都失败时抛出第一个请求的错误。
+    """
+    pool = _hedge_pool()
+    primary = pool.submit(fn)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeout:
+        pass
+
+    llm_metrics.record_event(node, "hedges_fired")
+    hedge = pool.submit(fn)
+    winner = _hedge_winner(primary, hedge, node)
+    if on_discard is not None:
+        _when_done(hedge if winner is primary else primary, on_discard)
+    return winner.result()
+
+async def ahedged_call(fn: Callable[[], Awaitable[Any]], delay: float, node: Optional[str] = None, on_discard: Optional[Callable[[Any], None]] = None) -> Any:
+    """
+    hedged_call的异步版本：落后的请求会被取消（由fn负责退还其限流预约）；
+    两个请求同时成功时，以落后的结果调用on_discard。
+    """
+    primary = asyncio.ensure_future(fn())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    llm_metrics.record_event(node, "hedges_fired")
+    hedge = asyncio.ensure_future(fn())
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in (primary, hedge) if task in done and task.exception() is None]
+            if winners:
+                if winners[0] is hedge:
+                    llm_metrics.record_event(node, "hedges_won")
+                if len(winners) > 1 and on_discard is not None:
+                    on_discard(winners[1].result())
+                return winners[0].result()
+        raise primary.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+# 流在第一块之前就结束（空响应）
+_END = object()
+
+def _open_first(stream: Iterator[str]) -> Any:
+    return next(stream, _END)
+
+def hedged_stream(open_stream: Callable[[], Iterator[str]], delay: float, node: Optional[str] = None, on_discard: Optional[Callable[[Any], None]] = None) -> Iterator[str]:
+    """
+    逐块产出open_stream()返回的流；delay秒内没有收到第一块时再打开一个相同的流，使用先收到第一块的流。
+
+    open_stream()必须立即返回（第一次读取时才发起请求）。落败的流被确定时立即以它调用on_discard，
+    在其正在进行的读取结束后关闭。两个流都在第一块之前失败时抛出第一个流的错误。
+    """
+    pool = _hedge_pool()
+    primary_stream = open_stream()
+    primary = pool.submit(_open_first, primary_stream)
+    try:
+        first = primary.result(timeout=delay)
+        stream = primary_stream
+    except FuturesTimeout:
+        llm_metrics.record_event(node, "hedges_fired")
+        hedge_stream = open_stream()
+        hedge = pool.submit(_open_first, hedge_stream)
+        try:
+            winner = _hedge_winner(primary, hedge, node)
+        except BaseException:
+            primary_stream.close()
+            hedge_stream.close()
+            raise
+        stream, loser, loser_stream = (
+            (primary_stream, hedge, hedge_stream) if winner is primary else (hedge_stream, primary, primary_stream)
+        )
+        first = winner.result()
+        if on_discard is not None:
+            on_discard(loser_stream)
+        # 落败的流可能还在后台线程中读取，读取结束后（在调用方的上下文中）再关闭
+        context = contextvars.copy_context()
+        loser.add_done_callback(lambda _: context.run(loser_stream.close))
+    except BaseException:
+        primary_stream.close()
+        raise
+
+    with closing(stream):
+        if first is not _END:
+            yield first
+            yield from stream
+
+async def _aopen_first(stream: AsyncIterator[str]) -> Any:
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+async def ahedged_stream(open_stream: Callable[[], AsyncIterator[str]], delay: float, node: Optional[str] = None, on_discard: Optional[Callable[[Any], None]] = None) -> AsyncIterator[str]:
+    """hedged_stream的异步版本：落败的流被取消并立即关闭。"""
+    streams = [open_stream()]
+    tasks = [asyncio.ensure_future(_aopen_first(streams[0]))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            llm_metrics.record_event(node, "hedges_fired")
+            streams.append(open_stream())
+            tasks.append(asyncio.ensure_future(_aopen_first(streams[1])))
+            pending = set(tasks)
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((i for i, task in enumerate(tasks) if task in done and task.exception() is None), None)
+            if winner is None:
+                raise tasks[0].exception()
+            if winner == 1:
+                llm_metrics.record_event(node, "hedges_won")
+        else:
+            winner = 0
+            tasks[0].result()
+    except BaseException:
+        for task, stream in zip(tasks, streams):
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await stream.aclose()
+        raise
+
+    for i, (task, stream) in enumerate(zip(tasks, streams)):
+        if i != winner:
+            if on_discard is not None:
+                on_discard(stream)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await stream.aclose()
+
+    stream, first = streams[winner], tasks[winner].result()
+    try:
+        if first is not _END:
+            yield first
+            async for chunk in stream:
+                yield chunk
+    finally:
+        await stream.aclose()
+
+def call_with_retry(
+    fn: Callable[[float], Any],
+    node: Optional[str] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: bool = True,
+    on_discard: Optional[Callable[[Any], None]] = None
+) -> Any:
+    """
+    调用fn，暂时性错误时按策略退避重试。
+
+    只重试上游请求本身，调用方无需重新构建提示词。
+    hedge为True且已启用对冲（LLM_HEDGE_PERCENTILE）时，每次尝试都以对冲方式发起。
+
+    Args:
+        fn: 发起一次上游请求的函数，参数为本次请求的超时（秒，不超过到截止时间的剩余时间）
+        node: 节点名称，用于对冲阈值和指标统计
+        policy: 重试策略，默认使用环境变量配置的策略
+        hedge: 是否允许对冲
+        on_discard: 对冲中落后但成功的请求的结果交给此函数处理
+
+    Returns:
+        fn的返回值
+    """
+    policy = policy or default_policy
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        delay = hedge_delay(node) if hedge else None
+        try:
+            if delay is None:
+                return fn(policy.timeout(start))
+            return hedged_call(lambda: fn(policy.timeout(start)), delay, node, on_discard)
+        except Exception as e:
+            wait_time = policy.next_delay(attempt, e, start)
+            if wait_time is None:
+                raise
+            _log_retry(node, e, wait_time, attempt, policy)
+        time.sleep(wait_time)
+        attempt += 1
+
+async def acall_with_retry(
+    fn: Callable[[float], Awaitable[Any]],
+    node: Optional[str] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: bool = True,
+    on_discard: Optional[Callable[[Any], None]] = None
+) -> Any:
+    """call_with_retry的异步版本。"""
+    policy = policy or default_policy
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        delay = hedge_delay(node) if hedge else None
+        try:
+            if delay is None:
+                return await fn(policy.timeout(start))
+            return await ahedged_call(lambda: fn(policy.timeout(start)), delay, node, on_discard)
+        except Exception as e:
+            wait_time = policy.next_delay(attempt, e, start)
+            if wait_time is None:
+                raise
+            _log_retry(node, e, wait_time, attempt, policy)
+        await asyncio.sleep(wait_time)
+        attempt += 1
+
+def stream_with_retry(
+    open_stream: Callable[[float], Iterator[str]],
+    node: Optional[str] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: bool = True,
+    on_discard: Optional[Callable[[Any], None]] = None
+) -> Iterator[str]:
+    """
+    逐块产出open_stream()的内容，在收到第一块之前失败时退避重试。
+
+    已经产出内容后失败则直接抛出，避免向调用方重复产出文本。
+    启用对冲时，第一块在节点首个token耗时的百分位数之后仍未到达则再打开一个流（见hedged_stream）。
+
+    Args:
+        open_stream: 打开一次上游流的函数，参数为本次请求的超时；必须立即返回，第一次读取时才发起请求
+        node: 节点名称，用于对冲阈值和指标统计
+        policy: 重试策略，默认使用环境变量配置的策略
+        hedge: 是否允许对冲
+        on_discard: 对冲中落败的流交给此函数处理（随后由本函数关闭）
+    """
+    policy = policy or default_policy
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        started = False
+        delay = hedge_delay(node, "ttft") if hedge else None
+        if delay is None:
+            stream = open_stream(policy.timeout(start))
+        else:
+            stream = hedged_stream(lambda: open_stream(policy.timeout(start)), delay, node, on_discard)
+        try:
+            with closing(stream):
+                for chunk in stream:
+                    started = True
+                    yield chunk
+            return
+        except Exception as e:
+            wait_time = None if started else policy.next_delay(attempt, e, start)
+            if wait_time is None:
+                raise
+            _log_retry(node, e, wait_time, attempt, policy)
+        time.sleep(wait_time)
+        attempt += 1
+
+async def astream_with_retry(
+    open_stream: Callable[[float], AsyncIterator[str]],
+    node: Optional[str] = None,
+    policy: Optional[RetryPolicy] = None,
+    hedge: bool = True,
+    on_discard: Optional[Callable[[Any], None]] = None
+) -> AsyncIterator[str]:
+    """stream_with_retry的异步版本。"""
+    policy = policy or default_policy
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        started = False
+        delay = hedge_delay(node, "ttft") if hedge else None
+        if delay is None:
+            stream = open_stream(policy.timeout(start))
+        else:
+            stream = ahedged_stream(lambda: open_stream(policy.timeout(start)), delay, node, on_discard)
+        try:
+            async for chunk in stream:
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            wait_time = None if started else policy.next_delay(attempt, e, start)
+            if wait_time is None:
+                raise
+            _log_retry(node, e, wait_time, attempt, policy)
+        finally:
+            await stream.aclose()
+        await asyncio.sleep(wait_time)
+        attempt += 1
+
+if __name__ == "__main__":
+    # 前两次以连接错误失败，第三次成功
+    failures = iter([ConnectionError("reset"), TimeoutError("slow")])
+
+    def flaky(timeout):
+        error = next(failures, None)
+        if error:
+            raise error
+        return "ok"
+
+    policy = RetryPolicy(max_attempts=4, base_delay=0.05, max_delay=0.2, deadline=5)
+    print(f"Retried result: {call_with_retry(flaky, node='demo', policy=policy)}")
+
+    # 不可重试的错误立即抛出
+    try:
+        call_with_retry(lambda timeout: 1 / 0, node='demo', policy=policy)
+    except ZeroDivisionError:
+        print("Non-retryable error raised immediately")
+
+    # 对冲：第一个请求很慢，对冲请求先返回
+    calls = []
+
+    def slow_then_fast():
+        calls.append(1)
+        time.sleep(1.0 if len(calls) == 1 else 0.05)
+        return f"request {len(calls)}"
+
+    begin = time.perf_counter()
+    result = hedged_call(slow_then_fast, delay=0.1, node='demo')
+    print(f"Hedged result: {result} in {time.perf_counter() - begin:.2f}s")
+    stats = llm_metrics.snapshot()["nodes"]["demo"]
+    print(f"retries={stats['retries']} hedges_fired={stats['hedges_fired']} hedges_won={stats['hedges_won']}")
@@ -0,0 +1,218 @@
+import yaml
+from typing import Any, Dict, Iterable, Optional
+from utils.yaml_stream import extract_yaml_block
+
+# 优先使用libyaml实现的C加速加载器，未编译libyaml时退回纯Python实现
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+# 主决策代理可选的工具，以及可以在一轮中并行执行的只读工具
+MAIN_TOOLS = ("read_file", "edit_file", "delete_file", "grep_search", "list_dir", "finish")
+READ_ONLY_TOOLS = ("read_file", "grep_search", "list_dir")
+MAX_PARALLEL_ACTIONS = 5
+
+class DecisionParseError(ValueError):
+    """LLM响应无法解析或不符合模式；path指出出错的位置，如"operations[2].end_line"。"""
+
+    def __init__(self, path: str, message: str):
+        self.path = path
+        self.message = message
+        super().__init__(f"{path}: {message}" if path else message)
+
+class Field:
+    """
+    声明式字段模式。
+
+    Args:
+        type: 期望的Python类型（或类型元组），None表示任意类型
+        required: 作为字典字段时是否必须存在
+        choices: 允许的取值
+        fields: type为dict时各键的模式
+        items: type为list时元素的模式
+        min_value/max_value: 数值范围，可以是整数或上下文中的变量名
+        min_items/max_items: 列表长度范围
+    """
+
+    def __init__(self, type: Any = None, required: bool = True, choices: Optional[Iterable[Any]] = None,
+                 fields: Optional[Dict[str, "Field"]] = None, items: Optional["Field"] = None,
+                 min_value: Any = None, max_value: Any = None,
+                 min_items: Optional[int] = None, max_items: Optional[int] = None):
+        self.type = type
+        self.required = required
+        self.choices = tuple(choices) if choices is not None else None
+        self.fields = fields
+        self.items = items
+        self.min_value = min_value
+        self.max_value = max_value
+        self.min_items = min_items
+        self.max_items = max_items
+
+def _type_name(expected: Any) -> str:
+    if isinstance(expected, tuple):
+        return " or ".join(t.__name__ for t in expected)
+    return expected.__name__
+
+def _bound(bound: Any, context: Dict[str, Any]) -> Any:
+    return context[bound] if isinstance(bound, str) else bound
+
+def validate(value: Any, field: Field, context: Optional[Dict[str, Any]] = None, path: str = "") -> None:
+    """按模式校验值，第一个不符合的位置抛出DecisionParseError。"""
+    context = context or {}
+    if field.type is not None:
+        # bool是int的子类，不能当作行号
+        if not isinstance(value, field.type) or (isinstance(value, bool) and field.type is int):
+            raise DecisionParseError(path, f"expected {_type_name(field.type)}, got {type(value).__name__}: {value!r:.80}")
+    if field.choices is not None and value not in field.choices:
+        raise DecisionParseError(path, f"must be one of {', '.join(map(str, field.choices))}, got {value!r:.80}")
+
+    low, high = _bound(field.min_value, context), _bound(field.max_value, context)
+    if low is not None and value < low or high is not None and value > high:
+        raise DecisionParseError(path, f"out of range {low if low is not None else ''}..{high if high is not None else ''}: {value}")
+
+    if field.fields is not None:
+        for name, sub in field.fields.items():
+            sub_path = f"{path}.{name}" if path else name
+            if name not in value:
+                if sub.required:
+                    raise DecisionParseError(sub_path, "is missing")
+                continue
+            validate(value[name], sub, context, sub_path)
+
+    if field.items is not None:
+        if field.min_items is not None and len(value) < field.min_items:
+            raise DecisionParseError(path, f"must contain at least {field.min_items} items")
+        if field.max_items is not None and len(value) > field.max_items:
+            raise DecisionParseError(path, f"must contain at most {field.max_items} items, got {len(value)}")
+        for i, item in enumerate(value):
+            validate(item, field.items, context, f"{path}[{i}]")
+
+def load_yaml(yaml_content: str) -> Any:
+    """用C加速加载器解析YAML，语法错误转换为带行列位置的DecisionParseError。"""
+    try:
+        return yaml.load(yaml_content, Loader=YamlLoader)
+    except yaml.YAMLError as e:
+        mark = getattr(e, "problem_mark", None)
+        where = f" at line {mark.line + 1}, column {mark.column + 1}" if mark else ""
+        problem = getattr(e, "problem", None) or str(e)
+        raise DecisionParseError("", f"invalid YAML{where}: {problem}") from None
+
+def parse_yaml(yaml_content: str, schema: Field, context: Optional[Dict[str, Any]] = None) -> Any:
+    """解析已提取的YAML内容并按模式校验。"""
+    if not yaml_content:
+        raise DecisionParseError("", "No YAML object found in response")
+    data = load_yaml(yaml_content)
+    validate(data, schema, context)
+    return data
+
+def parse_response(response: str, schema: Field, context: Optional[Dict[str, Any]] = None, allow_bare: bool = False) -> Any:
+    """从完整的LLM响应中提取YAML代码块，解析并按模式校验。"""
+    return parse_yaml(extract_yaml_block(response, allow_bare=allow_bare), schema, context)
+
+#############################################
+# 各节点的模式
+#############################################
+_ACTION = Field(dict, fields={
+    "tool": Field(str, choices=READ_ONLY_TOOLS),
+    "reason": Field(),
+    "params": Field(dict)
+})
+
+# 并行只读操作列表
+PARALLEL_DECISION_SCHEMA = Field(dict, fields={
+    "reason": Field(required=False),
+    "actions": Field(list, items=_ACTION, min_items=1, max_items=MAX_PARALLEL_ACTIONS)
+})
+
+# 单个工具的决策；除finish外params必须是映射
+DECISION_SCHEMA = Field(dict, fields={
+    "tool": Field(str, choices=MAIN_TOOLS),
+    "reason": Field(),
+    "params": Field((dict, type(None)), required=False)
+})
+
+# 编辑计划：行号在1..total_lines之间（total_lines由上下文提供）
+EDIT_PLAN_SCHEMA = Field(dict, fields={
+    "reasoning": Field(),
+    "operations": Field(list, items=Field(dict, fields={
+        "start_line": Field(int, min_value=1, max_value="total_lines"),
+        "end_line": Field(int, min_value=1, max_value="total_lines"),
+        "replacement": Field(str)
+    }))
+})
+
+def parse_main_decision(yaml_content: str) -> Dict[str, Any]:
+    """
+    解析MainDecisionAgent的决策。
+
+    返回单个工具的决策，或{"tool": "parallel", "reason": ..., "actions": [...]}。
+    只包含一个操作的actions列表按单个工具的决策返回。
+    """
+    if not yaml_content:
+        raise DecisionParseError("", "No YAML object found in response")
+    data = load_yaml(yaml_content)
+
+    if isinstance(data, dict) and "actions" in data:
+        validate(data, PARALLEL_DECISION_SCHEMA)
+        if len(data["actions"]) == 1:
+            return data["actions"][0]
+        return {"tool": "parallel", "reason": data.get("reason", ""), "actions": data["actions"]}
+
+    validate(data, DECISION_SCHEMA)
+    if data["tool"] == "finish":
+        data["params"] = {}
+    elif not isinstance(data.get("params"), dict):
+        raise DecisionParseError("params", f"required for tool {data['tool']}")
+    return data
+
+def parse_edit_plan(response: str, total_lines: int) -> Dict[str, Any]:
+    """解析AnalyzeAndPlanNode的编辑计划，并检查每个操作的start_line <= end_line。"""
+    plan = parse_response(response, EDIT_PLAN_SCHEMA, {"total_lines": total_lines})
+    for i, op in enumerate(plan["operations"]):
+        if op["start_line"] > op["end_line"]:
+            raise DecisionParseError(f"operations[{i}]", f"start_line > end_line: {op['start_line']} > {op['end_line']}")
+    return plan
+
+if __name__ == "__main__":
+    import time
+
+    # 错误报告
+    for bad in (
+        "tool: read_file\nreason: look\n",
+        "tool: rm_rf\nreason: x\nparams: {}\n",
+        "tool: read_file\nreason: [unclosed\n",
+    ):
+        try:
+            parse_main_decision(bad)
+        except DecisionParseError as e:
+            print(f"Rejected: {e}")
+    try:
+        parse_edit_plan("```yaml\nreasoning: x\noperations:\n  - start_line: 3\n    end_line: 99\n    replacement: y\n```", total_lines=40)
+    except DecisionParseError as e:
+        print(f"Rejected: {e}")
+
+    # 微基准：包含大量操作的编辑计划
+    operations = "".join(
+        f"  - start_line: {i}\n    end_line: {i}\n    replacement: |\n"
+        + "".join(f"      line {j} of replacement {i} with some code = call(arg_{j})\n" for j in range(8))
+        for i in range(1, 401)
+    )
+    response = f"Plan:\n```yaml\nreasoning: |\n  Replace each line.\noperations:\n{operations}```\n"
+    yaml_content = extract_yaml_block(response)
+    print(f"\nPayload: 400 operations, {len(yaml_content) / 1024:.0f} KB of YAML")
+
+    def bench(label: str, fn, repeat: int = 5) -> float:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        print(f"  {label}: {elapsed:.1f} ms")
+        return elapsed
+
+    pure = bench("yaml.safe_load (pure Python)", lambda: yaml.safe_load(yaml_content))
+    fast = bench(f"yaml.load({YamlLoader.__name__})", lambda: yaml.load(yaml_content, Loader=YamlLoader))
+    data = yaml.load(yaml_content, Loader=YamlLoader)
+    bench("schema validation", lambda: validate(data, EDIT_PLAN_SCHEMA, {"total_lines": 400}))
+    bench("parse_edit_plan (extract + load + validate)", lambda: parse_edit_plan(response, 400))
+    print(f"  loader speedup: {pure / fast:.1f}x")
@@ -0,0 +1,160 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("llm_logger")
+
+def _take(tokens: float, updated: float, now: float, rate: float, capacity: float, amount: float) -> Tuple[float, float]:
+    """
+    令牌桶预约：按经过的时间补充令牌后扣除amount。
+
+    令牌可以扣成负数，此时返回需要等待的时间，等待结束时预约的令牌恰好补齐。
+    预约式扣除让并发调用方按到达顺序排队，而不是同时醒来再次争抢。
+
+    Returns:
+        (扣除后的令牌数, 需要等待的秒数)
+    """
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    tokens -= amount
+    return tokens, (-tokens / rate if tokens < 0 else 0.0)
+
+class RateLimiter:
+    """
+    按每分钟请求数（RPM）和每分钟token数（TPM）限流的令牌桶，可在线程间共享。
+
+    每个桶的容量为一分钟的配额，以配额/60的速率补充。调用前用估算的token数预约，
+    调用后用adjust()按实际用量修正，使长期吞吐量贴近配额。
+    rpm或tpm为None时不限制对应维度。
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        # 桶名称 -> (每秒补充速率, 容量)
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        if rpm:
+            self.buckets["requests"] = (rpm / 60.0, float(rpm))
+        if tpm:
+            self.buckets["tokens"] = (tpm / 60.0, float(tpm))
+        self._lock = threading.Lock()
+        self._state: Dict[str, Tuple[float, float]] = {}  # 桶名称 -> (令牌数, 更新时间)
+
+    def _debit(self, name: str, amount: float) -> float:
+        rate, capacity = self.buckets[name]
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._state.get(name, (capacity, now))
+            tokens, delay = _take(tokens, updated, now, rate, capacity, amount)
+            self._state[name] = (tokens, now)
+        return delay
+
+    def reserve(self, tokens: int = 0) -> float:
+        """预约一次请求和tokens个token，返回调用方需要等待的秒数。"""
+        delay = 0.0
+        if "requests" in self.buckets:
+            delay = max(delay, self._debit("requests", 1))
+        if "tokens" in self.buckets and tokens:
+            delay = max(delay, self._debit("tokens", tokens))
+        if delay > 0:
+            logger.info(f"Rate limited, waiting {delay:.2f}s")
+        return delay
+
+    def acquire(self, tokens: int = 0) -> None:
+        """预约并阻塞等待，直到配额允许发出请求。"""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """acquire的异步版本，等待期间不阻塞事件循环。"""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def adjust(self, tokens: int) -> None:
+        """按实际用量修正TPM预约：正数追加扣除，负数退还。"""
+        if "tokens" in self.buckets and tokens:
+            self._debit("tokens", tokens)
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    令牌桶状态保存在SQLite数据库中的限流器，供同一台机器上的多个进程共享配额。
+
+    每次预约在一个BEGIN IMMEDIATE事务中完成读取、补充和扣除；
+    时间使用墙上时钟，因为单调时钟不能跨进程比较。
+    """
+
+    def __init__(self, db_path: str, rpm: Optional[float] = None, tpm: Optional[float] = None, busy_timeout: float = 30.0):
+        super().__init__(rpm, tpm)
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每次预约使用新连接：开销远小于一次LLM调用，且在fork后依然安全
+        return sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+
+    def _debit(self, name: str, amount: float) -> float:
+        rate, capacity = self.buckets[name]
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE name = ?", (name,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens, delay = _take(tokens, updated, now, rate, capacity, amount)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (name, tokens, now)
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return delay
+
+def rate_limiter_from_env() -> RateLimiter:
+    """
+    根据环境变量LLM_RPM和LLM_TPM创建限流器。
+
+    设置LLM_RATE_LIMIT_DB时使用SQLite存储状态，在多个进程之间共享配额；
+    两个配额都未设置时返回不做任何限制的限流器。
+    """
+    rpm = os.getenv("LLM_RPM")
+    tpm = os.getenv("LLM_TPM")
+    rpm = float(rpm) if rpm else None
+    tpm = float(tpm) if tpm else None
+    db_path = os.getenv("LLM_RATE_LIMIT_DB")
+    if db_path and (rpm or tpm):
+        return SQLiteRateLimiter(db_path, rpm=rpm, tpm=tpm)
+    return RateLimiter(rpm=rpm, tpm=tpm)
+
+if __name__ == "__main__":
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(limiter: RateLimiter, label: str) -> None:
+        # 120 RPM的桶初始有120个令牌；预约130次请求，超出的10次按每秒2次放行
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: limiter.acquire(), range(130)))
+        print(f"{label}: 130 requests at 120 RPM took {time.perf_counter() - start:.1f}s (expected ~5s)")
+
+    run(RateLimiter(rpm=120), "In-process")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        limiter = SQLiteRateLimiter(os.path.join(tmp, "rate_limit.db"), tpm=6000)
+        print(f"First 5000-token reservation waits {limiter.reserve(5000):.1f}s")
+        print(f"Second 5000-token reservation waits {limiter.reserve(5000):.1f}s")
+        limiter.adjust(-4000)  # 实际用量比估算少4000
+        print(f"After refund, a 1000-token reservation waits {limiter.reserve(1000):.1f}s")
@@ -1,11 +1,30 @@
+import io
 import os
 from typing import Tuple, Optional
+from utils.file_cache import file_cache
+from utils.line_index import line_index_cache
+from utils.file_outline import describe_file, sniff_binary
+
+# 不小于此大小的文件按行偏移索引读取指定范围，不把整个文件读入内存
+LINE_INDEX_MIN_BYTES = int(os.getenv("LINE_INDEX_MIN_BYTES", str(1024 * 1024)))
+# 超过此大小的文件不整个读取，只返回大小、结构大纲以及头部和尾部的行
+READ_FILE_MAX_BYTES = int(os.getenv("READ_FILE_MAX_BYTES", str(64 * 1024)))
+
+def _number_lines(text: str, first_line: int = 1) -> str:
+    # 与readlines()相同，只按\n分行
+    return ''.join(f"{i}: {line}" for i, line in enumerate(io.StringIO(text).readlines(), first_line))
+
+def _binary_file(target_file: str, bounded: bool) -> Tuple[str, bool]:
+    if bounded:
+        return describe_file(target_file, True, READ_FILE_MAX_BYTES), True
+    return f"Error: File {target_file} appears to be binary and cannot be read as text", False
 
 def read_file(
     target_file: str, 
     start_line_one_indexed: Optional[int] = None, 
     end_line_one_indexed_inclusive: Optional[int] = None, 
-    should_read_entire_file: bool = False
+    should_read_entire_file: bool = False,
+    bounded: bool = False
 ) -> Tuple[str, bool]:
     """
     从文件中读取内容，支持行范围。
@@ -16,6 +35,8 @@ def read_file(
         start_line_one_indexed: 起始行号（基于1）。如果为None，默认读取整个文件。
         end_line_one_indexed_inclusive: 结束行号（基于1）。如果为None，默认读取整个文件。
         should_read_entire_file: 如果为True，忽略行参数并读取整个文件
+        bounded: 读取整个文件时，过大的文件和二进制文件只返回有界的视图（大小、大纲、头部和尾部的行）；
+            为False时总是返回完整内容，二进制文件返回错误（编辑流程需要完整的内容和准确的行号）
     
     Returns:
         包含(带行号的文件内容, 成功状态)的元组
@@ -28,24 +49,42 @@ def read_file(
         if start_line_one_indexed is None or end_line_one_indexed_inclusive is None:
             should_read_entire_file = True
         
-        with open(target_file, 'r', encoding='utf-8') as f:
-            if should_read_entire_file:
-                lines = f.readlines()
-                # 为每行添加行号
-                numbered_lines = [f"{i+1}: {line}" for i, line in enumerate(lines)]
-                return ''.join(numbered_lines), True
-            
-            # 验证行范围参数
-            if start_line_one_indexed < 1:
-                return "Error: start_line_one_indexed must be at least 1", False
-            
-            if end_line_one_indexed_inclusive < start_line_one_indexed:
-                return "Error: end_line_one_indexed_inclusive must be >= start_line_one_indexed", False
-            
-            # 检查请求的范围是否超过250行限制
-            if end_line_one_indexed_inclusive - start_line_one_indexed + 1 > 250:
-                return "Error: Cannot read more than 250 lines at once", False
-            
+        if should_read_entire_file:
+            # 过大的文件（如package-lock.json、压缩过的脚本）不读入内存和提示词，只返回有界的视图
+            if bounded and os.path.getsize(target_file) > READ_FILE_MAX_BYTES:
+                return describe_file(target_file, sniff_binary(target_file), READ_FILE_MAX_BYTES), True
+            # 已缓存的文件是文本文件，不需要再读取开头判断
+            if target_file not in file_cache and sniff_binary(target_file):
+                return _binary_file(target_file, bounded)
+            try:
+                # 通过共享文件缓存读取：预读过或未变化的文件直接从内存返回，
+                # 带行号的内容也随文件内容缓存（编辑前ReadTargetFileNode会再次读取同一文件）
+                return file_cache.derived(target_file, "numbered", _number_lines), True
+            except UnicodeDecodeError:
+                # 开头之后才出现非UTF-8内容
+                return _binary_file(target_file, bounded)
+        
+        # 验证行范围参数
+        if start_line_one_indexed < 1:
+            return "Error: start_line_one_indexed must be at least 1", False
+        
+        if end_line_one_indexed_inclusive < start_line_one_indexed:
+            return "Error: end_line_one_indexed_inclusive must be >= start_line_one_indexed", False
+        
+        # 检查请求的范围是否超过250行限制
+        if end_line_one_indexed_inclusive - start_line_one_indexed + 1 > 250:
+            return "Error: Cannot read more than 250 lines at once", False
+        
+        # 大文件：通过行偏移索引只读取请求的范围，代价与范围大小成正比
+        if os.path.getsize(target_file) >= LINE_INDEX_MIN_BYTES:
+            text, total_lines = line_index_cache.read_lines(
+                target_file, start_line_one_indexed - 1, end_line_one_indexed_inclusive
+            )
+            if text is None:
+                return f"Error: start_line_one_indexed ({start_line_one_indexed}) exceeds file length ({total_lines})", False
+            return _number_lines(text, start_line_one_indexed), True
+        
+        with io.StringIO(file_cache.read_text(target_file)) as f:
             # 读取指定的行
             lines = f.readlines()
             
@@ -99,4 +138,28 @@ if __name__ == "__main__":
     # 测试读取不存在的文件
     content, success = read_file("non_existent_file.txt")
     print(f"\nRead non-existent file: success={success}")
-    print(f"Message: {content}") 
\ No newline at end of file
+    print(f"Message: {content}")
+    
+    # 测试读取过大的文件和二进制文件：只返回大小、大纲以及头部和尾部的行
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        large_file = os.path.join(tmp, "large.py")
+        with open(large_file, 'w') as f:
+            for i in range(READ_FILE_MAX_BYTES // 40 + 1):
+                f.write(f"def generated_{i}():\n    return {i}\n")
+        content, success = read_file(large_file, bounded=True)
+        print(f"\nRead {os.path.getsize(large_file)} byte file: success={success}, {len(content)} chars returned")
+        print(content[:500])
+        
+        binary_file = os.path.join(tmp, "data.bin")
+        with open(binary_file, 'wb') as f:
+            f.write(bytes(range(256)) * 4)
+        content, success = read_file(binary_file, bounded=True)
+        print(f"\nRead binary file: success={success}")
+        print(content)
+        
+        # 不使用bounded时（编辑流程）返回完整内容，二进制文件返回错误
+        content, success = read_file(large_file)
+        print(f"\nRead large file without bounded: success={success}, {len(content)} chars returned")
+        content, success = read_file(binary_file)
+        print(f"Read binary file without bounded: success={success}, {content}")
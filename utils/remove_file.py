@@ -1,5 +1,6 @@
 import os
 from typing import Tuple
+from utils.file_cache import file_cache
 
 def remove_file(target_file: str, start_line: int = None, end_line: int = None) -> Tuple[str, bool]:
     """
@@ -24,9 +25,8 @@ def remove_file(target_file: str, start_line: int = None, end_line: int = None)
         if start_line is None and end_line is None:
             return "Error: At least one of start_line or end_line must be specified", False
         
-        # 读取文件内容
-        with open(target_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        # 通过共享文件缓存读取文件内容
+        lines = file_cache.read_lines(target_file)
         
         # 验证行号
         if start_line is not None and start_line < 1:
@@ -53,9 +53,8 @@ def remove_file(target_file: str, start_line: int = None, end_line: int = None)
         # 移除指定的行
         del lines[start_idx:end_idx + 1]
         
-        # 将更新后的内容写回文件
-        with open(target_file, 'w', encoding='utf-8') as f:
-            f.writelines(lines)
+        # 将更新后的内容写回文件，同时更新缓存
+        file_cache.write_text(target_file, ''.join(lines))
         
         # 根据移除内容准备消息
         if start_line is None:
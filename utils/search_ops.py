@@ -1,6 +1,8 @@
+import io
 import os
 import re
 from typing import List, Dict, Any, Tuple, Optional
+from utils.file_cache import file_cache
 
 def grep_search(
     query: str,
@@ -57,7 +59,9 @@ def grep_search(
                 file_path = os.path.join(root, filename)
                 
                 try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    # 已缓存且未变化的文件直接在内存中搜索；其余文件流式读取，不写入缓存
+                    cached = file_cache.get(file_path)
+                    with io.StringIO(cached) if cached is not None else open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                         for i, line in enumerate(f, 1):
                             if pattern.search(line):
                                 results.append({
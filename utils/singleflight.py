@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+class Call:
+    """一次进行中的调用，跟随者等待领导者写入结果或错误。"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """等待调用完成并返回结果；领导者失败时抛出同一个错误。"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Timed out waiting for in-flight call")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """
+    合并相同键的并发调用（线程版）。
+
+    同一个键同时只有一个调用在执行（领导者），其余调用方（跟随者）等待并共享其结果。
+    调用完成后立即移除该键，之后的调用会重新执行，结果复用交给缓存负责。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Call] = {}
+
+    def join(self, key: str) -> Tuple[Call, bool]:
+        """
+        加入键对应的调用。
+
+        Returns:
+            (调用对象, 是否为领导者)；领导者必须在完成后调用finish()
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = Call()
+            return call, True
+
+    def finish(self, key: str, call: Call, result: Any = None, error: Optional[BaseException] = None) -> None:
+        """领导者写入结果或错误并唤醒所有跟随者。"""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result, call.error = result, error
+        call._done.set()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行fn，或等待正在执行的相同键调用。
+
+        Returns:
+            (结果, 是否与其他调用方共享)
+        """
+        call, leader = self.join(key)
+        if not leader:
+            return call.wait(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result, False
+
+class AsyncSingleFlight:
+    """
+    SingleFlight的asyncio版本。
+
+    只合并同一个事件循环中的调用；跟随者取消等待不会影响领导者。
+    """
+
+    def __init__(self):
+        self._calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]" = weakref.WeakKeyDictionary()
+
+    def join(self, key: str) -> Tuple[asyncio.Future, bool]:
+        calls = self._calls.setdefault(asyncio.get_running_loop(), {})
+        future = calls.get(key)
+        if future is not None:
+            return future, False
+        future = calls[key] = asyncio.get_running_loop().create_future()
+        return future, True
+
+    def finish(self, key: str, future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        calls = self._calls.get(asyncio.get_running_loop(), {})
+        if calls.get(key) is future:
+            del calls[key]
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+            # 没有跟随者时避免"exception was never retrieved"警告
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        future, leader = self.join(key)
+        if not leader:
+            return await asyncio.shield(future), True
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result=result)
+        return result, False
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    upstream_calls = []
+
+    def slow_call():
+        upstream_calls.append(1)
+        time.sleep(0.2)
+        return "response"
+
+    group = SingleFlight()
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = list(pool.map(lambda _: group.do("same prompt", slow_call), range(5)))
+    print(f"Threads: {len(results)} callers, {len(upstream_calls)} upstream call, shared flags: {[s for _, s in results]}")
+
+    async def main():
+        async_calls = []
+
+        async def aslow_call():
+            async_calls.append(1)
+            await asyncio.sleep(0.2)
+            return "response"
+
+        async_group = AsyncSingleFlight()
+        results = await asyncio.gather(*(async_group.do("same prompt", aslow_call) for _ in range(5)))
+        print(f"Asyncio: {len(results)} callers, {len(async_calls)} upstream call")
+
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+from typing import Optional
+
+_OPENERS = ("```yaml", "```yml")
+
+def extract_yaml_block(text: str, allow_bare: bool = False) -> str:
+    """
+    从完整的LLM响应中提取YAML内容。
+
+    依次查找```yaml、```yml和通用```代码块；都不存在时，
+    若allow_bare为True则返回整个响应，否则返回空字符串。
+    """
+    for opener in _OPENERS:
+        if opener in text:
+            return text.split(opener, 1)[1].split("```")[0].strip()
+    if "```" in text:
+        return text.split("```")[1].strip()
+    return text.strip() if allow_bare else ""
+
+class YamlBlockExtractor:
+    """
+    从流式响应中增量提取第一个```yaml代码块。
+
+    每收到一块文本就调用feed()；一旦YAML代码块闭合就返回其内容，
+    调用方可以立即停止读取流，而无需等待模型写完块后的说明文字。
+    流结束仍未得到闭合的块时，调用finish()按完整响应的规则提取。
+    """
+
+    def __init__(self, allow_bare: bool = False):
+        self.allow_bare = allow_bare
+        self.text = ""
+        self.block: Optional[str] = None
+        self._start: Optional[int] = None  # YAML内容在text中的起始位置
+        self._scan_from = 0
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """追加一块文本，YAML块已闭合时返回其内容，否则返回None。"""
+        if self.block is not None:
+            return self.block
+        self.text += chunk
+
+        if self._start is None:
+            # 回退几个字符，以便找到跨块边界的开始标记
+            window = max(0, self._scan_from - len(_OPENERS[0]))
+            for opener in _OPENERS:
+                idx = self.text.find(opener, window)
+                if idx != -1:
+                    self._start = idx + len(opener)
+                    break
+            if self._start is None:
+                self._scan_from = len(self.text)
+                return None
+            self._scan_from = self._start
+
+        end = self.text.find("```", max(self._start, self._scan_from - 2))
+        if end == -1:
+            self._scan_from = len(self.text)
+            return None
+
+        self.block = self.text[self._start:end].strip()
+        return self.block
+
+    def finish(self) -> str:
+        """流结束时调用，返回已闭合的块或按完整响应规则提取的内容。"""
+        if self.block is not None:
+            return self.block
+        return extract_yaml_block(self.text, allow_bare=self.allow_bare)
+
+if __name__ == "__main__":
+    response = "Let me think.\n```yaml\ntool: read_file\nparams:\n  target_file: main.py\n```\nTrailing prose..."
+
+    # 以很小的块模拟流式输入，检查跨块边界的标记
+    extractor = YamlBlockExtractor()
+    for i in range(0, len(response), 3):
+        block = extractor.feed(response[i:i + 3])
+        if block is not None:
+            print(f"Block closed after {i + 3} of {len(response)} chars:\n{block}")
+            break
+
+    print(f"\nMatches full extraction: {block == extract_yaml_block(response)}")
+    print(f"Bare fallback: {YamlBlockExtractor(allow_bare=True).finish() == ''}")